@@ -0,0 +1,46 @@
+"""
+Compare the full and the lean parsing of a Strava segment response into its segments document.
+
+Run from the repository root with: python -m benchmarks.segment_parsing [--number N]
+"""
+import argparse
+import copy
+import timeit
+from models.EnhancedSegment import EnhancedSegment
+from models.RawSegment import RawSegment
+from models.SegmentPayload import segment_document
+from segments_data.sample_payload import SEGMENT_PAYLOAD
+
+
+def full_path(segment_data):
+    return EnhancedSegment.from_raw_segment(RawSegment(**segment_data), "alghero", 0.0).to_dict()
+
+
+def lean_path(segment_data):
+    return segment_document(segment_data, "alghero", 0.0)
+
+
+def lean_segment_path(segment_data):
+    return EnhancedSegment.from_payload(segment_data, "alghero", 0.0).to_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="Parses timed per path")
+    args = parser.parse_args()
+    # RawSegment's validators modify the payload in place, so every parse gets its own copy
+    payloads = [copy.deepcopy(SEGMENT_PAYLOAD) for _ in range(args.number)]
+    assert full_path(copy.deepcopy(SEGMENT_PAYLOAD)) == lean_path(copy.deepcopy(SEGMENT_PAYLOAD))
+    baseline = None
+    for name, parse in (("RawSegment + from_raw_segment + to_dict", full_path),
+                        ("segment_document", lean_path),
+                        ("EnhancedSegment.from_payload + to_dict", lean_segment_path)):
+        payload_iter = iter(payloads)
+        seconds = timeit.timeit(lambda: parse(next(payload_iter)), number=args.number)
+        per_parse = seconds / args.number * 1e6
+        baseline = baseline or per_parse
+        print(f"{name:42} {per_parse:8.2f} us/parse  {baseline / per_parse:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
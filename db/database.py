@@ -1,5 +1,6 @@
 from pymongo import MongoClient
-from pymongo.errors import ConfigurationError
+from pymongo.errors import ConfigurationError, OperationFailure
+from db.indexes import INDEXED_QUERIES, REQUIRED_INDEXES
 from utils.logger import Logger
 
 
@@ -47,13 +48,57 @@ class Database:
         self.db[collection_name].insert_one(document)
 
     def update_one(self, collection_name, query, new_values, upsert=False):
-        self.db[collection_name].update_one(query, new_values, upsert=upsert)
+        return self.db[collection_name].update_one(query, new_values, upsert=upsert)
 
-    def find_one(self, collection_name, query):
-        return self.db[collection_name].find_one(query)
+    def update_many(self, collection_name, query, new_values):
+        return self.db[collection_name].update_many(query, new_values)
 
-    def find_many(self, collection_name, query):
-        return self.db[collection_name].find(query)
+    def aggregate(self, collection_name, pipeline):
+        return self.db[collection_name].aggregate(pipeline)
+
+    def find_one(self, collection_name, query, projection=None):
+        return self.db[collection_name].find_one(query, projection)
+
+    def find_many(self, collection_name, query, projection=None):
+        return self.db[collection_name].find(query, projection)
+
+    def bulk_write(self, collection_name, operations, ordered=False):
+        return self.db[collection_name].bulk_write(operations, ordered=ordered)
+
+    def ensure_indexes(self, indexes=None):
+        """Create the declared indexes; existing indexes with the same spec are left untouched."""
+        for collection_name, index_models in (indexes or REQUIRED_INDEXES).items():
+            try:
+                created = self.db[collection_name].create_indexes(index_models)
+                Logger.debug(f"Indexes ensured on {collection_name}: {created}")
+            except OperationFailure as e:
+                Logger.error(f"Could not create indexes on {collection_name}: {e}")
+
+    def explain(self, collection_name, query):
+        return self.db[collection_name].find(query).explain()
+
+    @staticmethod
+    def _winning_plan_index(plan):
+        """Return the index used by a query plan, or None for a collection scan."""
+        if plan.get("stage") == "IXSCAN":
+            return plan.get("indexName")
+        for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+            if child:
+                index_name = Database._winning_plan_index(child)
+                if index_name:
+                    return index_name
+        return None
+
+    def verify_indexes(self, queries=None):
+        """Explain each query and return (collection, query, index name or None) tuples."""
+        results = []
+        for collection_name, query in (queries or INDEXED_QUERIES):
+            query_planner = self.explain(collection_name, query).get("queryPlanner", {})
+            winning_plan = query_planner.get("winningPlan", {})
+            # Plans from the slot based engine wrap the classic plan tree in queryPlan
+            index_name = self._winning_plan_index(winning_plan.get("queryPlan", winning_plan))
+            results.append((collection_name, query, index_name))
+        return results
 
     def close_connection(self):
         self.client.close()
@@ -0,0 +1,59 @@
+from datetime import datetime
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from utils.config import Config
+
+# Indexes backing the repository queries, created idempotently by Database.ensure_indexes
+REQUIRED_INDEXES = {
+    Config.SEGMENTS_COLL_NAME: [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("start_point", GEOSPHERE)], name="start_point_2dsphere"),
+    ],
+    Config.EFFORT_COLL_NAME: [
+        IndexModel([("segment_id", ASCENDING)], name="segment_id_unique", unique=True),
+    ],
+    Config.EFFORT_BUCKETS_COLL_NAME: [
+        IndexModel([("segment_id", ASCENDING), ("month", ASCENDING)], name="segment_id_month_unique", unique=True),
+    ],
+    Config.EFFORT_COMPACT_COLL_NAME: [
+        IndexModel([("segment_id", ASCENDING), ("year", ASCENDING)], name="segment_id_year_unique", unique=True),
+    ],
+    Config.AREA_ROLLUPS_COLL_NAME: [
+        IndexModel([("trail_area", ASCENDING), ("day", ASCENDING)], name="trail_area_day_unique", unique=True),
+    ],
+    Config.RUN_JOURNAL_COLL_NAME: [
+        IndexModel([("started_at", ASCENDING)], name="started_at"),
+    ],
+    Config.LEASES_COLL_NAME: [
+        # Leases only matter during their run, drop them a week later
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=7 * 24 * 60 * 60),
+    ],
+}
+
+# Representative shapes of the hot repository queries, checked with explain() by Database.verify_indexes
+INDEXED_QUERIES = [
+    (Config.SEGMENTS_COLL_NAME, {"id": 0}),
+    (Config.SEGMENTS_COLL_NAME, {"start_point": {"$geoWithin": {"$centerSphere": [[0, 0], 0.001]}}}),
+    (Config.EFFORT_COLL_NAME, {"segment_id": 0}),
+    (Config.EFFORT_BUCKETS_COLL_NAME, {"segment_id": 0, "month": {"$gte": "0000-00", "$lte": "9999-12"}}),
+    (Config.AREA_ROLLUPS_COLL_NAME, {"trail_area": "", "day": {"$gte": datetime.min, "$lte": datetime.max}}),
+]
+
+
+def main():
+    from dotenv import load_dotenv
+    from db.database import Database
+    from utils.logger import Logger
+
+    load_dotenv()
+    db = Database(Config())
+    db.ensure_indexes()
+    for collection_name, query, index_name in db.verify_indexes():
+        if index_name:
+            Logger.info(f"{collection_name} {query} uses index {index_name}")
+        else:
+            Logger.warning(f"{collection_name} {query} runs a collection scan")
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+from dotenv import load_dotenv
+from db.database import Database
+from utils.config import Config
+from utils.logger import Logger
+
+
+def bucket_effort_history(db: Database, config: Config, batch_size: int):
+    """Copy effort_stats history into the monthly effort_buckets collection."""
+    from services.effort_history_repository import EffortHistoryRepository
+
+    db.ensure_indexes()
+    EffortHistoryRepository(db, config).import_effort_stats(batch_size)
+
+
+def backfill_fetch_day(db: Database, config: Config, batch_size: int):
+    """Add the native fetch_day date to efforts that only have the fetch_date string."""
+    from services.segments_repository import fetch_day_expression
+
+    pipeline = [
+        {
+            "$set": {
+                "efforts": {
+                    "$map": {
+                        "input": "$efforts",
+                        "in": {"$mergeObjects": ["$$this", {"fetch_day": fetch_day_expression("$$this")}]},
+                    }
+                }
+            }
+        }
+    ]
+    for collection_name in (config.EFFORT_COLL_NAME, config.EFFORT_BUCKETS_COLL_NAME):
+        result = db.update_many(collection_name, {"efforts": {"$elemMatch": {"fetch_day": {"$exists": False}}}},
+                                pipeline)
+        Logger.info(f"Backfilled fetch_day on {result.modified_count} documents of {collection_name}")
+
+
+def compact_effort_history(db: Database, config: Config, batch_size: int):
+    """Rebuild the compact binary copy of the effort history."""
+    from services.compact_effort_repository import CompactEffortRepository
+
+    db.ensure_indexes()
+    CompactEffortRepository(db, config).compact_all(batch_size)
+
+
+def extract_geometries(db: Database, config: Config, batch_size: int):
+    """Copy segment polylines into the geometries collection and reference them by geometry_id."""
+    from pymongo import UpdateOne
+    from services.geometry_repository import GeometryRepository, polyline_hash
+
+    documents = db.find_many(config.SEGMENTS_COLL_NAME, {"polyline": {"$exists": True}}, {"_id": 1, "polyline": 1})
+    geometry_operations, segment_operations = [], []
+    migrated = 0
+    for document in documents:
+        polyline = document["polyline"]
+        geometry_operations.append(GeometryRepository.save_operation(polyline))
+        update = {"$set": {"geometry_id": polyline_hash(polyline)}}
+        if config.GEOMETRY_STORAGE == "collection":
+            update["$unset"] = {"polyline": "", "map.polyline": "", "field_hashes.polyline": ""}
+        segment_operations.append(UpdateOne({"_id": document["_id"]}, update))
+        migrated += 1
+        if len(segment_operations) >= batch_size:
+            db.bulk_write(config.GEOMETRIES_COLL_NAME, geometry_operations)
+            db.bulk_write(config.SEGMENTS_COLL_NAME, segment_operations)
+            geometry_operations, segment_operations = [], []
+    if segment_operations:
+        db.bulk_write(config.GEOMETRIES_COLL_NAME, geometry_operations)
+        db.bulk_write(config.SEGMENTS_COLL_NAME, segment_operations)
+    Logger.info(f"Extracted geometry of {migrated} segments into {config.GEOMETRIES_COLL_NAME}")
+
+
+def rebuild_area_rollups(db: Database, config: Config, batch_size: int):
+    """Recompute the per-area daily effort rollups from the effort history."""
+    from services.area_rollup_repository import AreaRollupRepository
+
+    db.ensure_indexes()
+    AreaRollupRepository(db, config).rebuild(batch_size)
+
+
+MIGRATIONS = {
+    "bucket-effort-history": bucket_effort_history,
+    "backfill-fetch-day": backfill_fetch_day,
+    "compact-effort-history": compact_effort_history,
+    "extract-geometries": extract_geometries,
+    "rebuild-area-rollups": rebuild_area_rollups,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a data migration against the configured database.")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    load_dotenv()
+    config = Config()
+    db = Database(config)
+    MIGRATIONS[args.migration](db, config, args.batch_size)
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
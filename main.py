@@ -1,39 +1,319 @@
+import argparse
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
 from dotenv import load_dotenv
 from db.database import Database, DatabaseConnectionError
 from models.EnhancedSegment import EnhancedSegment
-from models.RawSegment import RawSegment
+from services.effort_history_repository import EffortHistoryRepository
+from services.fetch_scheduler import FetchScheduler
+from services.response_cache import SegmentResponseCache
+from services.run_budget import RunBudget
+from services.run_journal import DEFERRED, FAILED, FETCHED, SKIPPED, SPOOLED, VALIDATED, WRITTEN, RunJournal
+from services.segment_leases import HELD, SegmentLeases, shard_work
+from services.segment_pipeline import SegmentPipeline
+from services.segment_scoring import SegmentScorer
+from services.segments_bulk_writer import SegmentsBulkWriter
 from services.segments_repository import SegmentsRepository
 from utils.logger import Logger
 from utils.config import Config
-from services.strava_api import StravaAPI
+from services.strava_api import StravaAPI, StravaRateLimitError
+from services.write_behind import SegmentSpool, WriteBehindWriter
+from services.token_manager import FileTokenStore, MongoTokenStore
 from segments_data.segment_ids import segment_ids
 
 
-def main():
+def all_segments():
+    """(location, segment_id) pairs of every configured segment."""
+    return [(location, segment_id) for location, segments in segment_ids.items() for segment_id in segments.keys()]
+
+
+def fetch_segment(strava_api: StravaAPI, location: str, segment_id: str,
+                  journal: RunJournal = None) -> EnhancedSegment:
+    """Fetch a segment from Strava and build its EnhancedSegment for the given location."""
+    # A payload replayed from the response cache keeps the time it was fetched, so its efforts are dated then
+    segment_data, timestamp = strava_api.get_segment_with_fetch_time(segment_id)
+    if journal:
+        journal.mark(segment_id, FETCHED, buffered=True)
+    enhanced_segment = EnhancedSegment.from_payload(segment_data, location, timestamp)
+    if journal:
+        journal.mark(segment_id, VALIDATED, buffered=True)
+    return enhanced_segment
+
+
+def failed_segment_ids(report) -> dict:
+    """Map the segment ids of the failed operations of a bulk write report to their error message."""
+    failed = {}
+    for error in report.errors:
+        query = (error.get("operation") or {}).get("q") or {}
+        segment_id = query.get("segment_id", query.get("id"))
+        if segment_id is not None:
+            failed[str(segment_id)] = error.get("message")
+    return failed
+
+
+def record_bulk_flush(journal: RunJournal, segments, report, leases: SegmentLeases = None):
+    """Mark the segments of a bulk flush written, or failed when one of their operations failed."""
+    failed = failed_segment_ids(report)
+    journal.mark([segment.id for segment in segments if str(segment.id) not in failed], WRITTEN)
+    for segment_id, message in failed.items():
+        journal.mark(segment_id, FAILED, message)
+    if leases:
+        leases.complete(segment.id for segment in segments)
+
+
+def record_spooled(journal: RunJournal, segments, leases: SegmentLeases = None):
+    """Mark spooled segments, which the next run writes when it replays the spool."""
+    journal.mark([segment.id for segment in segments], SPOOLED)
+    if leases:
+        leases.complete(segment.id for segment in segments)
+
+
+def record_failed(journal: RunJournal, segments, error: Exception, leases: SegmentLeases = None):
+    """Mark segments the DB rejected failed, so resuming the run retries them."""
+    journal.mark([segment.id for segment in segments], FAILED, str(error))
+    if leases:
+        leases.complete(segment.id for segment in segments)
+
+
+def segment_batch_store(config: Config, segments_repository: SegmentsRepository):
+    """Function storing a batch of segments with the configured write mode, raising when the DB fails."""
+    if config.WRITE_MODE == "bulk":
+        return segments_repository.write_segments_bulk
+
+    def store(segments):
+        for segment in segments:
+            segments_repository.write_segment_data(segment)
+    return store
+
+
+def prioritize(work, first):
+    """Move the pairs of work whose segment id is in first to the front, keeping the order otherwise."""
+    first = set(first)
+    return sorted(work, key=lambda pair: pair[1] not in first)
+
+
+def fetch_and_write_segments(strava_api: StravaAPI, segments_writer, max_workers: int, work=None,
+                             journal: RunJournal = None, journal_writes: bool = True,
+                             budget: RunBudget = None, leases: SegmentLeases = None) -> List[str]:
+    """
+    Fetch segments concurrently and write them from the calling thread as they complete.
+
+    segments_writer is either a SegmentsRepository or a SegmentsBulkWriter, and work the
+    (location, segment_id) pairs to process in priority order, all segments by default. A segment
+    that fails is logged and marked failed in the journal without stopping the others.
+    journal_writes=False leaves marking writes to the caller, as buffered writes only land on flush.
+
+    Segments are submitted a worker's worth at a time, so once the budget runs out or Strava's quota
+    is exhausted no new fetch starts. The segments left are marked deferred and returned.
+
+    With leases, a segment is only fetched once this worker claimed it, and its lease is
+    completed once it is written or failed. Segments leased by other workers are polled between
+    writes rather than by sleeping, so this worker keeps completing its own leases meanwhile.
+    """
+    work = iter(all_segments() if work is None else work)
+    budget = budget or RunBudget()
+    if leases:
+        work = leases.claim(work, budget, wait=False)
+    deferred = []
+    # When only segments held by other workers are left, the time to poll their leases again
+    poll_at = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit():
+            nonlocal poll_at
+            while len(futures) < max_workers and not budget.exhausted():
+                if poll_at is not None and time.monotonic() < poll_at:
+                    if futures:
+                        return
+                    time.sleep(max(poll_at - time.monotonic(), 0))
+                pair = next(work, None)
+                poll_at = None
+                if pair is None:
+                    return
+                if pair is HELD:
+                    poll_at = time.monotonic() + leases.poll_interval
+                    continue
+                location, segment_id = pair
+                futures[executor.submit(fetch_segment, strava_api, location, segment_id, journal)] = segment_id
+
+        submit()
+        while futures:
+            timeout = None if poll_at is None else max(poll_at - time.monotonic(), 0)
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                segment_id = futures.pop(future)
+                try:
+                    segments_writer.write_segment_data(future.result())
+                except DatabaseConnectionError:
+                    raise
+                except StravaRateLimitError as e:
+                    budget.stop(str(e))
+                    deferred.append(segment_id)
+                    continue
+                except Exception as e:
+                    Logger.error(f"Error processing segment {segment_id}: {e}")
+                    if journal:
+                        journal.mark(segment_id, FAILED, str(e))
+                    if leases:
+                        leases.complete([segment_id])
+                    continue
+                if journal_writes:
+                    if journal:
+                        journal.mark(segment_id, WRITTEN)
+                    if leases:
+                        leases.complete([segment_id])
+            submit()
+    deferred.extend(pair[1] for pair in work if pair is not HELD)
+    if deferred:
+        Logger.warning(f"Stopped early ({budget.reason}), deferring {len(deferred)} segments to the next run")
+        if journal:
+            journal.mark(deferred, DEFERRED)
+        if leases:
+            leases.release(deferred)
+    return deferred
+
+
+def run_segments(config: Config, strava_api: StravaAPI, segments_writer, work, journal: RunJournal,
+                 journal_writes: bool, budget: RunBudget, leases: SegmentLeases = None) -> List[str]:
+    """Process work with the configured execution mode and return the ids of the deferred segments."""
+    if config.EXECUTION_MODE == "pipeline":
+        pipeline = SegmentPipeline(strava_api, segments_writer, config.FETCH_MAX_WORKERS,
+                                   config.PIPELINE_VALIDATE_WORKERS, config.PIPELINE_WRITE_WORKERS,
+                                   config.PIPELINE_QUEUE_SIZE, journal, journal_writes, budget, leases)
+        return pipeline.run(work)
+    return fetch_and_write_segments(strava_api, segments_writer, config.FETCH_MAX_WORKERS, work, journal,
+                                    journal_writes, budget, leases)
+
+
+def run_maintenance(db: Database, config: Config, segments_repository: SegmentsRepository):
+    """Post-write maintenance; it only refreshes derived data, so a failure is logged and never fails the run."""
+    try:
+        segments_repository.geometries.build_shapes()
+        SegmentScorer(db, config).run()
+    except Exception as e:
+        Logger.error(f"Post-write maintenance failed, the next run retries it: {e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch segment stats from Strava and write them to the DB.")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Resume the latest (or the given) unfinished run, retrying only the segments "
+                             "that were not written")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """Main function to fetch and write segment stats."""
+    args = parse_args(argv)
     Logger.info("Starting script to update segments and effort data...")
     load_dotenv()
     try:
         config = Config()
         db = Database(config)
-        strava_api = StravaAPI(config)
-        segments_repository = SegmentsRepository(db, config)
-
-        Logger.debug("Starting script to fetch and update segment stats...")
-        for location, segments in segment_ids.items():
-            for segment_id in segments.keys():
-                segment_data = strava_api.get_segment(segment_id)
-                raw_segment = RawSegment(**segment_data)
-                timestamp = datetime.now().timestamp()
-                enhanced_segment = EnhancedSegment.from_raw_segment(raw_segment, location, timestamp)
-                segments_repository.write_segment_data(enhanced_segment)
+        db.ensure_indexes()
+        if config.STRAVA_TOKEN_STORE == "file":
+            token_store = FileTokenStore(config.STRAVA_TOKEN_FILE)
+        else:
+            token_store = MongoTokenStore(db, config)
+        response_cache = None
+        if config.STRAVA_CACHE_PATH and config.STRAVA_CACHE_TTL > 0:
+            response_cache = SegmentResponseCache(config.STRAVA_CACHE_PATH, config.STRAVA_CACHE_TTL,
+                                                  config.STRAVA_CACHE_MAX_BYTES)
+        strava_api = StravaAPI(config, token_store, response_cache)
+        effort_history = EffortHistoryRepository(db, config) if config.EFFORT_STORAGE == "bucket" else None
+        segments_repository = SegmentsRepository(db, config, effort_history)
+        job_id, leases = RunJournal.JOB_ID, None
+        if config.SHARD_MODE == "hash":
+            job_id = f"{RunJournal.JOB_ID}:{config.SHARD_INDEX}-of-{config.SHARD_COUNT}"
+        elif config.SHARD_MODE == "lease":
+            if not config.SHARD_RUN_KEY:
+                Logger.error("SHARD_RUN_KEY must be set to share a run between workers")
+                sys.exit(1)
+            job_id = f"{RunJournal.JOB_ID}:{config.SHARD_WORKER_ID}"
+            leases = SegmentLeases(db, config, config.SHARD_RUN_KEY, config.SHARD_WORKER_ID)
+        journal = None
+        if args.resume:
+            journal = RunJournal.resume(db, config, None if args.resume == "latest" else args.resume, job_id)
+            if journal is None:
+                Logger.info("No unfinished run to resume, starting a new one")
+        if journal is None:
+            work = all_segments()
+            if config.SHARD_MODE == "hash":
+                work = shard_work(work, config.SHARD_INDEX, config.SHARD_COUNT)
+            # Segments the previous run had no budget left for go first
+            deferred = RunJournal.deferred_segments(db, config, job_id)
+            if config.FETCH_SCHEDULE == "adaptive":
+                work = FetchScheduler(db, config).due_segments(work, first=deferred)
+            else:
+                work = prioritize(work, deferred)
+            journal = RunJournal.start(db, config, work, job_id)
+        work = journal.remaining()
+        budget = RunBudget(config.RUN_TIME_BUDGET, config.RUN_REQUEST_BUDGET,
+                           lambda: strava_api.rate_limit_governor.acquired, config.RUN_DEADLINE_MARGIN)
+        if budget.deadline is not None:
+            strava_api.rate_limit_governor.deadline = budget.deadline - budget.margin
+
+        Logger.debug(f"Starting script to fetch and update segment stats with {config.FETCH_MAX_WORKERS} workers...")
+        if config.WRITE_SPOOL_PATH:
+            spool = SegmentSpool(config.WRITE_SPOOL_PATH)
+            store_batch = segment_batch_store(config, segments_repository)
+            spool.replay(store_batch, config.BULK_WRITE_BATCH_SIZE)
+            segments_writer = WriteBehindWriter(
+                segments_repository, spool, config.BULK_WRITE_BATCH_SIZE if config.WRITE_MODE == "bulk" else 1,
+                config.BULK_WRITE_FLUSH_INTERVAL, config.WRITE_BEHIND_MAX_PENDING, store_batch,
+                on_flush=lambda segments, report: record_bulk_flush(journal, segments, report, leases),
+                # The journal and leases live in the DB too, there is no point marking them once it is down
+                on_spooled=lambda segments: None if segments_writer.db_down else record_spooled(
+                    journal, segments, leases),
+                on_failed=lambda segments, error: record_failed(journal, segments, error, leases),
+            )
+            run_segments(config, strava_api, segments_writer, work, journal, False, budget, leases)
+            report = segments_writer.close()
+            if segments_writer.db_down:
+                # Maintenance and the journal need the DB, the next run replays the spool
+                Logger.warning(f"The DB went down during the run, {segments_writer.spooled} segments are spooled "
+                               f"to {spool.path} for the next run")
+                strava_api.close()
+                db.close_connection()
+                sys.exit(0)
+            Logger.info(f"Writes completed with {len(report.errors)} failed operations "
+                        f"and {segments_writer.spooled} spooled segments")
+        elif config.WRITE_MODE == "bulk":
+            segments_writer = SegmentsBulkWriter(segments_repository, config.BULK_WRITE_BATCH_SIZE,
+                                                 config.BULK_WRITE_FLUSH_INTERVAL,
+                                                 on_flush=lambda segments, report: record_bulk_flush(
+                                                     journal, segments, report, leases),
+                                                 on_failed=lambda segments, error: record_failed(
+                                                     journal, segments, error, leases))
+            run_segments(config, strava_api, segments_writer, work, journal, False, budget, leases)
+            segments_writer.close()
+            Logger.info(f"Bulk writes completed with {len(segments_writer.report.errors)} failed operations")
+        else:
+            run_segments(config, strava_api, segments_repository, work, journal, True, budget, leases)
+        if leases:
+            journal.mark(leases.done_elsewhere(segment_id for _, segment_id in journal.remaining()), SKIPPED)
+        if not budget.exhausted():
+            run_maintenance(db, config, segments_repository)
+        completed = journal.finish()
+        summary = journal.summary()
+        Logger.info(f"Run {journal.run_id}: {summary[WRITTEN]} written, {summary[FAILED]} failed, "
+                    f"{summary[DEFERRED]} deferred")
     except DatabaseConnectionError as e:
         Logger.error(f"Error fetching segment stats: {e}")
         sys.exit(1)
-    Logger.info("Script execution completed!")
+    except StravaRateLimitError as e:
+        Logger.error(f"Error fetching segment stats: {e}, rerun with --resume to continue")
+        db.close_connection()
+        sys.exit(1)
+    strava_api.close()
     db.close_connection()
+    if not completed and summary[FAILED]:
+        Logger.error(f"Script finished with failed segments, rerun with --resume {journal.run_id} to retry them")
+        sys.exit(1)
+    Logger.info("Script execution completed!")
     sys.exit(0)
 
 
@@ -0,0 +1,19 @@
+from typing import Any, Dict, List
+from pydantic import BaseModel
+
+
+class BulkWriteReport(BaseModel):
+    operations: int = 0
+    inserted: int = 0
+    matched: int = 0
+    modified: int = 0
+    upserted: int = 0
+    errors: List[Dict[str, Any]] = []
+
+    def add(self, other: "BulkWriteReport"):
+        self.operations += other.operations
+        self.inserted += other.inserted
+        self.matched += other.matched
+        self.modified += other.modified
+        self.upserted += other.upserted
+        self.errors.extend(other.errors)
@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import List, Tuple
+import numpy as np
+from pydantic import BaseModel
+from models.SegmentEffortData import Effort
+from utils.config import Config
+
+DAY_OFFSET_DTYPE = np.dtype("<u2")
+COUNT_DELTA_DTYPE = np.dtype("<i4")
+
+
+def effort_day(effort: Effort) -> datetime:
+    return effort.fetch_day or datetime.strptime(effort.fetch_date, Config.DATE_FORMAT)
+
+
+class CompactEffortHistory(BaseModel):
+    """
+    Effort history of one segment for one year packed into two binary arrays.
+
+    days holds little-endian uint16 offsets from base_day and counts holds the effort counts as
+    little-endian int32 deltas, the first delta being the first count itself.
+    """
+    segment_id: int
+    year: int
+    base_day: datetime
+    size: int
+    days: bytes
+    counts: bytes
+
+    @classmethod
+    def from_efforts(cls, segment_id: int, year: int, efforts: List[Effort]):
+        """Pack the efforts of a year; several samples on the same day keep the last one."""
+        samples = {effort_day(effort).date(): effort.effort_count for effort in efforts}
+        fetch_days = np.array(sorted(samples), dtype="datetime64[D]")
+        effort_counts = np.array([samples[day] for day in sorted(samples)], dtype=np.int64)
+        base_day = np.datetime64(f"{year}-01-01", "D")
+        return cls(
+            segment_id=segment_id,
+            year=year,
+            base_day=datetime(year, 1, 1),
+            size=len(fetch_days),
+            days=(fetch_days - base_day).astype(DAY_OFFSET_DTYPE).tobytes(),
+            counts=np.diff(effort_counts, prepend=0).astype(COUNT_DELTA_DTYPE).tobytes(),
+        )
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Decode into a datetime64[D] array of fetch days and an int64 array of effort counts."""
+        base_day = np.datetime64(self.base_day.date(), "D")
+        fetch_days = base_day + np.frombuffer(self.days, dtype=DAY_OFFSET_DTYPE).astype("timedelta64[D]")
+        effort_counts = np.cumsum(np.frombuffer(self.counts, dtype=COUNT_DELTA_DTYPE), dtype=np.int64)
+        return fetch_days, effort_counts
+
+    def to_efforts(self) -> List[Effort]:
+        fetch_days, effort_counts = self.to_arrays()
+        efforts = []
+        for fetch_day, effort_count in zip(fetch_days.astype(datetime), effort_counts.tolist()):
+            day = datetime(fetch_day.year, fetch_day.month, fetch_day.day)
+            efforts.append(Effort(effort_count=effort_count, fetch_date=day.strftime(Config.DATE_FORMAT),
+                                  fetch_day=day))
+        return efforts
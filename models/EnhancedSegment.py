@@ -1,6 +1,7 @@
 from pydantic import BaseModel
 from typing import Optional
 from models.RawSegment import RawSegment, Map, LocalLegend
+from models.SegmentPayload import segment_fields
 
 
 class EnhancedSegment(BaseModel):
@@ -73,3 +74,19 @@ class EnhancedSegment(BaseModel):
             polyline=segment.map.polyline,
             timestamp=timestamp,
         )
+
+    @classmethod
+    def from_payload(cls, segment_data: dict, trail_area: str, timestamp: float):
+        """
+        Lean alternative to from_raw_segment validating only the fields of the Strava response kept here.
+
+        The fields are validated once by segment_fields, so the models are constructed without validating them again.
+        """
+        fields = segment_fields(segment_data, trail_area, timestamp)
+        fields['map'] = Map.model_construct(_MAP_FIELDS, **fields['map'])
+        return cls.model_construct(_SEGMENT_FIELDS, **fields)
+
+
+# Every field is set, so model_construct is given the fields set instead of working it out for each segment
+_MAP_FIELDS = frozenset(Map.model_fields)
+_SEGMENT_FIELDS = frozenset(EnhancedSegment.model_fields)
@@ -1,10 +1,13 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 from pydantic import BaseModel
 
 
 class Effort(BaseModel):
     effort_count: int
     fetch_date: str
+    # Midnight of the fetch date, stored as a BSON date so efforts can be sorted and range-queried
+    fetch_day: Optional[datetime] = None
 
 
 class SegmentEffortData(BaseModel):
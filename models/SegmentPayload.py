@@ -0,0 +1,79 @@
+from typing import Any, Dict, List, Optional
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict
+from models.RawSegment import LocalLegend
+
+
+class XomsPayload(TypedDict):
+    kom: Optional[str]
+
+
+class MapPayload(TypedDict):
+    id: str
+    polyline: str
+    resource_state: int
+
+
+class SegmentPayload(TypedDict):
+    """The fields of a Strava segment response that EnhancedSegment keeps; the others are ignored."""
+    id: int
+    name: str
+    distance: float
+    average_grade: float
+    start_latlng: List[float]
+    end_latlng: List[float]
+    local_legend: Optional[LocalLegend]
+    star_count: int
+    effort_count: int
+    athlete_count: int
+    xoms: XomsPayload
+    map: MapPayload
+
+
+# Built once, so each payload is validated by the compiled core schema without building RawSegment
+SEGMENT_PAYLOAD_ADAPTER = TypeAdapter(SegmentPayload)
+
+
+def segment_fields(segment_data: Dict[str, Any], trail_area: str, timestamp: float) -> Dict[str, Any]:
+    """
+    Validate the needed fields of a Strava segment response and map them to EnhancedSegment's fields.
+
+    local_legend is the validated LocalLegend model and map a dict.
+    """
+    payload = SEGMENT_PAYLOAD_ADAPTER.validate_python(segment_data)
+    start_lat, start_lng = payload["start_latlng"]
+    end_lat, end_lng = payload["end_latlng"]
+    return {
+        'id': payload["id"],
+        'name': payload["name"],
+        'alt_name': payload["name"],
+        'trail_area': trail_area,
+        'average_grade': payload["average_grade"],
+        'distance': payload["distance"],
+        'difficulty': '',
+        'popularity': 0,
+        'start_lat': start_lat,
+        'start_lng': start_lng,
+        'end_lat': end_lat,
+        'end_lng': end_lng,
+        'local_legend': payload["local_legend"],
+        'star_count': payload["star_count"],
+        'effort_count': payload["effort_count"],
+        'athlete_count': payload["athlete_count"],
+        'kom': payload["xoms"]["kom"],
+        'map': dict(payload["map"]),
+        'polyline': payload["map"]["polyline"],
+        'timestamp': timestamp,
+    }
+
+
+def segment_document(segment_data: Dict[str, Any], trail_area: str, timestamp: float) -> Dict[str, Any]:
+    """
+    Validate the needed fields of a Strava segment response and build its segments document.
+
+    The document equals EnhancedSegment.from_raw_segment(RawSegment(**segment_data), ...).to_dict().
+    """
+    document = segment_fields(segment_data, trail_area, timestamp)
+    local_legend = document['local_legend']
+    document['local_legend'] = local_legend.to_dict() if local_legend else None
+    return document
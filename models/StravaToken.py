@@ -0,0 +1,8 @@
+from typing import Optional
+from pydantic import BaseModel
+
+
+class StravaToken(BaseModel):
+    access_token: Optional[str] = None
+    refresh_token: str
+    expires_at: int = 0
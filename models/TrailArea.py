@@ -9,6 +9,7 @@ class LocalRider(BaseModel):
 
 class TrailBase(BaseModel):
     name: str
+    # (lat, lng), in the same order as Strava's start_latlng
     coordinates: Tuple[float, float] = [0.0, 0.0]
 
     class ConfigDict:
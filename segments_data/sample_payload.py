@@ -0,0 +1,22 @@
+"""A Strava segment response, shared by the payload tests and the parsing benchmark."""
+
+SEGMENT_PAYLOAD = {
+    "id": 229781, "resource_state": 3, "name": "Salita poltagra", "activity_type": "Ride",
+    "distance": 2684.82, "average_grade": 5.7, "maximum_grade": 14.2,
+    "elevation_high": 245.3, "elevation_low": 92.3,
+    "start_latlng": [40.5612, 8.3191], "end_latlng": [40.5701, 8.3304],
+    "elevation_profile": "https://d3o5xota0a1fcr.cloudfront.net/v6/charts/abc",
+    "climb_category": 1, "city": "Alghero", "state": "Sardegna", "country": "Italy",
+    "private": False, "hazardous": False, "starred": False,
+    "created_at": "2009-09-21T20:29:41Z", "updated_at": "2018-02-15T09:04:18Z",
+    "total_elevation_gain": 155.7,
+    "map": {"id": "s229781", "polyline": "}g|eFnpqjVl@En@Md@HbAd@d@^", "resource_state": 3},
+    "effort_count": 30951, "athlete_count": 3542, "star_count": 39,
+    "athlete_segment_stats": {"pr_elapsed_time": None, "pr_date": None, "pr_visibility": None,
+                              "pr_activity_id": None, "pr_activity_visibility": None, "effort_count": 0},
+    "xoms": {"kom": "5:44", "qom": "7:09", "overall": "5:44",
+             "destination": {"href": "strava://segments/229781/leaderboard", "type": "overall", "name": "All-Time"}},
+    "local_legend": {"athlete_id": 1, "title": "Mario R.", "profile": "https://example.com/p.jpg",
+                     "effort_description": "42 efforts in the last 90 days", "effort_count": "42",
+                     "effort_counts": {"overall": "42 efforts", "female": None}, "destination": "strava://x"},
+}
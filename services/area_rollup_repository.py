@@ -0,0 +1,175 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+from pymongo import UpdateOne
+from db.database import Database
+from models.CompactEffortHistory import effort_day
+from models.EnhancedSegment import EnhancedSegment
+from services.compact_effort_repository import effort_histories
+from utils.config import Config
+from utils.logger import Logger
+
+
+def rollup_day(segment: EnhancedSegment) -> datetime:
+    """Midnight of the day a segment was fetched, the day its efforts are rolled up into."""
+    fetched_at = datetime.fromtimestamp(segment.timestamp)
+    return datetime(fetched_at.year, fetched_at.month, fetched_at.day)
+
+
+def _sum_values(field: str):
+    return {"$sum": {"$map": {"input": {"$objectToArray": field}, "in": "$$this.v"}}}
+
+
+class AreaRollupRepository:
+    """
+    Total and new efforts per trail area per day, one document per area and day.
+
+    Each document keeps the effort count of every known segment of the area in counts, and the
+    count the segment had before that day in baselines. A day's document starts from the counts of
+    the area's previous rollup, so segments not fetched that day (not due, deferred or failed) keep
+    their last known count and add no new efforts instead of dropping out of the total. Writes
+    merge in the latest counts with an update pipeline that recomputes total_efforts (sum of
+    counts) and new_efforts (total minus the sum of baselines), so writing a segment twice on the
+    same day, as the morning and evening runs do, replaces its count instead of adding it again.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+        # Counts of the rollup before each (area, day) written by this process, read once per day
+        self._carried: Dict[tuple, Dict[str, int]] = {}
+
+    @property
+    def collection_name(self):
+        return self.config.AREA_ROLLUPS_COLL_NAME
+
+    @staticmethod
+    def rollup_pipeline(counts: Dict[str, int], baselines: Dict[str, int], carried: Dict[str, int] = None):
+        """
+        Update pipeline merging segment counts into a rollup; baselines already stored are kept.
+
+        A new rollup starts from the carried counts, which are also the baselines of their segments.
+        """
+        carried = {"$literal": carried or {}}
+        return [
+            {
+                "$set": {
+                    "counts": {"$mergeObjects": [{"$ifNull": ["$counts", carried]}, {"$literal": counts}]},
+                    # Later objects win in $mergeObjects, so a stored baseline overrides the new one
+                    "baselines": {"$mergeObjects": [{"$literal": baselines}, {"$ifNull": ["$baselines", carried]}]},
+                }
+            },
+            {
+                "$set": {
+                    "total_efforts": _sum_values("$counts"),
+                    "new_efforts": {"$subtract": [_sum_values("$counts"), _sum_values("$baselines")]},
+                    "segment_count": {"$size": {"$objectToArray": "$counts"}},
+                    "updated_at": "$$NOW",
+                }
+            },
+        ]
+
+    @staticmethod
+    def _group(segments: List[EnhancedSegment], previous_counts: Dict[int, Optional[int]]):
+        counts, baselines = defaultdict(dict), defaultdict(dict)
+        for segment in segments:
+            key = (segment.trail_area, rollup_day(segment))
+            previous_count = previous_counts.get(segment.id)
+            counts[key][str(segment.id)] = segment.effort_count
+            baselines[key][str(segment.id)] = segment.effort_count if previous_count is None else previous_count
+        return counts, baselines
+
+    def build_operations(self, segments: List[EnhancedSegment],
+                         previous_counts: Dict[int, Optional[int]]) -> List[UpdateOne]:
+        """
+        One rollup upsert per area and day of a batch of segments.
+
+        previous_counts maps segment ids to the effort count stored before the write, None for a
+        new segment, whose efforts are all counted as already there.
+        """
+        counts, baselines = self._group(segments, previous_counts)
+        return [
+            UpdateOne({"trail_area": trail_area, "day": day}, self._day_pipeline(trail_area, day, counts, baselines),
+                      upsert=True)
+            for trail_area, day in counts
+        ]
+
+    def _day_pipeline(self, trail_area: str, day: datetime, counts, baselines):
+        key = (trail_area, day)
+        return self.rollup_pipeline(counts[key], baselines[key], self.carried_counts(trail_area, day))
+
+    def record(self, segment: EnhancedSegment, previous_count: Optional[int]):
+        """Roll up a single segment write."""
+        counts, baselines = self._group([segment], {segment.id: previous_count})
+        (trail_area, day), = counts
+        self.db.update_one(self.collection_name, {"trail_area": trail_area, "day": day},
+                           self._day_pipeline(trail_area, day, counts, baselines), upsert=True)
+
+    def carried_counts(self, trail_area: str, day: datetime) -> Dict[str, int]:
+        """Segment counts of the latest rollup of an area before a day, the starting point of the day's rollup."""
+        key = (trail_area, day)
+        if key not in self._carried:
+            previous = list(self.db.find_many(self.collection_name, {"trail_area": trail_area, "day": {"$lt": day}},
+                                              {"_id": 0, "counts": 1}).sort("day", -1).limit(1))
+            self._carried[key] = previous[0].get("counts", {}) if previous else {}
+        return self._carried[key]
+
+    def find_day(self, trail_area: str, day: datetime) -> Optional[Dict]:
+        """Rollup of an area for one day."""
+        return self.db.find_one(self.collection_name, {"trail_area": trail_area, "day": day},
+                                {"_id": 0, "counts": 0, "baselines": 0})
+
+    def find_days(self, trail_area: str, start: datetime, end: datetime) -> List[Dict]:
+        """Rollups of an area between two days, inclusive, oldest first."""
+        return list(self.db.find_many(self.collection_name,
+                                      {"trail_area": trail_area, "day": {"$gte": start, "$lte": end}},
+                                      {"_id": 0, "counts": 0, "baselines": 0}).sort("day", 1))
+
+    @staticmethod
+    def rollup_documents(trail_areas: Dict[int, str], histories) -> Dict[tuple, Dict]:
+        """Rollup documents by (area, day) for (segment_id, efforts) histories, efforts oldest first."""
+        documents = {}
+        for segment_id, efforts in histories:
+            trail_area = trail_areas.get(segment_id)
+            if trail_area is None:
+                continue
+            previous_count = None
+            for effort in sorted(efforts, key=effort_day):
+                day = effort_day(effort)
+                day = datetime(day.year, day.month, day.day)
+                document = documents.setdefault((trail_area, day), {
+                    "trail_area": trail_area, "day": day, "counts": {}, "baselines": {},
+                })
+                document["counts"][str(segment_id)] = effort.effort_count
+                # Only the first fetch of a day sets the baseline, later ones replace the day's count
+                document["baselines"].setdefault(
+                    str(segment_id), effort.effort_count if previous_count is None else previous_count
+                )
+                previous_count = effort.effort_count
+        # Carry each area's counts forward into the following days, as the incremental writes do
+        carried = {}
+        for (trail_area, _), document in sorted(documents.items(), key=lambda item: item[0]):
+            for segment_id, count in carried.get(trail_area, {}).items():
+                document["counts"].setdefault(segment_id, count)
+                document["baselines"].setdefault(segment_id, count)
+            carried[trail_area] = document["counts"]
+        for document in documents.values():
+            document["total_efforts"] = sum(document["counts"].values())
+            document["new_efforts"] = document["total_efforts"] - sum(document["baselines"].values())
+            document["segment_count"] = len(document["counts"])
+            document["updated_at"] = datetime.now()
+        return documents
+
+    def rebuild(self, batch_size: int = 500) -> int:
+        """Recompute every rollup from the effort history and return the number of documents written."""
+        trail_areas = {
+            document["id"]: document["trail_area"]
+            for document in self.db.find_many(self.config.SEGMENTS_COLL_NAME, {}, {"_id": 0, "id": 1, "trail_area": 1})
+        }
+        documents = self.rollup_documents(trail_areas, effort_histories(self.db, self.config))
+        operations = [UpdateOne({"trail_area": trail_area, "day": day}, {"$set": document}, upsert=True)
+                      for (trail_area, day), document in documents.items()]
+        for start in range(0, len(operations), batch_size):
+            self.db.bulk_write(self.collection_name, operations[start:start + batch_size], ordered=False)
+        Logger.info(f"Rebuilt {len(operations)} area rollups into {self.collection_name}")
+        return len(operations)
@@ -0,0 +1,134 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from pymongo import UpdateOne
+from db.database import Database
+from models.CompactEffortHistory import CompactEffortHistory, effort_day
+from models.SegmentEffortData import Effort
+from utils.config import Config
+from utils.logger import Logger
+
+
+def effort_histories(db: Database, config: Config) -> Iterable[Tuple[int, List[Effort]]]:
+    """Yield the full effort history of every segment from the configured effort storage."""
+    if config.EFFORT_STORAGE == "bucket":
+        documents = db.aggregate(config.EFFORT_BUCKETS_COLL_NAME, [
+            {"$sort": {"segment_id": 1, "month": 1}},
+            {"$group": {"_id": "$segment_id", "efforts": {"$push": "$efforts"}}},
+        ])
+        for document in documents:
+            yield document["_id"], [Effort(**effort) for bucket in document["efforts"] for effort in bucket]
+    else:
+        documents = db.find_many(config.EFFORT_COLL_NAME, {}, {"_id": 0, "segment_id": 1, "efforts": 1})
+        for document in documents:
+            yield document["segment_id"], [Effort(**effort) for effort in document.get("efforts", [])]
+
+
+class StaleCompactHistoryError(Exception):
+    def __init__(self, message="The compact effort history is older than the latest run, "
+                               "rebuild it with python -m db.migrations compact-effort-history"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class CompactEffortRepository:
+    """
+    Optional compact copy of the effort history for analytics.
+
+    Each document packs one segment's efforts for one year (see CompactEffortHistory), and readers
+    decode them straight into NumPy arrays instead of validating one sub-document per sample.
+
+    The copy is a snapshot: segment writes do not update it. compact_all records when it was built
+    in job_state, and the readers raise StaleCompactHistoryError once a run started after that,
+    unless called with allow_stale=True.
+    """
+    JOB_ID = "effort_history_compact"
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+
+    @property
+    def collection_name(self):
+        return self.config.EFFORT_COMPACT_COLL_NAME
+
+    @staticmethod
+    def compact_efforts(segment_id: int, efforts: List[Effort]) -> List[CompactEffortHistory]:
+        efforts_by_year = defaultdict(list)
+        for effort in efforts:
+            efforts_by_year[effort_day(effort).year].append(effort)
+        return [CompactEffortHistory.from_efforts(segment_id, year, year_efforts)
+                for year, year_efforts in sorted(efforts_by_year.items())]
+
+    def compact_all(self, batch_size: int = 500) -> int:
+        """Rebuild the compact history of every segment and return the number of documents written."""
+        # Efforts written while the copy is built may be missed, so it is dated from the start
+        built_at = datetime.now()
+        operations = []
+        written = 0
+        for segment_id, efforts in effort_histories(self.db, self.config):
+            for history in self.compact_efforts(segment_id, efforts):
+                operations.append(UpdateOne({"segment_id": history.segment_id, "year": history.year},
+                                            {"$set": history.model_dump()}, upsert=True))
+            if len(operations) >= batch_size:
+                self.db.bulk_write(self.collection_name, operations, ordered=False)
+                written += len(operations)
+                operations = []
+        if operations:
+            self.db.bulk_write(self.collection_name, operations, ordered=False)
+            written += len(operations)
+        self.db.update_one(self.config.JOB_STATE_COLL_NAME, {"_id": self.JOB_ID},
+                           {"$set": {"built_at": built_at}}, upsert=True)
+        Logger.info(f"Wrote {written} compact effort history documents into {self.collection_name}")
+        return written
+
+    def built_at(self) -> Optional[datetime]:
+        """When the compact copy was last built, None if it never was."""
+        state = self.db.find_one(self.config.JOB_STATE_COLL_NAME, {"_id": self.JOB_ID})
+        return state.get("built_at") if state else None
+
+    def is_stale(self) -> bool:
+        """Whether a run may have written efforts the compact copy does not have."""
+        built_at = self.built_at()
+        if built_at is None:
+            return True
+        newer_runs = list(self.db.find_many(self.config.RUN_JOURNAL_COLL_NAME, {"started_at": {"$gt": built_at}},
+                                            {"_id": 1}).limit(1))
+        return bool(newer_runs)
+
+    def _find_histories(self, query, allow_stale: bool = False) -> Iterable[CompactEffortHistory]:
+        if not allow_stale and self.is_stale():
+            raise StaleCompactHistoryError()
+        documents = self.db.find_many(self.collection_name, query, {"_id": 0})
+        return (CompactEffortHistory(**document) for document in documents)
+
+    def read_arrays(self, segment_id: int, start_year: Optional[int] = None, end_year: Optional[int] = None,
+                    allow_stale: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode a segment's history into arrays of fetch days and effort counts, oldest first.
+
+        Raises StaleCompactHistoryError when the copy is older than the latest run, unless allow_stale.
+        """
+        query = {"segment_id": segment_id}
+        if start_year is not None or end_year is not None:
+            query["year"] = {key: year for key, year in (("$gte", start_year), ("$lte", end_year))
+                             if year is not None}
+        histories = sorted(self._find_histories(query, allow_stale), key=lambda history: history.year)
+        if not histories:
+            return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+        arrays = [history.to_arrays() for history in histories]
+        return np.concatenate([days for days, _ in arrays]), np.concatenate([counts for _, counts in arrays])
+
+    def read_many_arrays(self, segment_ids: List[int],
+                         allow_stale: bool = False) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Decode the histories of many segments with a single query, refusing a stale copy like read_arrays."""
+        arrays_by_segment = defaultdict(list)
+        for history in self._find_histories({"segment_id": {"$in": segment_ids}}, allow_stale):
+            arrays_by_segment[history.segment_id].append((history.year, history.to_arrays()))
+        result = {}
+        for segment_id, year_arrays in arrays_by_segment.items():
+            year_arrays.sort(key=lambda item: item[0])
+            result[segment_id] = (np.concatenate([days for _, (days, _) in year_arrays]),
+                                  np.concatenate([counts for _, (_, counts) in year_arrays]))
+        return result
@@ -0,0 +1,144 @@
+import argparse
+from datetime import datetime, timedelta
+from typing import List, Optional
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from db.database import Database
+from models.CompactEffortHistory import effort_day
+from models.SegmentEffortData import Effort
+from utils.config import Config
+from utils.logger import Logger
+
+# Key of the period an effort falls in for each retention resolution; one effort is kept per period
+RESOLUTION_KEYS = {
+    "sample": lambda day, index: index,
+    "day": lambda day, index: day.date(),
+    "week": lambda day, index: tuple(day.isocalendar())[:2],
+    "month": lambda day, index: (day.year, day.month),
+}
+
+
+def downsample_efforts(efforts: List[Effort], policy, now: datetime) -> List[Effort]:
+    """
+    Keep the efforts allowed by a retention policy.
+
+    policy is a sequence of (max_age_days, resolution) tiers ordered by age, the last tier having
+    max_age_days None. Within each period of a tier's resolution only the latest effort is kept.
+    """
+    kept = {}
+    for index, effort in enumerate(efforts):
+        day = effort_day(effort)
+        age_days = (now - day).days
+        for tier, (max_age_days, resolution) in enumerate(policy):
+            if max_age_days is None or age_days <= max_age_days:
+                kept[(tier, RESOLUTION_KEYS[resolution](day, index))] = (day, index, effort)
+                break
+    return [effort for _, _, effort in sorted(kept.values(), key=lambda item: (item[0], item[1]))]
+
+
+class EffortCompactor:
+    """
+    Downsamples old effort history by the retention policy in bounded, resumable batches.
+
+    Documents are visited in _id order and the last compacted _id is checkpointed after every
+    batch, so an interrupted run picks up where it stopped. Removed entries are pulled with an
+    update pipeline, which leaves efforts appended concurrently by the job untouched.
+    """
+    JOB_ID = "effort_compaction"
+
+    def __init__(self, db: Database, config: Config, policy=None, batch_size: int = 200):
+        self.config = config
+        self.db = db
+        self.policy = policy or config.EFFORT_RETENTION_POLICY
+        self.batch_size = batch_size
+
+    @property
+    def collection_name(self):
+        if self.config.EFFORT_STORAGE == "bucket":
+            return self.config.EFFORT_BUCKETS_COLL_NAME
+        return self.config.EFFORT_COLL_NAME
+
+    def _load_checkpoint(self):
+        state = self.db.find_one(self.config.JOB_STATE_COLL_NAME, {"_id": self.JOB_ID})
+        if state and not state.get("completed_at") and state.get("collection") == self.collection_name:
+            Logger.info(f"Resuming effort compaction after {state.get('last_id')}")
+            return state.get("last_id")
+        return None
+
+    def _save_checkpoint(self, last_id, completed: bool = False):
+        self.db.update_one(
+            self.config.JOB_STATE_COLL_NAME,
+            {"_id": self.JOB_ID},
+            {"$set": {"collection": self.collection_name, "last_id": last_id,
+                      "completed_at": datetime.now() if completed else None, "updated_at": datetime.now()}},
+            upsert=True,
+        )
+
+    def _compaction_operation(self, document, now: datetime) -> Optional[UpdateOne]:
+        efforts = [Effort(**effort) for effort in document.get("efforts", [])]
+        kept = downsample_efforts(efforts, self.policy, now)
+        if len(kept) == len(efforts):
+            return None
+        kept_dates = {effort.fetch_date for effort in kept}
+        removed_dates = sorted({effort.fetch_date for effort in efforts} - kept_dates)
+        pipeline = [{"$set": {"efforts": {"$filter": {
+            "input": "$efforts",
+            "cond": {"$not": [{"$in": ["$$this.fetch_date", {"$literal": removed_dates}]}]},
+        }}}}]
+        if self.collection_name == self.config.EFFORT_BUCKETS_COLL_NAME:
+            pipeline.append({"$set": {"count": {"$size": "$efforts"}}})
+        return UpdateOne({"_id": document["_id"]}, pipeline)
+
+    def _batch_query(self, last_id, now: datetime):
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        max_age_days, resolution = self.policy[0]
+        if resolution == "sample" and max_age_days is not None:
+            # Efforts in a first tier keeping every sample are never removed, so skip documents with only recent
+            # efforts; entries without fetch_day predate the migration and are always checked, also in a
+            # document that has newer entries with it ("efforts.fetch_day" $exists False needs all to lack it)
+            cutoff = now - timedelta(days=max_age_days)
+            query["$or"] = [{"efforts.fetch_day": {"$lt": cutoff}},
+                            {"efforts": {"$elemMatch": {"fetch_day": {"$exists": False}}}}]
+        return query
+
+    def run(self, max_batches: Optional[int] = None) -> int:
+        """Compact up to max_batches batches and return the number of documents rewritten."""
+        now = datetime.now()
+        last_id = self._load_checkpoint()
+        compacted = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            query = self._batch_query(last_id, now)
+            documents = list(self.db.find_many(self.collection_name, query, {"efforts": 1})
+                             .sort("_id", 1).limit(self.batch_size))
+            if not documents:
+                self._save_checkpoint(last_id, completed=True)
+                Logger.info(f"Effort compaction completed, {compacted} documents compacted")
+                return compacted
+            operations = [operation for operation in
+                          (self._compaction_operation(document, now) for document in documents) if operation]
+            if operations:
+                self.db.bulk_write(self.collection_name, operations, ordered=False)
+                compacted += len(operations)
+            last_id = documents[-1]["_id"]
+            self._save_checkpoint(last_id)
+            batches += 1
+        Logger.info(f"Effort compaction paused after {batches} batches, {compacted} documents compacted")
+        return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downsample old effort history by the retention policy.")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--max-batches", type=int, default=None)
+    args = parser.parse_args()
+
+    load_dotenv()
+    config = Config()
+    db = Database(config)
+    EffortCompactor(db, config, batch_size=args.batch_size).run(args.max_batches)
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
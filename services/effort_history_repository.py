@@ -0,0 +1,144 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import List
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db.database import Database
+from models.SegmentEffortData import Effort, SegmentEffortData
+from services.segments_repository import SegmentsRepository, day_range, fetch_day_expression
+from utils.config import Config
+from utils.logger import Logger
+
+
+def bucket_month(fetch_date: str) -> str:
+    """Sortable month key of the bucket holding an effort fetched on fetch_date."""
+    return datetime.strptime(fetch_date, Config.DATE_FORMAT).strftime(Config.BUCKET_MONTH_FORMAT)
+
+
+class EffortHistoryRepository:
+    """
+    Effort history stored as one bucket document per segment per month.
+
+    Appends only touch the current month's bucket, so the cost of a write stays constant however
+    long the history of a segment is.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+
+    @property
+    def collection_name(self):
+        return self.config.EFFORT_BUCKETS_COLL_NAME
+
+    @staticmethod
+    def bucket_query(segment_effort_data: SegmentEffortData):
+        return {"segment_id": segment_effort_data.segment_id,
+                "month": bucket_month(segment_effort_data.efforts[0].fetch_date)}
+
+    @staticmethod
+    def bucket_pipeline(segment_effort_data: SegmentEffortData):
+        """Upsert of the effort into its monthly bucket, replacing an entry for the same fetch date."""
+        pipeline = SegmentsRepository.upsert_effort_pipeline(segment_effort_data)
+        pipeline.append({"$set": {"count": {"$size": "$efforts"}}})
+        return pipeline
+
+    def append_operation(self, segment_effort_data: SegmentEffortData) -> UpdateOne:
+        return UpdateOne(self.bucket_query(segment_effort_data), self.bucket_pipeline(segment_effort_data),
+                         upsert=True)
+
+    def append_effort(self, segment_effort_data: SegmentEffortData):
+        """Append today's effort to the segment's current bucket."""
+        try:
+            self.db.update_one(self.collection_name, self.bucket_query(segment_effort_data),
+                               self.bucket_pipeline(segment_effort_data), upsert=True)
+        except Exception as e:
+            Logger.error(f"An error occurred while updating the database: {e}")
+            raise
+        Logger.debug(f"Effort bucket for segment {segment_effort_data.segment_id} written into DB")
+
+    def read_efforts(self, segment_id: int, start: datetime, end: datetime) -> List[Effort]:
+        """Read the efforts of a segment fetched between start and end, inclusive, oldest first."""
+        start_day, end_day = day_range(start, end)
+        pipeline = [
+            {
+                "$match": {
+                    "segment_id": segment_id,
+                    "month": {"$gte": start.strftime(self.config.BUCKET_MONTH_FORMAT),
+                              "$lte": end.strftime(self.config.BUCKET_MONTH_FORMAT)},
+                }
+            },
+            {"$unwind": "$efforts"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$efforts",
+                                                            {"fetch_day": fetch_day_expression("$efforts")}]}}},
+            {"$match": {"fetch_day": {"$gte": start_day, "$lte": end_day}}},
+            {"$sort": {"fetch_day": 1}},
+        ]
+        return [Effort(**effort) for effort in self.db.aggregate(self.collection_name, pipeline)]
+
+    def _import_operations(self, document) -> List[UpdateOne]:
+        """Merge the efforts of one effort_stats document into its monthly buckets."""
+        efforts_by_month = defaultdict(list)
+        for effort in document.get("efforts", []):
+            efforts_by_month[bucket_month(effort["fetch_date"])].append(
+                {"effort_count": effort["effort_count"], "fetch_date": effort["fetch_date"],
+                 "fetch_day": effort.get("fetch_day", datetime.strptime(effort["fetch_date"], Config.DATE_FORMAT))}
+            )
+        operations = []
+        for month, efforts in efforts_by_month.items():
+            fetch_dates = [effort["fetch_date"] for effort in efforts]
+            operations.append(UpdateOne(
+                {"segment_id": document["segment_id"], "month": month},
+                [
+                    {
+                        "$set": {
+                            "name": {"$ifNull": ["$name", {"$literal": document.get("name")}]},
+                            # Entries already in the bucket for other dates were appended after the switch to
+                            # bucket storage, so they go after the imported history
+                            "efforts": {
+                                "$concatArrays": [
+                                    {"$literal": efforts},
+                                    {
+                                        "$filter": {
+                                            "input": {"$ifNull": ["$efforts", []]},
+                                            "cond": {"$not": [{"$in": ["$$this.fetch_date",
+                                                                       {"$literal": fetch_dates}]}]},
+                                        }
+                                    },
+                                ]
+                            },
+                        }
+                    },
+                    {"$set": {"count": {"$size": "$efforts"}}},
+                ],
+                upsert=True,
+            ))
+        return operations
+
+    def _flush_import(self, operations: List[UpdateOne]):
+        try:
+            self.db.bulk_write(self.collection_name, operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                Logger.error(f"Bucket migration failed for {error.get('op')}: {error.get('errmsg')}")
+
+    def import_effort_stats(self, batch_size: int = 500) -> int:
+        """
+        Copy the effort_stats history into monthly buckets and return the number of segments migrated.
+
+        Buckets are merged by fetch date, so the migration can be re-run safely.
+        """
+        documents = self.db.find_many(self.config.EFFORT_COLL_NAME, {},
+                                      {"_id": 0, "segment_id": 1, "name": 1, "efforts": 1})
+        operations = []
+        migrated = 0
+        for document in documents:
+            operations.extend(self._import_operations(document))
+            migrated += 1
+            if len(operations) >= batch_size:
+                self._flush_import(operations)
+                operations = []
+        if operations:
+            self._flush_import(operations)
+        Logger.info(f"Migrated effort history of {migrated} segments into {self.collection_name}")
+        return migrated
@@ -0,0 +1,94 @@
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from db.database import Database
+from models.CompactEffortHistory import effort_day
+from models.SegmentEffortData import Effort
+from utils.config import Config
+from utils.logger import Logger
+
+
+def effort_rate(efforts: List[Effort]) -> Optional[float]:
+    """New efforts per day over a segment's stored samples, None when there are not two distinct days."""
+    if len(efforts) < 2:
+        return None
+    first, last = efforts[0], efforts[-1]
+    days = (effort_day(last) - effort_day(first)).total_seconds() / 86400
+    if days <= 0:
+        return None
+    return max(last.effort_count - first.effort_count, 0) / days
+
+
+class FetchScheduler:
+    """
+    Picks the segments due for a fetch from how fast their effort counts change.
+
+    A segment gaining efforts quickly is refreshed every run, while a quiet one waits up to
+    SCHEDULE_MAX_INTERVAL_DAYS: the interval is the time the segment takes to gain
+    SCHEDULE_TARGET_EFFORTS efforts at its recent rate. Segments without history are always due.
+    Due segments are ordered by how overdue they are and capped at the run's request quota.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+
+    def recent_efforts(self, now: datetime) -> Dict[int, List[Effort]]:
+        """The last SCHEDULE_RATE_SAMPLES efforts of every stored segment, oldest first."""
+        samples = self.config.SCHEDULE_RATE_SAMPLES
+        if self.config.EFFORT_STORAGE == "bucket":
+            since = now - timedelta(days=self.config.SCHEDULE_MAX_INTERVAL_DAYS + samples)
+            documents = self.db.aggregate(self.config.EFFORT_BUCKETS_COLL_NAME, [
+                {"$match": {"month": {"$gte": since.strftime(self.config.BUCKET_MONTH_FORMAT)}}},
+                {"$sort": {"segment_id": 1, "month": 1}},
+                {"$group": {"_id": "$segment_id", "buckets": {"$push": "$efforts"}}},
+            ])
+            histories = {document["_id"]: [effort for bucket in document["buckets"] for effort in bucket]
+                         for document in documents}
+        else:
+            documents = self.db.find_many(self.config.EFFORT_COLL_NAME, {},
+                                          {"_id": 0, "segment_id": 1, "efforts": {"$slice": -samples}})
+            histories = {document["segment_id"]: document.get("efforts", []) for document in documents}
+        return {int(segment_id): [Effort(**effort) for effort in efforts[-samples:]]
+                for segment_id, efforts in histories.items()}
+
+    def refresh_interval(self, rate: Optional[float]) -> float:
+        """Days between two fetches of a segment gaining rate efforts per day."""
+        if rate is None:
+            return self.config.SCHEDULE_MIN_INTERVAL_DAYS
+        if rate <= 0:
+            return self.config.SCHEDULE_MAX_INTERVAL_DAYS
+        return min(max(self.config.SCHEDULE_TARGET_EFFORTS / rate, self.config.SCHEDULE_MIN_INTERVAL_DAYS),
+                   self.config.SCHEDULE_MAX_INTERVAL_DAYS)
+
+    def priorities(self, work: List[Tuple[str, str]], now: datetime, first=()) -> Dict[str, float]:
+        """Elapsed time over refresh interval of each segment; due segments are at 1 or more."""
+        histories = self.recent_efforts(now)
+        priorities = {}
+        for _, segment_id in work:
+            efforts = histories.get(int(segment_id))
+            if not efforts or segment_id in first:
+                priorities[segment_id] = math.inf
+                continue
+            elapsed = (now - effort_day(efforts[-1])).total_seconds() / 86400
+            priorities[segment_id] = elapsed / self.refresh_interval(effort_rate(efforts))
+        return priorities
+
+    def due_segments(self, work: List[Tuple[str, str]], now: Optional[datetime] = None,
+                     quota: Optional[int] = None, first=()) -> List[Tuple[str, str]]:
+        """
+        The due (location, segment_id) pairs of work, most overdue first, at most quota of them.
+
+        Segments in first, like those a previous run deferred, are always due and go first.
+        """
+        now = now or datetime.now()
+        quota = self.config.FETCH_QUOTA if quota is None else quota
+        priorities = self.priorities(work, now, set(first))
+        due = sorted((pair for pair in work if priorities[pair[1]] >= 1),
+                     key=lambda pair: priorities[pair[1]], reverse=True)
+        if quota and len(due) > quota:
+            Logger.warning(f"{len(due)} segments are due but the quota allows {quota}, "
+                           f"deferring the least overdue ones")
+            due = due[:quota]
+        Logger.info(f"Scheduled {len(due)} of {len(work)} segments for this run")
+        return due
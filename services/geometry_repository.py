@@ -0,0 +1,129 @@
+import hashlib
+from typing import Dict, List, Optional
+import numpy as np
+from pymongo import UpdateOne
+from db.database import Database
+from utils.config import Config
+from utils.geometry import bounding_box, decode_polyline, decode_polylines, path_length, simplify
+from utils.logger import Logger
+
+
+def polyline_hash(polyline: str) -> str:
+    """Content address of an encoded polyline, used as the _id of its geometry document."""
+    return hashlib.blake2b(polyline.encode(), digest_size=16).hexdigest()
+
+
+class GeometryRepository:
+    """
+    Segment geometries stored once per distinct polyline in a content-addressed collection.
+
+    Segments reference their geometry by geometry_id, and consumers load the polyline only when
+    they need it, so scans over the segments collection do not carry the geometry along.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+        self._shape_cache: Dict[str, Dict] = {}
+
+    @property
+    def collection_name(self):
+        return self.config.GEOMETRIES_COLL_NAME
+
+    @staticmethod
+    def save_operation(polyline: str) -> UpdateOne:
+        # Geometry documents are immutable, an existing one is never rewritten
+        return UpdateOne({"_id": polyline_hash(polyline)}, {"$setOnInsert": {"polyline": polyline}}, upsert=True)
+
+    def save(self, polyline: str) -> str:
+        """Store a polyline if it is not stored yet and return its geometry_id."""
+        geometry_id = polyline_hash(polyline)
+        try:
+            self.db.update_one(self.collection_name, {"_id": geometry_id}, {"$setOnInsert": {"polyline": polyline}},
+                               upsert=True)
+        except Exception as e:
+            Logger.error(f"An error occurred while updating the database: {e}")
+            raise
+        return geometry_id
+
+    def get_polyline(self, geometry_id: str) -> Optional[str]:
+        document = self.db.find_one(self.collection_name, {"_id": geometry_id})
+        return document["polyline"] if document else None
+
+    def get_polylines(self, geometry_ids: List[str]) -> Dict[str, str]:
+        documents = self.db.find_many(self.collection_name, {"_id": {"$in": list(set(geometry_ids))}})
+        return {document["_id"]: document["polyline"] for document in documents}
+
+    def compute_shape(self, coordinates: np.ndarray) -> Dict:
+        """Bounding box, length and simplified paths of a decoded polyline, ready to store and render."""
+        tolerances = list(self.config.GEOMETRY_SIMPLIFY_TOLERANCES)
+        if len(coordinates) == 0:
+            return {"tolerances": tolerances, "points": 0, "bbox": None, "length": 0.0,
+                    "simplified": {str(tolerance): [] for tolerance in tolerances}}
+        return {
+            "tolerances": tolerances,
+            "points": len(coordinates),
+            "bbox": list(bounding_box(coordinates)),
+            "length": path_length(coordinates),
+            # Mongo keys cannot hold dots, tolerances are whole meters
+            "simplified": {str(tolerance): np.round(simplify(coordinates, tolerance), 5).tolist()
+                           for tolerance in tolerances},
+        }
+
+    def _failed_shape(self, error: Exception) -> Dict:
+        # Stored for the configured tolerances, so build_shapes does not pick the geometry up again
+        return {"tolerances": list(self.config.GEOMETRY_SIMPLIFY_TOLERANCES), "error": str(error)}
+
+    def _shapes(self, documents: List[Dict]) -> List[Dict]:
+        """Shapes of a batch of geometry documents, a failure marker for each polyline that cannot be decoded."""
+        try:
+            return [self.compute_shape(coordinates)
+                    for coordinates in decode_polylines([document["polyline"] for document in documents])]
+        except ValueError:
+            # Decode one by one to keep the valid geometries of a batch with a malformed one
+            pass
+        shapes = []
+        for document in documents:
+            try:
+                shapes.append(self.compute_shape(decode_polyline(document["polyline"])))
+            except ValueError as e:
+                Logger.error(f"Could not build the shape of geometry {document['_id']}: {e}")
+                shapes.append(self._failed_shape(e))
+        return shapes
+
+    def build_shapes(self, batch_size: int = 200) -> int:
+        """Compute and store the shape of every geometry that lacks one for the configured tolerances."""
+        query = {"shape.tolerances": {"$ne": list(self.config.GEOMETRY_SIMPLIFY_TOLERANCES)}}
+        built = 0
+        while True:
+            documents = list(self.db.find_many(self.collection_name, query, {"polyline": 1}).limit(batch_size))
+            if not documents:
+                break
+            operations = []
+            for document, shape in zip(documents, self._shapes(documents)):
+                self._shape_cache[document["_id"]] = shape
+                operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {"shape": shape}}))
+            self.db.bulk_write(self.collection_name, operations, ordered=False)
+            built += len(operations)
+        if built:
+            Logger.info(f"Built shapes for {built} geometries")
+        return built
+
+    def get_shape(self, geometry_id: str) -> Optional[Dict]:
+        """
+        Precomputed shape of a geometry, cached per polyline hash and computed on first use.
+
+        None when the geometry is not stored or its polyline cannot be decoded.
+        """
+        if geometry_id in self._shape_cache:
+            shape = self._shape_cache[geometry_id]
+            return None if "error" in shape else shape
+        document = self.db.find_one(self.collection_name, {"_id": geometry_id})
+        if not document:
+            return None
+        shape = document.get("shape")
+        if not shape or shape.get("tolerances") != list(self.config.GEOMETRY_SIMPLIFY_TOLERANCES):
+            shape, = self._shapes([document])
+            self.db.update_one(self.collection_name, {"_id": geometry_id}, {"$set": {"shape": shape}})
+        self._shape_cache[geometry_id] = shape
+        return None if "error" in shape else shape
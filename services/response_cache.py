@@ -0,0 +1,71 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from utils.logger import Logger
+
+
+class SegmentResponseCache:
+    """
+    On-disk SQLite cache of raw Strava segment payloads.
+
+    Entries expire ttl seconds after they were fetched, and the oldest entries are evicted once the
+    payloads take more than max_bytes. A rerun of a failed job, or local development, replays recent
+    payloads without spending Strava quota.
+    """
+
+    def __init__(self, path: str, ttl: float, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS segment_responses ("
+            "segment_id TEXT PRIMARY KEY, payload TEXT NOT NULL, fetched_at REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS segment_responses_fetched_at ON segment_responses (fetched_at)"
+        )
+
+    def get(self, segment_id: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """The cached payload of a segment and the time it was fetched from Strava, None when missing or expired."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload, fetched_at FROM segment_responses WHERE segment_id = ? AND fetched_at >= ?",
+                (str(segment_id), time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        Logger.debug(f"Segment {segment_id} served from response cache")
+        return json.loads(row[0]), row[1]
+
+    def put(self, segment_id: str, payload: Dict[str, Any], fetched_at: Optional[float] = None):
+        serialized = json.dumps(payload)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO segment_responses (segment_id, payload, fetched_at, size) VALUES (?, ?, ?, ?)",
+                (str(segment_id), serialized, fetched_at or time.time(), len(serialized)),
+            )
+            self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then the oldest ones until the cache fits in max_bytes."""
+        self._connection.execute("DELETE FROM segment_responses WHERE fetched_at < ?", (time.time() - self.ttl,))
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM segment_responses").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        rows = self._connection.execute("SELECT segment_id, size FROM segment_responses ORDER BY fetched_at")
+        evicted = []
+        for segment_id, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((segment_id,))
+            total_size -= size
+        self._connection.executemany("DELETE FROM segment_responses WHERE segment_id = ?", evicted)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,33 @@
+import time
+from typing import Callable, Optional
+
+
+class RunBudget:
+    """
+    Time and request budget of a job run.
+
+    The run stops taking new segments once the deadline minus margin has passed or request_count()
+    reaches max_requests, leaving the margin to finish in-flight fetches and flush pending writes.
+    A budget without a time or request limit never runs out on its own but can still be stopped.
+    """
+
+    def __init__(self, time_budget: Optional[float] = None, max_requests: Optional[int] = None,
+                 request_count: Optional[Callable[[], int]] = None, margin: float = 0):
+        self.started_at = time.time()
+        self.deadline = self.started_at + time_budget if time_budget else None
+        self.max_requests = max_requests or None
+        self.request_count = request_count or (lambda: 0)
+        self.margin = margin
+        self.reason: Optional[str] = None
+
+    def stop(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    def exhausted(self) -> bool:
+        if self.reason is None:
+            if self.deadline is not None and time.time() >= self.deadline - self.margin:
+                self.stop("time budget exhausted")
+            elif self.max_requests is not None and self.request_count() >= self.max_requests:
+                self.stop("request budget exhausted")
+        return self.reason is not None
@@ -0,0 +1,146 @@
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from pymongo.errors import PyMongoError
+from db.database import Database
+from utils.config import Config
+from utils.logger import Logger
+
+FETCHED = "fetched"
+VALIDATED = "validated"
+WRITTEN = "written"
+FAILED = "failed"
+# Not attempted because the run budget ran out; the next run takes these first
+DEFERRED = "deferred"
+# Written by another worker of a sharded run
+SKIPPED = "skipped"
+# Kept in the local write spool, written when the next run replays it
+SPOOLED = "spooled"
+DONE = (WRITTEN, SKIPPED, SPOOLED)
+
+
+class RunJournal:
+    """
+    Records the status of every segment of a job run so an interrupted run can be resumed.
+
+    Each run is one document in the run journal collection keyed by its run_id, holding a
+    segments map of segment id to status. The id of the latest run is kept in job_state, so a
+    resumed run picks it up and only processes the segments that were not written. Shards of a
+    sharded run keep their own latest run under their own job_id.
+
+    Intermediate statuses (fetched, validated) are marked with buffered=True: they are kept in
+    memory and written together with the next unbuffered mark, so they cost no round trip of their own.
+    """
+    JOB_ID = "segments_job"
+
+    def __init__(self, db: Database, config: Config, run_id: str, segments: Dict[str, Dict] = None):
+        self.config = config
+        self.db = db
+        self.run_id = run_id
+        self.segments = segments or {}
+        self._pending: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        # Held from taking the pending marks until they are written, so updates land in the order they were taken
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def start(cls, db: Database, config: Config, work: Iterable[Tuple[str, str]],
+              job_id: str = JOB_ID) -> "RunJournal":
+        """Open a new run over (location, segment_id) pairs and make it the latest run."""
+        run_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        segments = {str(segment_id): {"location": location, "status": None} for location, segment_id in work}
+        db.insert_one(config.RUN_JOURNAL_COLL_NAME, {
+            "_id": run_id, "started_at": datetime.now(), "completed_at": None, "segments": segments,
+        })
+        db.update_one(config.JOB_STATE_COLL_NAME, {"_id": job_id},
+                      {"$set": {"run_id": run_id, "updated_at": datetime.now()}}, upsert=True)
+        Logger.info(f"Started run {run_id} over {len(segments)} segments")
+        return cls(db, config, run_id, segments)
+
+    @classmethod
+    def resume(cls, db: Database, config: Config, run_id: Optional[str] = None,
+               job_id: str = JOB_ID) -> Optional["RunJournal"]:
+        """Load the given run, or the latest run when it did not complete; None if there is nothing to resume."""
+        if run_id is None:
+            state = db.find_one(config.JOB_STATE_COLL_NAME, {"_id": job_id})
+            run_id = state.get("run_id") if state else None
+        run = db.find_one(config.RUN_JOURNAL_COLL_NAME, {"_id": run_id}) if run_id else None
+        if not run or run.get("completed_at"):
+            return None
+        journal = cls(db, config, run_id, run.get("segments", {}))
+        Logger.info(f"Resuming run {run_id} with {len(journal.remaining())} segments left")
+        return journal
+
+    @classmethod
+    def deferred_segments(cls, db: Database, config: Config, job_id: str = JOB_ID) -> List[str]:
+        """Ids of the segments the latest run deferred."""
+        state = db.find_one(config.JOB_STATE_COLL_NAME, {"_id": job_id})
+        run = db.find_one(config.RUN_JOURNAL_COLL_NAME, {"_id": state["run_id"]}) if state else None
+        if not run:
+            return []
+        return [segment_id for segment_id, entry in run.get("segments", {}).items()
+                if entry.get("status") == DEFERRED]
+
+    def summary(self) -> Counter:
+        """Number of segments in each status."""
+        return Counter(entry.get("status") for entry in self.segments.values())
+
+    def remaining(self) -> List[Tuple[str, str]]:
+        """(location, segment_id) pairs of the segments not written yet, failed ones included."""
+        return [(entry["location"], segment_id) for segment_id, entry in self.segments.items()
+                if entry.get("status") not in DONE]
+
+    def mark(self, segment_ids: Iterable, status: str, error: Optional[str] = None, buffered: bool = False):
+        """
+        Set the status of one or more segments with a single update of the run document.
+
+        A buffered mark is only written with the next unbuffered mark or flush().
+        """
+        if isinstance(segment_ids, (str, int)):
+            segment_ids = [segment_ids]
+        segment_ids = [str(segment_id) for segment_id in segment_ids]
+        now = datetime.now()
+        new_values = {}
+        for segment_id in segment_ids:
+            new_values[f"segments.{segment_id}.status"] = status
+            new_values[f"segments.{segment_id}.error"] = error
+            new_values[f"segments.{segment_id}.updated_at"] = now
+        with self._lock:
+            for segment_id in segment_ids:
+                entry = self.segments.setdefault(segment_id, {"location": None})
+                entry.update({"status": status, "error": error, "updated_at": now})
+            self._pending.update(new_values)
+        if not buffered:
+            self._write(status)
+
+    def flush(self):
+        """Write the buffered marks."""
+        self._write("buffered")
+
+    def _write(self, status: str):
+        with self._write_lock:
+            with self._lock:
+                new_values, self._pending = self._pending, {}
+            if not new_values:
+                return
+            try:
+                self.db.update_one(self.config.RUN_JOURNAL_COLL_NAME, {"_id": self.run_id}, {"$set": new_values})
+            except PyMongoError as e:
+                # The journal is best effort, a DB outage is handled by the writes themselves
+                Logger.warning(f"Could not journal {len(new_values) // 3} segments as {status}: {e}")
+
+    def finish(self) -> bool:
+        """Close the run when every segment was written and return whether it completed."""
+        self.flush()
+        summary = self.summary()
+        unwritten = sum(summary.values()) - sum(summary[status] for status in DONE)
+        if unwritten:
+            Logger.warning(f"Run {self.run_id} left {unwritten} segments unwritten "
+                           f"({summary[DEFERRED]} deferred), resume it to retry them")
+            return False
+        self.db.update_one(self.config.RUN_JOURNAL_COLL_NAME, {"_id": self.run_id},
+                           {"$set": {"completed_at": datetime.now()}})
+        Logger.info(f"Run {self.run_id} completed")
+        return True
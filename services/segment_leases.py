@@ -0,0 +1,127 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+from pymongo.errors import DuplicateKeyError
+from db.database import Database
+from utils.config import Config
+from utils.logger import Logger
+
+# Yielded by claim(wait=False) when only segments held by other workers are left
+HELD = object()
+
+
+def shard_of(segment_id, shard_count: int) -> int:
+    """Stable shard of a segment, the same in every process unlike the salted built-in hash()."""
+    digest = hashlib.blake2b(str(segment_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def shard_work(work: Iterable[Tuple[str, str]], shard_index: int, shard_count: int) -> List[Tuple[str, str]]:
+    """The (location, segment_id) pairs of work that belong to one shard."""
+    return [(location, segment_id) for location, segment_id in work if shard_of(segment_id, shard_count) == shard_index]
+
+
+class SegmentLeases:
+    """
+    Segments of a run claimed dynamically by the workers sharing a run_key.
+
+    A worker claims a segment by upserting its lease document, which only matches while nobody
+    else holds an unexpired lease and the segment is not done, so two workers never claim the same
+    segment. A failed segment is done too, it is retried by resuming the run of the worker that
+    failed it. Leases outlive the longest rate limit wait so a live worker keeps them, and expire when
+    a worker crashes so the others take its segments over.
+    """
+
+    def __init__(self, db: Database, config: Config, run_key: str, worker_id: str):
+        self.config = config
+        self.db = db
+        self.run_key = run_key
+        self.worker_id = worker_id
+
+    @property
+    def collection_name(self):
+        return self.config.LEASES_COLL_NAME
+
+    @property
+    def poll_interval(self) -> float:
+        return self.config.SEGMENT_LEASE_POLL_INTERVAL
+
+    def _lease_id(self, segment_id) -> str:
+        return f"{self.run_key}:{segment_id}"
+
+    def try_claim(self, segment_id) -> Optional[bool]:
+        """Claim a segment; False when another worker completed it, None when another worker holds it."""
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=self.config.SEGMENT_LEASE_TTL)
+        lease_id = self._lease_id(segment_id)
+        try:
+            self.db.update_one(
+                self.collection_name,
+                # A worker always gets its own leases back, so resuming its run retries its failures
+                {"_id": lease_id,
+                 "$or": [{"done_at": None, "expires_at": {"$lte": now}}, {"owner": self.worker_id}]},
+                {"$set": {"owner": self.worker_id, "expires_at": expires_at},
+                 "$setOnInsert": {"run_key": self.run_key, "segment_id": str(segment_id), "created_at": now}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists but did not match: it is done or held by another worker
+            lease = self.db.find_one(self.collection_name, {"_id": lease_id}, {"done_at": 1})
+            return False if lease and lease.get("done_at") else None
+
+    def claim(self, work: Iterable[Tuple[str, str]], budget=None, wait: bool = True) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the pairs of work this worker claimed.
+
+        Segments held by other workers are polled until they are done or their lease expires and
+        is taken over here, so the segments of a crashed worker are still processed in this run.
+        With wait=False, HELD is yielded instead of sleeping between polls, so a caller with fetches
+        in flight can write and complete them (another worker may be waiting on those leases) and
+        ask for the next pair once poll_interval has passed.
+        """
+        waiting = list(work)
+        while waiting:
+            held = []
+            for pair in waiting:
+                if budget and budget.exhausted():
+                    return
+                claimed = self.try_claim(pair[1])
+                if claimed:
+                    yield pair
+                elif claimed is None:
+                    held.append(pair)
+            waiting = held
+            if waiting:
+                Logger.debug(f"{len(waiting)} segments are leased by other workers, checking again")
+                if wait:
+                    time.sleep(self.poll_interval)
+                else:
+                    yield HELD
+
+    def complete(self, segment_ids: Iterable):
+        """Mark segments this worker wrote or failed as done so no other worker claims them in this run."""
+        lease_ids = [self._lease_id(segment_id) for segment_id in segment_ids]
+        if lease_ids:
+            self.db.update_many(self.collection_name, {"_id": {"$in": lease_ids}, "owner": self.worker_id},
+                                {"$set": {"done_at": datetime.now()}})
+
+    def release(self, segment_ids: Iterable):
+        """Expire this worker's leases on segments it gives up, so another worker can take them now."""
+        lease_ids = [self._lease_id(segment_id) for segment_id in segment_ids]
+        if lease_ids:
+            self.db.update_many(self.collection_name,
+                                {"_id": {"$in": lease_ids}, "owner": self.worker_id, "done_at": None},
+                                {"$set": {"expires_at": datetime.now()}})
+
+    def done_elsewhere(self, segment_ids: Iterable) -> List[str]:
+        """Ids of the segments other workers completed."""
+        lease_ids = [self._lease_id(segment_id) for segment_id in segment_ids]
+        if not lease_ids:
+            return []
+        leases = self.db.find_many(self.collection_name,
+                                   {"_id": {"$in": lease_ids}, "owner": {"$ne": self.worker_id},
+                                    "done_at": {"$ne": None}},
+                                   {"segment_id": 1})
+        return [lease["segment_id"] for lease in leases]
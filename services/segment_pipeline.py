@@ -0,0 +1,158 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+from db.database import DatabaseConnectionError
+from models.EnhancedSegment import EnhancedSegment
+from services.run_budget import RunBudget
+from services.run_journal import DEFERRED, FAILED, FETCHED, VALIDATED, WRITTEN, RunJournal
+from services.segment_leases import SegmentLeases
+from services.strava_api import StravaAPI, StravaRateLimitError
+from utils.logger import Logger
+
+# Tells the workers of a stage that the previous stage is finished
+_DONE = object()
+
+
+class SegmentPipeline:
+    """
+    Fetch, validate and write stages connected by bounded asyncio queues.
+
+    Each stage runs its own number of workers, so HTTP requests, Pydantic validation and DB writes
+    overlap instead of running one after another. Blocking calls (requests, pymongo) and validation
+    run in a thread pool sized for the workers of every stage, so none of them stalls the event
+    loop. A full queue blocks the stage feeding it, which keeps at most queue_size segments waiting
+    between two stages. Per-segment errors are journaled like in main.fetch_and_write_segments; a
+    DatabaseConnectionError cancels every stage and is raised.
+    """
+
+    def __init__(self, strava_api: StravaAPI, segments_writer, fetch_workers: int, validate_workers: int = 1,
+                 write_workers: int = 1, queue_size: int = 16, journal: Optional[RunJournal] = None,
+                 journal_writes: bool = True, budget: Optional[RunBudget] = None,
+                 leases: Optional[SegmentLeases] = None):
+        self.strava_api = strava_api
+        self.segments_writer = segments_writer
+        self.fetch_workers = fetch_workers
+        self.validate_workers = validate_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.journal = journal
+        self.journal_writes = journal_writes
+        self.budget = budget or RunBudget()
+        self.leases = leases
+        self.deferred: List[str] = []
+
+    def run(self, work: Iterable[Tuple[str, str]]) -> List[str]:
+        """Process (location, segment_id) pairs in order and return the ids of the deferred segments."""
+        return asyncio.run(self._run(work))
+
+    async def _run(self, work: Iterable[Tuple[str, str]]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.fetch_workers + self.validate_workers + self.write_workers + 1)
+        loop.set_default_executor(executor)
+        work = iter(work)
+        if self.leases:
+            work = self.leases.claim(work, self.budget)
+        fetch_queue = asyncio.Queue(self.queue_size)
+        validate_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+        try:
+            async with asyncio.TaskGroup() as tasks:
+                tasks.create_task(self._produce(work, fetch_queue))
+                tasks.create_task(self._stage(self._fetch, self.fetch_workers, fetch_queue,
+                                              validate_queue, self.validate_workers))
+                tasks.create_task(self._stage(self._validate, self.validate_workers, validate_queue,
+                                              write_queue, self.write_workers))
+                tasks.create_task(self._stage(self._write, self.write_workers, write_queue))
+        except BaseExceptionGroup as group:
+            # Surface the error that stopped the pipeline, as the threaded runner does
+            raise group.exceptions[0]
+        finally:
+            executor.shutdown(cancel_futures=True)
+        self.deferred.extend(segment_id for _, segment_id in work)
+        if self.deferred:
+            Logger.warning(f"Stopped early ({self.budget.reason}), deferring {len(self.deferred)} segments "
+                           f"to the next run")
+            if self.journal:
+                self.journal.mark(self.deferred, DEFERRED)
+            if self.leases:
+                self.leases.release(self.deferred)
+        return self.deferred
+
+    async def _produce(self, work, queue: asyncio.Queue):
+        while not self.budget.exhausted():
+            # Claiming a lease may poll the DB, so the next pair is taken off the event loop
+            pair = await asyncio.to_thread(next, work, None)
+            if pair is None:
+                break
+            await queue.put(pair)
+        for _ in range(self.fetch_workers):
+            await queue.put(_DONE)
+
+    @staticmethod
+    async def _stage(worker, count: int, queue: asyncio.Queue, next_queue: asyncio.Queue = None,
+                     next_count: int = 0):
+        """Run count workers over queue, then tell the next stage's workers there is nothing left."""
+        await asyncio.gather(*(worker(queue, next_queue) for _ in range(count)))
+        for _ in range(next_count):
+            await next_queue.put(_DONE)
+
+    async def _mark(self, segment_id, status: str, error: str = None):
+        if self.journal:
+            if status in (FETCHED, VALIDATED):
+                # Intermediate statuses go out with the next terminal mark, without a round trip of their own
+                self.journal.mark(segment_id, status, buffered=True)
+            else:
+                await asyncio.to_thread(self.journal.mark, segment_id, status, error)
+
+    async def _fail(self, segment_id, error: Exception):
+        Logger.error(f"Error processing segment {segment_id}: {error}")
+        await self._mark(segment_id, FAILED, str(error))
+        if self.leases:
+            await asyncio.to_thread(self.leases.complete, [segment_id])
+
+    async def _fetch(self, queue: asyncio.Queue, next_queue: asyncio.Queue):
+        while (item := await queue.get()) is not _DONE:
+            location, segment_id = item
+            if self.budget.exhausted():
+                self.deferred.append(segment_id)
+                continue
+            try:
+                segment_data, timestamp = await asyncio.to_thread(self.strava_api.get_segment_with_fetch_time,
+                                                                  segment_id)
+            except StravaRateLimitError as e:
+                self.budget.stop(str(e))
+                self.deferred.append(segment_id)
+                continue
+            except DatabaseConnectionError:
+                raise
+            except Exception as e:
+                await self._fail(segment_id, e)
+                continue
+            await self._mark(segment_id, FETCHED)
+            await next_queue.put((location, segment_id, segment_data, timestamp))
+
+    async def _validate(self, queue: asyncio.Queue, next_queue: asyncio.Queue):
+        while (item := await queue.get()) is not _DONE:
+            location, segment_id, segment_data, timestamp = item
+            try:
+                segment = await asyncio.to_thread(EnhancedSegment.from_payload, segment_data, location, timestamp)
+            except Exception as e:
+                await self._fail(segment_id, e)
+                continue
+            await self._mark(segment_id, VALIDATED)
+            await next_queue.put((segment_id, segment))
+
+    async def _write(self, queue: asyncio.Queue, _=None):
+        while (item := await queue.get()) is not _DONE:
+            segment_id, segment = item
+            try:
+                await asyncio.to_thread(self.segments_writer.write_segment_data, segment)
+            except DatabaseConnectionError:
+                raise
+            except Exception as e:
+                await self._fail(segment_id, e)
+                continue
+            if self.journal_writes:
+                await self._mark(segment_id, WRITTEN)
+                if self.leases:
+                    await asyncio.to_thread(self.leases.complete, [segment_id])
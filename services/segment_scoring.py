@@ -0,0 +1,164 @@
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from db.database import Database
+from services.segments_repository import fetch_day_expression
+from utils.config import Config
+from utils.logger import Logger
+
+DIFFICULTY_CLASSES = ("easy", "moderate", "hard", "extreme")
+
+
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator > 0)
+
+
+def effort_rates(segment_index: np.ndarray, days: np.ndarray, counts: np.ndarray, segment_total: int) -> np.ndarray:
+    """
+    New efforts per day of every segment between its first and last sample.
+
+    The samples are flattened arrays of segment index, day number and effort count in any order;
+    segments with fewer than two sample days get a rate of 0.
+    """
+    rates = np.zeros(segment_total)
+    if not len(segment_index):
+        return rates
+    order = np.lexsort((days, segment_index))
+    segment_index, days, counts = segment_index[order], days[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, segment_index[1:] != segment_index[:-1]])
+    ends = np.r_[starts[1:], len(segment_index)] - 1
+    gained = np.maximum(counts[ends] - counts[starts], 0).astype(float)
+    rates[segment_index[starts]] = _safe_divide(gained, (days[ends] - days[starts]).astype(float))
+    return rates
+
+
+def popularity_scores(area_codes: np.ndarray, rates: np.ndarray, athlete_counts: np.ndarray) -> np.ndarray:
+    """
+    Popularity from 0 to 100 of every segment relative to the busiest segment of its area.
+
+    Segments are compared by recent effort rate, or by athlete count in an area with no recent
+    efforts yet, so a newly added area still gets a ranking.
+    """
+    area_total = int(area_codes.max()) + 1 if len(area_codes) else 0
+    area_max_rate = np.zeros(area_total)
+    area_max_athletes = np.zeros(area_total)
+    np.maximum.at(area_max_rate, area_codes, rates)
+    np.maximum.at(area_max_athletes, area_codes, athlete_counts)
+    scores = np.where(area_max_rate[area_codes] > 0,
+                      _safe_divide(rates, area_max_rate[area_codes]),
+                      _safe_divide(athlete_counts.astype(float), area_max_athletes[area_codes]))
+    return np.rint(scores * 100).astype(int)
+
+
+def difficulty_classes(average_grades: np.ndarray, distances: np.ndarray, grade_thresholds,
+                       long_distance: float) -> np.ndarray:
+    """Difficulty class of every segment from the steepness of its average grade, a class harder when long."""
+    levels = np.digitize(np.abs(average_grades), grade_thresholds) + (distances >= long_distance)
+    return np.array(DIFFICULTY_CLASSES)[np.minimum(levels, len(DIFFICULTY_CLASSES) - 1)]
+
+
+class SegmentScorer:
+    """
+    Computes the popularity and difficulty of every stored segment.
+
+    Segment attributes and the recent effort samples are loaded into NumPy arrays and scored in
+    one vectorized pass, then only the segments whose scores changed are written back in bulk.
+    Segment writes never touch these fields after the insert, so the scores survive until the
+    next scoring run.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.config = config
+        self.db = db
+
+    def load_segments(self) -> Dict[str, np.ndarray]:
+        """Arrays of the scored attributes and the current scores of every segment."""
+        documents = list(self.db.find_many(self.config.SEGMENTS_COLL_NAME, {}, {
+            "_id": 0, "id": 1, "trail_area": 1, "average_grade": 1, "distance": 1, "athlete_count": 1,
+            "popularity": 1, "difficulty": 1,
+        }))
+        trail_areas = [document.get("trail_area") or "" for document in documents]
+        _, area_codes = np.unique(trail_areas, return_inverse=True)
+        return {
+            "id": np.array([document["id"] for document in documents], dtype=np.int64),
+            "area_code": area_codes.astype(np.int64),
+            "average_grade": np.array([document.get("average_grade") or 0 for document in documents], dtype=float),
+            "distance": np.array([document.get("distance") or 0 for document in documents], dtype=float),
+            "athlete_count": np.array([document.get("athlete_count") or 0 for document in documents], dtype=np.int64),
+            "popularity": np.array([document.get("popularity") or 0 for document in documents], dtype=np.int64),
+            "difficulty": np.array([document.get("difficulty") or "" for document in documents], dtype=object),
+        }
+
+    def recent_efforts(self, since: datetime):
+        """(segment_id, day number, effort count) arrays of the efforts fetched since a day."""
+        # Efforts outside the window are dropped inside each document, so only the window is unwound
+        recent = {"$filter": {
+            "input": {"$map": {"input": "$efforts", "in": {"effort_count": "$$this.effort_count",
+                                                           "fetch_day": fetch_day_expression("$$this")}}},
+            "cond": {"$gte": ["$$this.fetch_day", since]},
+        }}
+        pipeline = [
+            {"$project": {"_id": 0, "segment_id": 1, "efforts": recent}},
+            {"$unwind": "$efforts"},
+            {"$project": {"segment_id": 1, "effort_count": "$efforts.effort_count", "fetch_day": "$efforts.fetch_day"}},
+        ]
+        collection_name = self.config.EFFORT_COLL_NAME
+        if self.config.EFFORT_STORAGE == "bucket":
+            collection_name = self.config.EFFORT_BUCKETS_COLL_NAME
+            pipeline.insert(0, {"$match": {"month": {"$gte": since.strftime(self.config.BUCKET_MONTH_FORMAT)}}})
+        rows = list(self.db.aggregate(collection_name, pipeline))
+        segment_ids = np.array([row["segment_id"] for row in rows], dtype=np.int64)
+        days = np.array([row["fetch_day"] for row in rows], dtype="datetime64[D]").astype(np.int64)
+        counts = np.array([row["effort_count"] for row in rows], dtype=np.int64)
+        return segment_ids, days, counts
+
+    def score(self, segments: Dict[str, np.ndarray], effort_segment_ids: np.ndarray, days: np.ndarray,
+              counts: np.ndarray):
+        """Popularity and difficulty arrays aligned with segments."""
+        ids = segments["id"]
+        # Position of each sample's segment in the arrays; samples of segments no longer stored are dropped
+        order = np.argsort(ids)
+        positions = np.searchsorted(ids, effort_segment_ids, sorter=order)
+        known = positions < len(ids)
+        known[known] = ids[order[positions[known]]] == effort_segment_ids[known]
+        rates = effort_rates(order[positions[known]], days[known], counts[known], len(ids))
+        popularity = popularity_scores(segments["area_code"], rates, segments["athlete_count"])
+        difficulty = difficulty_classes(segments["average_grade"], segments["distance"],
+                                        self.config.DIFFICULTY_GRADE_THRESHOLDS, self.config.DIFFICULTY_LONG_DISTANCE)
+        return popularity, difficulty
+
+    def run(self, now: Optional[datetime] = None, batch_size: int = 500) -> int:
+        """Score every segment and write the changed scores; returns the number of segments updated."""
+        now = now or datetime.now()
+        segments = self.load_segments()
+        since = datetime(now.year, now.month, now.day) - timedelta(days=self.config.SCORING_WINDOW_DAYS)
+        popularity, difficulty = self.score(segments, *self.recent_efforts(since))
+        changed = np.flatnonzero((popularity != segments["popularity"]) | (difficulty != segments["difficulty"]))
+        operations = [
+            UpdateOne({"id": int(segments["id"][index])},
+                      {"$set": {"popularity": int(popularity[index]), "difficulty": str(difficulty[index])}})
+            for index in changed
+        ]
+        for start in range(0, len(operations), batch_size):
+            self.db.bulk_write(self.config.SEGMENTS_COLL_NAME, operations[start:start + batch_size], ordered=False)
+        Logger.info(f"Scored {len(segments['id'])} segments, updated {len(operations)}")
+        return len(operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score the popularity and difficulty of every segment.")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    load_dotenv()
+    config = Config()
+    db = Database(config)
+    SegmentScorer(db, config).run(batch_size=args.batch_size)
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
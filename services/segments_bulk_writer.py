@@ -0,0 +1,124 @@
+import threading
+import time
+from typing import Callable, List, Optional
+from db.database import DatabaseConnectionError
+from models.BulkWriteReport import BulkWriteReport
+from models.EnhancedSegment import EnhancedSegment
+from services.segments_repository import SegmentsRepository
+from utils.logger import Logger
+
+
+class SegmentsBulkWriter:
+    """
+    Collects segment writes and flushes them through SegmentsRepository.write_segments_bulk.
+
+    A flush happens when batch_size segments are pending or flush_interval seconds have passed
+    since the last one. A background thread checks the interval, so pending segments are written
+    even while no new segment arrives; call close() at the end of a run to stop it and write what
+    is left. on_flush, when given, is called with the flushed segments and the report of their
+    flush. When a flush fails as a whole, on_failed is called with its segments and the error
+    instead, except for a DatabaseConnectionError, which puts the segments back and is raised to
+    stop the run (by the next write or close() when the background thread hit it).
+    """
+
+    def __init__(self, segments_repository: SegmentsRepository, batch_size: int, flush_interval: float,
+                 on_flush: Optional[Callable[[List[EnhancedSegment], BulkWriteReport], None]] = None,
+                 on_failed: Optional[Callable[[List[EnhancedSegment], Exception], None]] = None):
+        self.segments_repository = segments_repository
+        self.on_flush = on_flush
+        self.on_failed = on_failed
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.report = BulkWriteReport()
+        self._pending: List[EnhancedSegment] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # Set to have the background thread check for a due flush before the interval ends
+        self._wake = threading.Event()
+        # A DatabaseConnectionError of a background flush, raised by the next write or close()
+        self._error: Optional[DatabaseConnectionError] = None
+        self._timer = threading.Thread(target=self._flush_periodically, name="bulk-flush", daemon=True)
+        self._timer.start()
+
+    def _flush_due(self) -> bool:
+        # Called with the lock held
+        return bool(self._pending) and (len(self._pending) >= self.batch_size
+                                        or time.monotonic() - self._last_flush >= self.flush_interval)
+
+    def _flush_periodically(self):
+        while not self._closed.is_set():
+            with self._lock:
+                timeout = self.flush_interval
+                if self._pending:
+                    timeout = max(self._last_flush + self.flush_interval - time.monotonic(), 0)
+            self._wake.wait(timeout)
+            self._wake.clear()
+            with self._lock:
+                due = self._flush_due()
+            if not due:
+                continue
+            try:
+                self.flush()
+            except DatabaseConnectionError as e:
+                self._error = e
+                return
+            except Exception as e:
+                Logger.error(f"Background bulk flush failed: {e}")
+
+    def write_segment_data(self, segment_data: EnhancedSegment):
+        """Queue a segment for the next bulk flush."""
+        if self._error:
+            raise self._error
+        with self._lock:
+            self._pending.append(segment_data)
+            should_flush = self._flush_due()
+        if should_flush:
+            self.flush()
+
+    def _write(self, segments: List[EnhancedSegment]) -> BulkWriteReport:
+        return self.segments_repository.write_segments_bulk(segments)
+
+    def _take_pending(self) -> List[EnhancedSegment]:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        return pending
+
+    def flush(self) -> BulkWriteReport:
+        """Write all pending segments and return the report for this flush."""
+        pending = self._take_pending()
+        if not pending:
+            return BulkWriteReport()
+        try:
+            report = self._write(pending)
+        except DatabaseConnectionError:
+            with self._lock:
+                self._pending = pending + self._pending
+            raise
+        except Exception as e:
+            Logger.error(f"Bulk write of {len(pending)} segments failed: {e}")
+            if self.on_failed:
+                self.on_failed(pending, e)
+            return BulkWriteReport()
+        self._record(pending, report)
+        return report
+
+    def _record(self, segments: List[EnhancedSegment], report: BulkWriteReport):
+        with self._lock:
+            # The background thread and the caller both flush
+            self.report.add(report)
+        if report.errors:
+            Logger.warning(f"{len(report.errors)} bulk write operations failed")
+        if self.on_flush:
+            self.on_flush(segments, report)
+
+    def close(self) -> BulkWriteReport:
+        """Stop the background flushes and write what is left; returns the report of every flush."""
+        self._closed.set()
+        self._wake.set()
+        self._timer.join()
+        if self._error:
+            raise self._error
+        self.flush()
+        return self.report
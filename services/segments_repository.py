@@ -1,6 +1,15 @@
+import hashlib
+import json
+from typing import Dict, List, Optional
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from db.database import Database
+from models.BulkWriteReport import BulkWriteReport
 from models.EnhancedSegment import EnhancedSegment
 from models.SegmentEffortData import Effort, SegmentEffortData
+from models.TrailArea import TrailBase
+from services.area_rollup_repository import AreaRollupRepository
+from services.geometry_repository import GeometryRepository, polyline_hash
 from datetime import datetime
 from utils.logger import Logger
 from utils.config import Config
@@ -10,15 +19,51 @@ def map_segment_effort_data(enhanced_segment: EnhancedSegment) -> SegmentEffortD
     segment_id = enhanced_segment.id
     segment_name = enhanced_segment.name
     effort_count = enhanced_segment.effort_count
-    fetch_date = datetime.now().strftime(Config.DATE_FORMAT)
-    effort = Effort(effort_count=effort_count, fetch_date=fetch_date)
+    # Date the effort by the fetch, so writing the same segment data again updates the same entry
+    now = datetime.fromtimestamp(enhanced_segment.timestamp)
+    fetch_date = now.strftime(Config.DATE_FORMAT)
+    fetch_day = datetime(now.year, now.month, now.day)
+    effort = Effort(effort_count=effort_count, fetch_date=fetch_date, fetch_day=fetch_day)
     return SegmentEffortData(segment_id=segment_id, name=segment_name, efforts=[effort])
 
 
+def fetch_day_expression(effort: str):
+    """Aggregation expression for the fetch day of an effort, parsing fetch_date for entries not yet migrated."""
+    return {"$ifNull": [f"{effort}.fetch_day",
+                        {"$dateFromString": {"dateString": f"{effort}.fetch_date", "format": Config.DATE_FORMAT}}]}
+
+
+def day_range(start: datetime, end: datetime):
+    """Midnight of the first and last day of an inclusive date range."""
+    return datetime(start.year, start.month, start.day), datetime(end.year, end.month, end.day)
+
+
+def geojson_point(lat: Optional[float], lng: Optional[float]) -> Optional[Dict]:
+    """GeoJSON point for a 2dsphere index; GeoJSON puts longitude first."""
+    if lat is None or lng is None:
+        return None
+    return {"type": "Point", "coordinates": [lng, lat]}
+
+
+def field_fingerprints(fields: Dict) -> Dict[str, str]:
+    """Short content hash of each field value, stored with the segment to detect changes."""
+    return {
+        name: hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+        for name, value in fields.items()
+    }
+
+
 class SegmentsRepository:
-    def __init__(self, db: Database, config: Config):
+    # Refreshed on every write that changes the segment, but never a reason to write on its own
+    UNTRACKED_FIELDS = {"timestamp"}
+
+    def __init__(self, db: Database, config: Config, effort_history=None):
         self.config = config
         self.db = db
+        # EffortHistoryRepository used instead of effort_stats when efforts are stored in monthly buckets
+        self.effort_history = effort_history
+        self.geometries = GeometryRepository(db, config)
+        self.area_rollups = AreaRollupRepository(db, config)
 
     def _update_one(self, collection_name, query, new_values, upsert=False):
         """Update a single document in the database."""
@@ -36,104 +81,330 @@ class SegmentsRepository:
             Logger.error(f"An error occurred while inserting into the database: {e}")
             raise
 
-    def update_existing_effort(self, segment_effort_data, fetch_date):
-        """Update the effort_count of an existing effort."""
-        self._update_one(
-            self.config.EFFORT_COLL_NAME,
-            {"segment_id": segment_effort_data.segment_id, "efforts.fetch_date": fetch_date},
-            {"$set": {"efforts.$.effort_count": segment_effort_data.efforts[0].effort_count}},
-        )
+    @staticmethod
+    def upsert_effort_pipeline(segment_effort_data: SegmentEffortData):
+        """
+        Update pipeline that inserts or replaces today's effort without reading the document.
 
-    def add_new_effort(self, segment_effort_data, fetch_date):
-        """Add a new entry for the efforts array."""
+        An existing entry for the fetch date keeps its position in the efforts array, otherwise the
+        effort is appended; with upsert the document is created on the first fetch of a segment.
+        """
+        effort = segment_effort_data.efforts[0]
+        existing_efforts = {"$ifNull": ["$efforts", []]}
+        return [
+            {
+                "$set": {
+                    "name": {"$ifNull": ["$name", {"$literal": segment_effort_data.name}]},
+                    "efforts": {
+                        "$cond": [
+                            {"$in": [{"$literal": effort.fetch_date}, {"$ifNull": ["$efforts.fetch_date", []]}]},
+                            {
+                                "$map": {
+                                    "input": existing_efforts,
+                                    "in": {
+                                        "$cond": [
+                                            {"$eq": ["$$this.fetch_date", {"$literal": effort.fetch_date}]},
+                                            {"$mergeObjects": ["$$this", {"effort_count": effort.effort_count,
+                                                                          "fetch_day": effort.fetch_day}]},
+                                            "$$this",
+                                        ]
+                                    },
+                                }
+                            },
+                            {"$concatArrays": [existing_efforts, [{"$literal": effort.model_dump()}]]},
+                        ]
+                    },
+                }
+            }
+        ]
+
+    def update_effort_data(self, segment: EnhancedSegment):
+        """Updates effort stats for a segment to the database."""
+        segment_effort_data = map_segment_effort_data(segment)
+        if self.effort_history:
+            self.effort_history.append_effort(segment_effort_data)
+            return
         self._update_one(
             self.config.EFFORT_COLL_NAME,
             {"segment_id": segment_effort_data.segment_id},
+            self.upsert_effort_pipeline(segment_effort_data),
+            upsert=True,
+        )
+        Logger.debug(f"Effort data for segment {segment_effort_data.segment_id} written into DB")
+
+    def find_efforts_between(self, segment_id: int, start: datetime, end: datetime) -> List[Effort]:
+        """Efforts of a segment fetched between start and end, inclusive, filtered and sorted server-side."""
+        if self.effort_history:
+            return self.effort_history.read_efforts(segment_id, start, end)
+        start_day, end_day = day_range(start, end)
+        fetch_day = fetch_day_expression("$$effort")
+        pipeline = [
+            {"$match": {"segment_id": segment_id}},
             {
-                "$push": {
+                "$project": {
+                    "_id": 0,
                     "efforts": {
-                        "effort_count": segment_effort_data.efforts[0].effort_count,
-                        "fetch_date": fetch_date,
-                    }
+                        "$filter": {
+                            "input": "$efforts",
+                            "as": "effort",
+                            "cond": {"$and": [{"$gte": [fetch_day, start_day]}, {"$lte": [fetch_day, end_day]}]},
+                        }
+                    },
                 }
             },
-            upsert=False,
-        )
+            {"$unwind": "$efforts"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$efforts",
+                                                            {"fetch_day": fetch_day_expression("$efforts")}]}}},
+            {"$sort": {"fetch_day": 1}},
+        ]
+        return [Effort(**effort) for effort in self.db.aggregate(self.config.EFFORT_COLL_NAME, pipeline)]
 
-    def create_new_effort_data(self, segment_effort_data):
-        """Create a new effort data for the segment."""
-        self._insert_one(
-            self.config.EFFORT_COLL_NAME,
-            {"segment_id": segment_effort_data.segment_id, "name": segment_effort_data.name,
-             "efforts": [{"effort_count": segment_effort_data.efforts[0].effort_count,
-                          "fetch_date": segment_effort_data.efforts[0].fetch_date}]},
+    def _segment_update_fields(self, segment: EnhancedSegment):
+        """Fields refreshed from Strava on every run for an existing segment."""
+        fields = {
+            "name": segment.name,
+            "average_grade": segment.average_grade,
+            "distance": segment.distance,
+            "start_lat": segment.start_lat,
+            "start_lng": segment.start_lng,
+            "end_lat": segment.end_lat,
+            "end_lng": segment.end_lng,
+            "local_legend": segment.local_legend.to_dict() if segment.local_legend else None,
+            "star_count": segment.star_count,
+            "effort_count": segment.effort_count,
+            "athlete_count": segment.athlete_count,
+            "kom": segment.kom,
+            "map": segment.map.to_dict(),
+            "polyline": segment.polyline,
+            "geometry_id": polyline_hash(segment.map.polyline),
+            "start_point": geojson_point(segment.start_lat, segment.start_lng),
+            "timestamp": segment.timestamp,
+        }
+        if self.config.GEOMETRY_STORAGE == "collection":
+            # The polyline lives only in the geometries collection, referenced by geometry_id
+            del fields["polyline"]
+            fields["map"] = {key: value for key, value in fields["map"].items() if key != "polyline"}
+        return fields
+
+    def _changed_fields_update(self, segment: EnhancedSegment, stored_fingerprints: Dict[str, str]) -> Optional[Dict]:
+        """$set of the fields that differ from the stored fingerprints, or None when nothing changed."""
+        update_fields = self._segment_update_fields(segment)
+        fingerprints = field_fingerprints(
+            {name: value for name, value in update_fields.items() if name not in self.UNTRACKED_FIELDS}
         )
+        changed = {name: fingerprint for name, fingerprint in fingerprints.items()
+                   if stored_fingerprints.get(name) != fingerprint}
+        if not changed:
+            return None
+        changes = {name: update_fields[name] for name in changed}
+        changes.update({name: update_fields[name] for name in self.UNTRACKED_FIELDS})
+        changes.update({f"field_hashes.{name}": fingerprint for name, fingerprint in changed.items()})
+        return {"$set": changes}
 
-    def update_effort_data(self, segment: EnhancedSegment):
-        """Updates effort stats for a segment to the database."""
-        segment_effort_data = map_segment_effort_data(segment)
-        fetch_date = segment_effort_data.efforts[0].fetch_date
-        # Check if an effort with the same fetch_date already exists
-        existing_effort_data = self.db.find_one(
-            self.config.EFFORT_COLL_NAME,
-            {"segment_id": segment_effort_data.segment_id}
+    def _new_segment_document(self, segment: EnhancedSegment) -> Dict:
+        document = segment.to_dict()
+        update_fields = self._segment_update_fields(segment)
+        if "polyline" not in update_fields:
+            del document["polyline"]
+        document.update(update_fields)
+        document["field_hashes"] = field_fingerprints(
+            {name: value for name, value in update_fields.items() if name not in self.UNTRACKED_FIELDS}
         )
+        return document
 
-        if existing_effort_data:
-            Logger.debug(f"Effort data for segment {segment_effort_data.segment_id} already exists in DB")
-            Logger.debug(f"Existing effort: {existing_effort_data}")
-            Logger.debug(f"SegmentEffortData: {segment_effort_data}")
-            # If it does, check if there is an effort with the same fetch_date
-            existing_effort_same_date = next(
-                (effort for effort in existing_effort_data['efforts'] if effort['fetch_date'] == fetch_date), None)
-            if existing_effort_same_date:
-                # If it's the same, update the effort_count of the existing effort
-                self.update_existing_effort(segment_effort_data, fetch_date)
-            else:
-                # If the fetch date is not the same, add a new entry for the efforts array
-                self.add_new_effort(segment_effort_data, fetch_date)
-        else:
-            # If it doesn't, create a new effort data for the segment
-            self.create_new_effort_data(segment_effort_data)
-        Logger.debug(f"Effort data for segment {segment_effort_data.segment_id} written into DB")
+    def _find_stored_segment(self, segment_id: int) -> Optional[Dict]:
+        return self.db.find_one("segments", {"id": segment_id}, {"_id": 1, "field_hashes": 1, "effort_count": 1})
 
     def update_segment_data(self, segment: EnhancedSegment):
-        """Updates data for a segment to the database."""
+        """Updates data for a segment to the database, writing only the fields that changed."""
+        self._write_segment(segment, self._find_stored_segment(segment.id))
+
+    def _write_segment(self, segment: EnhancedSegment, existing_document: Optional[Dict]):
         segment_id = segment.id
-        local_legend_dict = segment.local_legend.to_dict() if segment.local_legend else None
-        segment_map_dict = segment.map.to_dict()
-        existing_document = self.db.find_one("segments", {"id": segment_id})
         if existing_document:
+            update = self._changed_fields_update(segment, existing_document.get("field_hashes", {}))
+            if update is None:
+                Logger.debug(f"Data for segment {segment_id} unchanged, skipping write")
+                return
+            if "geometry_id" in update["$set"]:
+                self.geometries.save(segment.map.polyline)
             self._update_one(
                 "segments",
                 {"_id": existing_document.get("_id")},
-                {
-                    "$set":
-                    {
-                        "name": segment.name,
-                        "average_grade": segment.average_grade,
-                        "distance": segment.distance,
-                        "start_lat": segment.start_lat,
-                        "start_lng": segment.start_lng,
-                        "end_lat": segment.end_lat,
-                        "end_lng": segment.end_lng,
-                        "local_legend": local_legend_dict,
-                        "star_count": segment.star_count,
-                        "effort_count": segment.effort_count,
-                        "athlete_count": segment.athlete_count,
-                        "kom": segment.kom,
-                        "map": segment_map_dict,
-                        "polyline": segment.polyline,
-                        "timestamp": segment.timestamp,
-                    }
-                }
+                update
             )
             Logger.debug(f"Data for segment {segment_id} updated into DB")
-        else:
-            self._insert_one("segments", segment.to_dict())
-            Logger.debug(f"Data for segment {segment_id} written into DB")
+            return
+        self.geometries.save(segment.map.polyline)
+        self._insert_one("segments", self._new_segment_document(segment))
+        Logger.debug(f"Data for segment {segment_id} written into DB")
+
+    def find_segments(self, query, with_geometry: bool = False) -> List[Dict]:
+        """
+        Find segment documents, leaving the polyline out unless with_geometry is set.
+
+        With geometry stored separately, the polylines are loaded from the geometries collection in
+        a single query for all the documents found and put back in polyline and map.polyline, so the
+        documents have the same layout as inline ones.
+        """
+        projection = None if with_geometry else {"polyline": 0, "map.polyline": 0}
+        documents = list(self.db.find_many(self.config.SEGMENTS_COLL_NAME, query, projection))
+        if with_geometry:
+            missing = [document["geometry_id"] for document in documents
+                       if "polyline" not in document and document.get("geometry_id")]
+            polylines = self.geometries.get_polylines(missing) if missing else {}
+            for document in documents:
+                if "polyline" not in document and document.get("geometry_id") in polylines:
+                    document["polyline"] = polylines[document["geometry_id"]]
+                    if isinstance(document.get("map"), dict):
+                        document["map"].setdefault("polyline", document["polyline"])
+        return documents
+
+    def find_segments_near(self, trail_base: TrailBase, distance_km: float) -> List[Dict]:
+        """Segments starting within distance_km of a trail base, nearest first, from the 2dsphere index."""
+        lat, lng = trail_base.coordinates
+        return self.find_segments({
+            "start_point": {
+                "$nearSphere": {"$geometry": geojson_point(lat, lng), "$maxDistance": distance_km * 1000}
+            }
+        })
+
+    def find_segments_in_box(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[Dict]:
+        """Segments starting inside a latitude/longitude bounding box."""
+        box = [[min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat], [min_lng, max_lat], [min_lng, min_lat]]
+        return self.find_segments({
+            "start_point": {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [box]}}}
+        })
+
+    def load_geometry(self, segment_document: Dict) -> Optional[str]:
+        """Polyline of a segment document, loaded on demand when it is not stored inline."""
+        if segment_document.get("polyline"):
+            return segment_document["polyline"]
+        if segment_document.get("geometry_id"):
+            return self.geometries.get_polyline(segment_document["geometry_id"])
+        return None
 
     def write_segment_data(self, segment_data: EnhancedSegment):
-        """Write segment data and effort data to the database."""
+        """Write segment data and effort data to the database and roll the efforts up into the area totals."""
         self.update_effort_data(segment_data)
-        self.update_segment_data(segment_data)
+        existing_document = self._find_stored_segment(segment_data.id)
+        # The rollup goes before the segment update, so a retry after a failed write still reads the
+        # effort count from before the day as the segment's baseline
+        self.area_rollups.record(segment_data, existing_document.get("effort_count") if existing_document else None)
+        self._write_segment(segment_data, existing_document)
+
+    def build_effort_operations(self, segments: List[EnhancedSegment]):
+        """Build read-free effort upserts for a batch of segments."""
+        operations = []
+        for segment in segments:
+            segment_effort_data = map_segment_effort_data(segment)
+            if self.effort_history:
+                operations.append(self.effort_history.append_operation(segment_effort_data))
+                continue
+            operations.append(UpdateOne(
+                {"segment_id": segment_effort_data.segment_id},
+                self.upsert_effort_pipeline(segment_effort_data),
+                upsert=True,
+            ))
+        return operations
+
+    def _stored_documents(self, segments: List[EnhancedSegment]) -> Dict[int, Dict]:
+        """Field fingerprints and effort count of the stored segments of a batch, read with a single query."""
+        return {
+            document["id"]: document
+            for document in self.db.find_many(
+                self.config.SEGMENTS_COLL_NAME,
+                {"id": {"$in": [segment.id for segment in segments]}},
+                {"_id": 0, "id": 1, "field_hashes": 1, "effort_count": 1},
+            )
+        }
+
+    def _stored_fingerprints(self, segments: List[EnhancedSegment]) -> Dict[int, Dict[str, str]]:
+        """Field fingerprints of the stored segments of a batch, read with a single query."""
+        return {segment_id: document.get("field_hashes", {})
+                for segment_id, document in self._stored_documents(segments).items()}
+
+    def build_geometry_operations(self, segments: List[EnhancedSegment],
+                                  stored_fingerprints: Dict[int, Dict[str, str]]):
+        """Build geometry upserts for the segments that are new or whose polyline changed."""
+        operations = {}
+        for segment in segments:
+            geometry_fingerprint = field_fingerprints({"geometry_id": polyline_hash(segment.map.polyline)})
+            if stored_fingerprints.get(segment.id, {}).get("geometry_id") != geometry_fingerprint["geometry_id"]:
+                operations[polyline_hash(segment.map.polyline)] = GeometryRepository.save_operation(
+                    segment.map.polyline)
+        return list(operations.values())
+
+    def build_segment_operations(self, segments: List[EnhancedSegment],
+                                 stored_fingerprints: Optional[Dict[int, Dict[str, str]]] = None):
+        """Build the segment writes of a batch, reading the stored fingerprints once for the whole batch."""
+        if stored_fingerprints is None:
+            stored_fingerprints = self._stored_fingerprints(segments)
+        operations = []
+        for segment in segments:
+            if segment.id in stored_fingerprints:
+                update = self._changed_fields_update(segment, stored_fingerprints[segment.id])
+                if update is not None:
+                    operations.append(UpdateOne({"id": segment.id}, update))
+                continue
+            new_document = self._new_segment_document(segment)
+            update_fields = self._segment_update_fields(segment)
+            update_fields["field_hashes"] = new_document["field_hashes"]
+            insert_only_fields = {
+                key: value for key, value in new_document.items() if key not in update_fields and key != "id"
+            }
+            # Upsert so a segment inserted by a concurrent writer since the read is updated, not duplicated
+            operations.append(UpdateOne(
+                {"id": segment.id},
+                {"$set": update_fields, "$setOnInsert": insert_only_fields},
+                upsert=True,
+            ))
+        return operations
+
+    def bulk_write(self, collection_name, operations) -> BulkWriteReport:
+        """Run unordered bulk writes and report the per-operation errors."""
+        report = BulkWriteReport(operations=len(operations))
+        if not operations:
+            return report
+        try:
+            result = self.db.bulk_write(collection_name, operations, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            for error in result.get("writeErrors", []):
+                Logger.error(f"Bulk write on {collection_name} failed for operation {error.get('index')}: "
+                             f"{error.get('errmsg')}")
+                report.errors.append({"collection": collection_name, "index": error.get("index"),
+                                      "code": error.get("code"), "message": error.get("errmsg"),
+                                      "operation": error.get("op")})
+        report.inserted = result.get("nInserted", 0)
+        report.matched = result.get("nMatched", 0)
+        report.modified = result.get("nModified", 0)
+        report.upserted = result.get("nUpserted", 0)
+        return report
+
+    def write_segments_bulk(self, segments: List[EnhancedSegment]) -> BulkWriteReport:
+        """Write segment data and effort data for many segments with unordered bulk writes."""
+        report = BulkWriteReport()
+        # Keep the latest fetch of each segment so a batch never writes the same document twice
+        segments = list({segment.id: segment for segment in segments}.values())
+        if not segments:
+            return report
+        effort_collection_name = (
+            self.effort_history.collection_name if self.effort_history else self.config.EFFORT_COLL_NAME
+        )
+        report.add(self.bulk_write(effort_collection_name, self.build_effort_operations(segments)))
+        stored_documents = self._stored_documents(segments)
+        stored_fingerprints = {segment_id: document.get("field_hashes", {})
+                               for segment_id, document in stored_documents.items()}
+        # Rollups go before the segments, which overwrite the effort counts they take as baselines
+        previous_counts = {segment_id: document.get("effort_count")
+                           for segment_id, document in stored_documents.items()}
+        report.add(self.bulk_write(self.area_rollups.collection_name,
+                                   self.area_rollups.build_operations(segments, previous_counts)))
+        # Geometries go before the segments so a segment never references a geometry that is not stored
+        report.add(self.bulk_write(self.geometries.collection_name,
+                                   self.build_geometry_operations(segments, stored_fingerprints)))
+        report.add(self.bulk_write(self.config.SEGMENTS_COLL_NAME,
+                                   self.build_segment_operations(segments, stored_fingerprints)))
+        Logger.debug(f"Bulk wrote {len(segments)} segments into DB")
+        return report
@@ -1,46 +1,207 @@
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from utils.logger import Logger
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
+from services.token_manager import TokenManager
 from utils.config import Config
 
 
+class StravaRateLimitError(Exception):
+    def __init__(self, message="Strava rate limit exhausted"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RateLimitWindow:
+    """Request quota for one Strava rate limit window, refilled when the window resets."""
+
+    def __init__(self, name: str, period: int):
+        self.name = name
+        self.period = period
+        self.limit: Optional[int] = None
+        self.usage = 0
+        self.reset_at = 0.0
+        self.exhausted = False
+
+    def roll(self, now: float):
+        """Start a new window once the current one has reset."""
+        if now >= self.reset_at:
+            self.usage = 0
+            self.exhausted = False
+            self.reset_at = (now // self.period + 1) * self.period
+
+    def remaining(self, safety_margin: int) -> Optional[int]:
+        if self.exhausted:
+            return 0
+        if self.limit is None:
+            return None
+        return self.limit - safety_margin - self.usage
+
+
+class RateLimitGovernor:
+    """
+    Token bucket over Strava's 15-minute and daily windows.
+
+    Each request takes a token from every window. Buckets are sized from the X-RateLimit-* and
+    X-ReadRateLimit-* response headers and refill at the window boundaries Strava uses (quarter hours
+    and midnight UTC), so the job can spend the whole quota and then waits for the next window.
+    """
+    HEADER_PREFIXES = ("X-RateLimit", "X-ReadRateLimit")
+    SHORT_PERIOD = 15 * 60
+    DAILY_PERIOD = 24 * 60 * 60
+
+    def __init__(self, safety_margin: int = 0, max_wait: float = 960, deadline: Optional[float] = None):
+        self.safety_margin = safety_margin
+        self.max_wait = max_wait
+        # Epoch time after which waiting for a window is pointless because the run has to stop
+        self.deadline = deadline
+        self.acquired = 0
+        self._lock = threading.Lock()
+        self._windows = {
+            (prefix, period): RateLimitWindow(f"{prefix} {name}", period)
+            for prefix in self.HEADER_PREFIXES
+            for name, period in (("15-minute", self.SHORT_PERIOD), ("daily", self.DAILY_PERIOD))
+        }
+
+    def acquire(self):
+        """Block until every window has a token left and take it."""
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = 0.0
+                exhausted = []
+                for window in self._windows.values():
+                    window.roll(now)
+                    remaining = window.remaining(self.safety_margin)
+                    if remaining is not None and remaining <= 0:
+                        wait = max(wait, window.reset_at - now)
+                        exhausted.append(window.name)
+                if not exhausted:
+                    for window in self._windows.values():
+                        window.usage += 1
+                    self.acquired += 1
+                    return
+            if wait > self.max_wait or (self.deadline is not None and now + wait > self.deadline):
+                raise StravaRateLimitError(f"Strava rate limit exhausted ({', '.join(exhausted)}), "
+                                           f"next window opens in {int(wait)}s")
+            Logger.warning(f"Strava rate limit reached ({', '.join(exhausted)}), waiting {int(wait)}s")
+            time.sleep(wait)
+
+    def update(self, headers):
+        """Resize the buckets from the rate limit headers of a response."""
+        with self._lock:
+            now = time.time()
+            for prefix in self.HEADER_PREFIXES:
+                limits = self._parse_header(headers.get(f"{prefix}-Limit"))
+                usages = self._parse_header(headers.get(f"{prefix}-Usage"))
+                if not limits or not usages:
+                    continue
+                for period, limit, usage in zip((self.SHORT_PERIOD, self.DAILY_PERIOD), limits, usages):
+                    window = self._windows[(prefix, period)]
+                    window.roll(now)
+                    window.limit = limit
+                    # Local usage also counts requests still in flight on other workers
+                    window.usage = max(window.usage, usage)
+
+    def exhaust(self):
+        """Empty the 15-minute buckets after a 429 so callers wait for the next window."""
+        with self._lock:
+            now = time.time()
+            for (_, period), window in self._windows.items():
+                if period == self.SHORT_PERIOD:
+                    window.roll(now)
+                    window.exhausted = True
+
+    @staticmethod
+    def _parse_header(value: Optional[str]):
+        if not value:
+            return None
+        try:
+            return [int(part) for part in value.split(",")]
+        except ValueError:
+            return None
+
+
 class StravaAPI:
-    def __init__(self, config: Config):
+    MAX_RATE_LIMITED_ATTEMPTS = 3
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, config: Config, token_store=None, response_cache=None):
         self.config = config
-        self.headers = {"Authorization": f"Bearer {self.config.STRAVA_REFRESH_TOKEN}"}
+        # Optional SegmentResponseCache replaying recent segment payloads without a request
+        self.response_cache = response_cache
+        self.session = self._create_session()
+        self.token_manager = TokenManager(self.config, self.session, token_store)
+        self.rate_limit_governor = RateLimitGovernor(
+            safety_margin=self.config.STRAVA_RATE_LIMIT_SAFETY_MARGIN,
+            max_wait=self.config.STRAVA_RATE_LIMIT_MAX_WAIT,
+        )
+
+    def _create_session(self) -> requests.Session:
+        """Create a keep-alive session with a connection pool sized for the fetch workers."""
+        retry = Retry(
+            total=self.config.STRAVA_MAX_RETRIES,
+            backoff_factor=self.config.STRAVA_BACKOFF_FACTOR,
+            backoff_jitter=self.config.STRAVA_BACKOFF_JITTER,
+            status_forcelist=self.RETRY_STATUS_CODES,
+            # The OAuth token refresh is a POST and not idempotent, so only reads are retried
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.config.STRAVA_POOL_SIZE,
+            pool_maxsize=self.config.STRAVA_POOL_SIZE,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        return session
+
+    def close(self):
+        self.session.close()
+        if self.response_cache:
+            self.response_cache.close()
 
     def get_segment(self, segment_id: str) -> Dict[str, Any]:
+        return self.get_segment_with_fetch_time(segment_id)[0]
+
+    def get_segment_with_fetch_time(self, segment_id: str) -> Tuple[Dict[str, Any], float]:
+        """A segment payload and the Unix time it was fetched from Strava, in the past when served from the cache."""
+        if self.response_cache:
+            cached = self.response_cache.get(segment_id)
+            if cached is not None:
+                return cached
         segment = self._handle_request(f"{self.config.STRAVA_API_URL}/segments/{segment_id}")
-        return segment
+        fetched_at = time.time()
+        if self.response_cache:
+            self.response_cache.put(segment_id, segment, fetched_at)
+        return segment, fetched_at
 
     def _handle_request(self, url: str) -> Dict[str, Any]:
         Logger.debug(f"Fetching Strava for segment: {url.split('/')[-1]}")
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 401:
-            self._refresh_token()
-            response = requests.get(url, headers=self.headers)
+        for _ in range(self.MAX_RATE_LIMITED_ATTEMPTS):
+            access_token = self.token_manager.get_access_token()
+            response = self._get(url, access_token)
+            if response.status_code == 401:
+                self.token_manager.invalidate(access_token)
+                response = self._get(url, self.token_manager.get_access_token())
+            if response.status_code != 429:
+                break
+            Logger.warning("Strava API returned 429 Too Many Requests.")
+            self.rate_limit_governor.exhaust()
         if response.status_code != 200:
             Logger.error("Error fetching data from strava API.")
             Logger.error(response.json())
             raise Exception("Error fetching data from strava API.")
         return response.json()
 
-    def _refresh_token(self):
-        Logger.info("Refreshing strava access token.")
-        auth_request = requests.post(
-            f"https://www.strava.com/api/v3/oauth/token",
-            data={
-                "client_id": self.config.STRAVA_CLIENT_ID,
-                "client_secret": self.config.STRAVA_CLIENT_SECRET,
-                "grant_type": "refresh_token",
-                "refresh_token": self.config.STRAVA_REFRESH_TOKEN,
-            },
-        )
-        if auth_request.status_code != 200:
-            Logger.error("Error refreshing strava access token.")
-            Logger.error(auth_request.json())
-            raise Exception("Error refreshing strava access token.")
-        self.config.STRAVA_REFRESH_TOKEN = auth_request.json().get("refresh_token")
-        self.config.STRAVA_ACCESS_TOKEN = auth_request.json().get("access_token")
-        self.headers = {"Authorization": f"Bearer {self.config.STRAVA_ACCESS_TOKEN}"}
-
+    def _get(self, url: str, access_token: str) -> requests.Response:
+        self.rate_limit_governor.acquire()
+        response = self.session.get(url, headers={"Authorization": f"Bearer {access_token}"},
+                                    timeout=self.config.STRAVA_REQUEST_TIMEOUT)
+        self.rate_limit_governor.update(response.headers)
+        return response
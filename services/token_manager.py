@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+import requests
+from db.database import Database
+from models.StravaToken import StravaToken
+from utils.config import Config
+from utils.logger import Logger
+
+
+class MongoTokenStore:
+    """Persist the Strava OAuth token in MongoDB so rotated tokens survive between runs."""
+    TOKEN_ID = "strava"
+
+    def __init__(self, db: Database, config: Config):
+        self.db = db
+        self.config = config
+
+    def load(self) -> Optional[StravaToken]:
+        document = self.db.find_one(self.config.TOKENS_COLL_NAME, {"_id": self.TOKEN_ID})
+        return StravaToken(**document) if document else None
+
+    def save(self, token: StravaToken):
+        self.db.update_one(self.config.TOKENS_COLL_NAME, {"_id": self.TOKEN_ID}, {"$set": token.model_dump()},
+                           upsert=True)
+
+
+class FileTokenStore:
+    """Persist the Strava OAuth token in a local JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[StravaToken]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as token_file:
+            return StravaToken(**json.load(token_file))
+
+    def save(self, token: StravaToken):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as token_file:
+            json.dump(token.model_dump(), token_file)
+        os.replace(tmp_path, self.path)
+
+
+class TokenManager:
+    """
+    Hands out a valid Strava access token, refreshing it before it expires.
+
+    The token is shared by all fetch workers; refreshes are serialized so only one of them
+    talks to the OAuth endpoint and every rotation is written to the token store.
+    """
+
+    def __init__(self, config: Config, session: requests.Session, store=None):
+        self.config = config
+        self.session = session
+        self.store = store
+        self._lock = threading.Lock()
+        self._token: Optional[StravaToken] = None
+
+    def get_access_token(self) -> str:
+        with self._lock:
+            if self._token is None:
+                self._token = self._load_token()
+            if self._token.expires_at - self.config.STRAVA_TOKEN_REFRESH_MARGIN <= time.time():
+                self._refresh_token()
+            return self._token.access_token
+
+    def invalidate(self, access_token: str):
+        """Refresh the token after a 401, unless another worker already did."""
+        with self._lock:
+            if self._token is None or self._token.access_token == access_token:
+                self._token = self._token or self._load_token()
+                self._refresh_token()
+
+    def _load_token(self) -> StravaToken:
+        stored_token = self.store.load() if self.store else None
+        if stored_token:
+            Logger.debug("Loaded strava token from token store.")
+            return stored_token
+        # Without a stored expiry the token is treated as expired and refreshed before the first request
+        return StravaToken(access_token=self.config.STRAVA_ACCESS_TOKEN,
+                           refresh_token=self.config.STRAVA_REFRESH_TOKEN)
+
+    def _refresh_token(self):
+        Logger.info("Refreshing strava access token.")
+        auth_request = self.session.post(
+            f"https://www.strava.com/api/v3/oauth/token",
+            data={
+                "client_id": self.config.STRAVA_CLIENT_ID,
+                "client_secret": self.config.STRAVA_CLIENT_SECRET,
+                "grant_type": "refresh_token",
+                "refresh_token": self._token.refresh_token,
+            },
+            timeout=self.config.STRAVA_REQUEST_TIMEOUT,
+        )
+        if auth_request.status_code != 200:
+            Logger.error("Error refreshing strava access token.")
+            Logger.error(auth_request.json())
+            raise Exception("Error refreshing strava access token.")
+        auth_data = auth_request.json()
+        self._token = StravaToken(
+            access_token=auth_data.get("access_token"),
+            refresh_token=auth_data.get("refresh_token"),
+            expires_at=auth_data.get("expires_at", 0),
+        )
+        self.config.STRAVA_REFRESH_TOKEN = self._token.refresh_token
+        self.config.STRAVA_ACCESS_TOKEN = self._token.access_token
+        if self.store:
+            self.store.save(self._token)
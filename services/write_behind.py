@@ -0,0 +1,208 @@
+import os
+import threading
+from typing import Callable, List, Optional
+from pymongo.errors import ConnectionFailure
+from db.database import DatabaseConnectionError
+from models.BulkWriteReport import BulkWriteReport
+from models.EnhancedSegment import EnhancedSegment
+from services.segments_bulk_writer import SegmentsBulkWriter
+from services.segments_repository import SegmentsRepository
+from utils.logger import Logger
+
+
+def is_connection_error(error: Exception) -> bool:
+    """Whether a store failed because the DB is unreachable, rather than because of the segments written."""
+    # ServerSelectionTimeoutError and NetworkTimeout are ConnectionFailure subclasses
+    return isinstance(error, (ConnectionFailure, DatabaseConnectionError))
+
+
+def store_each(store_batch: Callable[[List[EnhancedSegment]], BulkWriteReport], segments: List[EnhancedSegment],
+               on_failed: Optional[Callable[[List[EnhancedSegment], Exception], None]] = None) -> BulkWriteReport:
+    """
+    Store segments one at a time after their batch failed, so one bad segment does not fail the others.
+
+    Segments failing on their own are passed to on_failed and dropped; a connection error is raised.
+    """
+    report = BulkWriteReport()
+    for segment in segments:
+        try:
+            report.add(store_batch([segment]) or BulkWriteReport(operations=1))
+        except Exception as e:
+            if is_connection_error(e):
+                raise
+            Logger.error(f"Could not write segment {segment.id}, dropping it: {e}")
+            if on_failed:
+                on_failed([segment], e)
+    return report
+
+
+class SegmentSpool:
+    """
+    Append-only local file of segment writes that could not reach the DB, one JSON line per segment.
+
+    Lines are flushed and fsynced as they are appended, so a crash loses at most the line being
+    written, and a truncated last line is skipped on read. Replaying the spool writes the segments
+    again with the same fetch timestamp, which the repository writes idempotently.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = f"{path}.replay"
+        self._lock = threading.Lock()
+
+    def append(self, segments: List[EnhancedSegment]):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as spool_file:
+                for segment in segments:
+                    spool_file.write(segment.model_dump_json() + "\n")
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+
+    @staticmethod
+    def _read(path: str) -> List[EnhancedSegment]:
+        if not os.path.exists(path):
+            return []
+        segments = []
+        with open(path, encoding="utf-8") as spool_file:
+            for line in spool_file:
+                try:
+                    segments.append(EnhancedSegment.model_validate_json(line))
+                except ValueError:
+                    Logger.warning(f"Skipping unreadable line in {path}")
+        return segments
+
+    def replay(self, store_batch: Callable[[List[EnhancedSegment]], BulkWriteReport], batch_size: int) -> int:
+        """
+        Write the spooled segments in batches and return how many were written.
+
+        Batches that fail because the DB is unreachable stay spooled; segments the DB rejects are dropped.
+        """
+        with self._lock:
+            # Segments spooled while replaying go to the emptied spool; a replay file left by a crash is read again.
+            # The spool file is kept even when empty, so a cached copy of a replayed spool gets overwritten
+            with open(self.replay_path, "a", encoding="utf-8") as replay_file, \
+                    open(self.path, "a+", encoding="utf-8") as spool_file:
+                spool_file.seek(0)
+                replay_file.write(spool_file.read())
+                spool_file.truncate(0)
+        segments = self._read(self.replay_path)
+        if not segments:
+            os.remove(self.replay_path)
+            return 0
+        written = 0
+        for start in range(0, len(segments), batch_size):
+            batch = segments[start:start + batch_size]
+            dropped = []
+            try:
+                try:
+                    store_batch(batch)
+                except Exception as e:
+                    if is_connection_error(e):
+                        raise
+                    # A segment the DB rejects would be replayed forever, it is dropped instead
+                    store_each(store_batch, batch, lambda failed, error: dropped.extend(failed))
+                written += len(batch) - len(dropped)
+            except Exception as e:
+                Logger.error(f"Could not replay {len(batch)} spooled segments: {e}")
+                self.append(batch)
+        os.remove(self.replay_path)
+        Logger.info(f"Replayed {written} of {len(segments)} spooled segments")
+        return written
+
+
+class WriteBehindWriter(SegmentsBulkWriter):
+    """
+    SegmentsBulkWriter whose flushes all run on its background thread, so fetching never waits on the DB.
+
+    write_segment_data only adds the segment to the pending batch, which the background thread
+    stores through store_batch (SegmentsRepository.write_segments_bulk by default) once batch_size
+    segments are pending or flush_interval seconds have passed. Segments are spilled to the spool
+    instead when max_pending are already waiting, and once a store fails with a connection error
+    the DB is considered down: the failed batch and every later write go to the spool, to be
+    replayed by the next run. Any other error is specific to the segments written, so the batch is
+    stored one segment at a time and the segments that still fail go to on_failed. Call close() at
+    the end of a run to write what is left.
+    """
+
+    def __init__(self, segments_repository: SegmentsRepository, spool: SegmentSpool, batch_size: int = 100,
+                 flush_interval: float = 30, max_pending: int = 1000,
+                 store_batch: Optional[Callable[[List[EnhancedSegment]], BulkWriteReport]] = None,
+                 on_flush: Optional[Callable[[List[EnhancedSegment], BulkWriteReport], None]] = None,
+                 on_spooled: Optional[Callable[[List[EnhancedSegment]], None]] = None,
+                 on_failed: Optional[Callable[[List[EnhancedSegment], Exception], None]] = None):
+        self.store_batch = store_batch or segments_repository.write_segments_bulk
+        self.spool = spool
+        self.max_pending = max_pending
+        self.on_spooled = on_spooled
+        self.spooled = 0
+        self._db_down = False
+        super().__init__(segments_repository, batch_size, flush_interval, on_flush, on_failed)
+
+    @property
+    def db_down(self) -> bool:
+        """Whether a store failed with a connection error, so every later write goes to the spool."""
+        return self._db_down
+
+    def write_segment_data(self, segment_data: EnhancedSegment):
+        """Add a segment to the pending batch, or spool it when the DB is down or lagging."""
+        if not self._db_down:
+            with self._lock:
+                queued = len(self._pending) < self.max_pending
+                if queued:
+                    self._pending.append(segment_data)
+                    if self._flush_due():
+                        self._wake.set()
+            if queued:
+                return
+            Logger.warning("Write-behind queue is full, spooling the segment")
+        self._spill([segment_data])
+
+    def _spill(self, segments: List[EnhancedSegment]):
+        self.spool.append(segments)
+        with self._lock:
+            self.spooled += len(segments)
+        self._notify(self.on_spooled, segments)
+
+    @staticmethod
+    def _notify(callback, *args):
+        # A failing callback must not stop the background thread and strand the pending segments
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                Logger.error(f"Write-behind callback failed: {e}")
+
+    def _write(self, segments: List[EnhancedSegment]) -> BulkWriteReport:
+        return self.store_batch(segments) or BulkWriteReport(operations=len(segments))
+
+    def flush(self) -> BulkWriteReport:
+        """Store all pending segments, or spool them when the DB is down, and return the report for this flush."""
+        segments = self._take_pending()
+        if not segments:
+            return BulkWriteReport()
+        if self._db_down:
+            self._spill(segments)
+            return BulkWriteReport()
+        try:
+            try:
+                report = self._write(segments)
+            except Exception as e:
+                if is_connection_error(e):
+                    raise
+                Logger.error(f"Could not write {len(segments)} segments, writing them one at a time: {e}")
+                report = store_each(self._write, segments,
+                                    lambda failed, error: self._notify(self.on_failed, failed, error))
+        except Exception as e:
+            Logger.error(f"Could not write {len(segments)} segments, spooling them and the next writes: {e}")
+            self._db_down = True
+            self._spill(segments)
+            return BulkWriteReport()
+        self._record(segments, report)
+        return report
+
+    def close(self) -> BulkWriteReport:
+        """Stop the background thread once every pending segment is written or spooled."""
+        report = super().close()
+        if self.spooled:
+            Logger.warning(f"{self.spooled} segments were spooled to {self.spool.path}, the next run replays them")
+        return report
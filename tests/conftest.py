@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pytest
+from models.EnhancedSegment import EnhancedSegment
+from models.RawSegment import Map
+
+FETCHED_AT = datetime(2024, 6, 1, 7).timestamp()
+
+
+@pytest.fixture
+def make_segment():
+    """Factory of test segments with placeholder attributes; effort_count defaults to ten times the id."""
+
+    def make(segment_id, trail_area="Test Trail Area", effort_count=None, timestamp=FETCHED_AT):
+        return EnhancedSegment(
+            id=segment_id,
+            name=f"Test Segment {segment_id}",
+            alt_name="Test Alt Name",
+            trail_area=trail_area,
+            average_grade=0.0,
+            distance=0.0,
+            start_lat=0.0,
+            start_lng=0.0,
+            end_lat=0.0,
+            end_lng=0.0,
+            local_legend=None,
+            star_count=0,
+            effort_count=segment_id * 10 if effort_count is None else effort_count,
+            athlete_count=0,
+            kom="Test KOM",
+            map=Map(id=str(segment_id), polyline="Test Polyline", resource_state=1),
+            polyline="Test Polyline",
+            timestamp=timestamp,
+        )
+
+    return make
@@ -0,0 +1,110 @@
+from datetime import datetime
+
+import pytest
+from unittest.mock import MagicMock, patch
+from db.database import Database
+from models.SegmentEffortData import Effort
+from services.area_rollup_repository import AreaRollupRepository
+from services.geometry_repository import GeometryRepository
+from services.segments_repository import SegmentsRepository
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FETCHED_AT = datetime(2024, 5, 3, 18, 30).timestamp()
+
+
+@pytest.fixture
+def rollups():
+    config = ConfigForTest()
+    return AreaRollupRepository(Database(config), config)
+
+
+def test_build_operations_groups_segments_by_area_and_day(rollups, make_segment):
+    segments = [make_segment(1, "alghero", 12, FETCHED_AT), make_segment(2, "alghero", 30, FETCHED_AT),
+                make_segment(3, "sassari", 5, FETCHED_AT)]
+    with patch.object(AreaRollupRepository, 'carried_counts', return_value={"4": 8}):
+        operations = rollups.build_operations(segments, {1: 10, 2: None})
+
+    assert [operation._filter for operation in operations] == [
+        {"trail_area": "alghero", "day": datetime(2024, 5, 3)},
+        {"trail_area": "sassari", "day": datetime(2024, 5, 3)},
+    ]
+    merge = operations[0]._doc[0]["$set"]
+    assert merge["counts"]["$mergeObjects"] == [{"$ifNull": ["$counts", {"$literal": {"4": 8}}]},
+                                                {"$literal": {"1": 12, "2": 30}}]
+    # A new segment has no new efforts on its first day, its whole count is the baseline
+    assert merge["baselines"]["$mergeObjects"][0] == {"$literal": {"1": 10, "2": 30}}
+    assert all(operation._upsert for operation in operations)
+
+
+def test_rollup_documents_use_previous_day_as_baseline(rollups):
+    histories = [
+        (1, [Effort(effort_count=10, fetch_date="01-05-2024"),
+             Effort(effort_count=14, fetch_date="02-05-2024"),
+             Effort(effort_count=16, fetch_date="02-05-2024")]),
+        (2, [Effort(effort_count=7, fetch_date="02-05-2024")]),
+        (3, [Effort(effort_count=99, fetch_date="02-05-2024")]),
+    ]
+    documents = rollups.rollup_documents({1: "alghero", 2: "alghero"}, histories)
+
+    first_day = documents[("alghero", datetime(2024, 5, 1))]
+    second_day = documents[("alghero", datetime(2024, 5, 2))]
+    assert (first_day["total_efforts"], first_day["new_efforts"]) == (10, 0)
+    assert second_day["counts"] == {"1": 16, "2": 7}
+    assert (second_day["total_efforts"], second_day["new_efforts"], second_day["segment_count"]) == (23, 6, 2)
+    assert len(documents) == 2
+
+
+def test_rollup_documents_carry_unfetched_segments_forward(rollups):
+    histories = [
+        (1, [Effort(effort_count=10, fetch_date="01-05-2024"), Effort(effort_count=12, fetch_date="03-05-2024")]),
+        (2, [Effort(effort_count=7, fetch_date="01-05-2024"), Effort(effort_count=9, fetch_date="02-05-2024")]),
+    ]
+    documents = rollups.rollup_documents({1: "alghero", 2: "alghero"}, histories)
+
+    second_day = documents[("alghero", datetime(2024, 5, 2))]
+    third_day = documents[("alghero", datetime(2024, 5, 3))]
+    assert second_day["counts"] == {"1": 10, "2": 9}
+    assert (second_day["total_efforts"], second_day["new_efforts"]) == (19, 2)
+    assert third_day["counts"] == {"1": 12, "2": 9}
+    assert (third_day["total_efforts"], third_day["new_efforts"]) == (21, 2)
+
+
+def test_carried_counts_are_read_once_per_area_and_day(rollups):
+    previous = MagicMock()
+    previous.sort.return_value.limit.return_value = [{"counts": {"1": 10}}]
+    with patch.object(Database, 'find_many', return_value=previous) as mock_find_many:
+        assert rollups.carried_counts("alghero", datetime(2024, 5, 3)) == {"1": 10}
+        assert rollups.carried_counts("alghero", datetime(2024, 5, 3)) == {"1": 10}
+    mock_find_many.assert_called_once()
+    assert mock_find_many.call_args.args[1] == {"trail_area": "alghero", "day": {"$lt": datetime(2024, 5, 3)}}
+
+
+def test_write_segment_data_rolls_up_with_previous_count(make_segment):
+    config = ConfigForTest()
+    segment = make_segment(1, "alghero", 12, FETCHED_AT)
+    with patch.object(GeometryRepository, 'save'), \
+            patch.object(Database, 'find_one', return_value={"_id": "test_id", "effort_count": 10}), \
+            patch.object(Database, 'update_one') as mock_update_one, \
+            patch.object(AreaRollupRepository, 'record') as mock_record:
+        mock_record.side_effect = lambda *args: mock_update_one.assert_called_once()
+        SegmentsRepository(Database(config), config).write_segment_data(segment)
+    mock_record.assert_called_once_with(segment, 10)
+    # Effort upsert, then the segment update after the rollup
+    assert mock_update_one.call_count == 2
+
+
+def test_write_segments_bulk_rolls_up_the_batch(make_segment):
+    config = ConfigForTest()
+    repository = SegmentsRepository(Database(config), config)
+    segments = [make_segment(1, "alghero", 12, FETCHED_AT), make_segment(2, "alghero", 10, FETCHED_AT)]
+    with patch.object(Database, 'find_many', return_value=[{"id": 1, "field_hashes": {}, "effort_count": 10}]), \
+            patch.object(SegmentsRepository, 'bulk_write') as mock_bulk_write, \
+            patch.object(AreaRollupRepository, 'build_operations', return_value=["rollup"]) as mock_build:
+        repository.write_segments_bulk(segments)
+    mock_build.assert_called_once_with(segments, {1: 10})
+    written = [call.args[0] for call in mock_bulk_write.call_args_list]
+    assert written.index(config.AREA_ROLLUPS_COLL_NAME) < written.index(config.SEGMENTS_COLL_NAME)
+    mock_bulk_write.assert_any_call(config.AREA_ROLLUPS_COLL_NAME, ["rollup"])
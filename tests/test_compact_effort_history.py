@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from unittest.mock import MagicMock, patch
+from db.database import Database
+from models.CompactEffortHistory import CompactEffortHistory
+from models.SegmentEffortData import Effort
+from services.compact_effort_repository import CompactEffortRepository, StaleCompactHistoryError
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def test_compact_history_round_trip():
+    efforts = [
+        Effort(effort_count=10, fetch_date="01-01-2024"),
+        Effort(effort_count=15, fetch_date="05-03-2024", fetch_day=datetime(2024, 3, 5)),
+        Effort(effort_count=14, fetch_date="05-03-2024"),
+        Effort(effort_count=40, fetch_date="31-12-2024"),
+    ]
+    history = CompactEffortHistory.from_efforts(1, 2024, efforts)
+    fetch_days, effort_counts = history.to_arrays()
+
+    assert history.size == 3
+    assert len(history.days) == 6
+    assert fetch_days.tolist() == np.array(["2024-01-01", "2024-03-05", "2024-12-31"],
+                                           dtype="datetime64[D]").tolist()
+    assert effort_counts.tolist() == [10, 14, 40]
+    assert history.to_efforts()[1] == Effort(effort_count=14, fetch_date="05-03-2024", fetch_day=datetime(2024, 3, 5))
+
+
+def test_read_many_arrays_concatenates_years_in_order():
+    config = ConfigForTest()
+    repository = CompactEffortRepository(Database(config), config)
+    histories = CompactEffortRepository.compact_efforts(1, [
+        Effort(effort_count=5, fetch_date="30-12-2023"),
+        Effort(effort_count=8, fetch_date="02-01-2024"),
+    ])
+    with patch.object(Database, 'find_many') as mock_find_many:
+        mock_find_many.return_value = [history.model_dump() for history in reversed(histories)]
+        arrays = repository.read_many_arrays([1], allow_stale=True)
+        mock_find_many.assert_called_once_with(config.EFFORT_COMPACT_COLL_NAME, {"segment_id": {"$in": [1]}},
+                                               {"_id": 0})
+    fetch_days, effort_counts = arrays[1]
+    assert fetch_days.astype(str).tolist() == ["2023-12-30", "2024-01-02"]
+    assert effort_counts.tolist() == [5, 8]
+
+
+def test_readers_refuse_a_copy_older_than_the_latest_run():
+    config = ConfigForTest()
+    repository = CompactEffortRepository(Database(config), config)
+    runs = MagicMock()
+    runs.limit.return_value = [{"_id": "run"}]
+    with patch.object(Database, 'find_one', return_value={"_id": "effort_history_compact",
+                                                          "built_at": datetime(2024, 5, 1)}), \
+            patch.object(Database, 'find_many', return_value=runs) as mock_find_many:
+        with pytest.raises(StaleCompactHistoryError):
+            repository.read_arrays(1)
+    assert mock_find_many.call_args.args[1] == {"started_at": {"$gt": datetime(2024, 5, 1)}}
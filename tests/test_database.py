@@ -1,5 +1,6 @@
 from unittest.mock import patch
 from db.database import Database
+from db.indexes import REQUIRED_INDEXES
 from dotenv import load_dotenv
 from utils.config import ConfigForTest
 
@@ -12,3 +13,22 @@ def test_db_connection():
     db = Database(config)
     assert db is not None
 
+
+def test_ensure_indexes_creates_declared_indexes():
+    config = ConfigForTest()
+    db = Database(config)
+    with patch.object(db, 'db') as mock_db:
+        db.ensure_indexes()
+        for collection_name, index_models in REQUIRED_INDEXES.items():
+            mock_db[collection_name].create_indexes.assert_any_call(index_models)
+
+
+def test_verify_indexes_reports_index_used_by_winning_plan():
+    config = ConfigForTest()
+    db = Database(config)
+    explain = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN",
+                                                                                 "indexName": "id_unique"}}}}
+    with patch.object(Database, 'explain', return_value=explain):
+        assert db.verify_indexes([("segments", {"id": 1})]) == [("segments", {"id": 1}, "id_unique")]
+    with patch.object(Database, 'explain', return_value={"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}):
+        assert db.verify_indexes([("segments", {"id": 1})]) == [("segments", {"id": 1}, None)]
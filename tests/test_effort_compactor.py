@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+from unittest.mock import MagicMock, patch
+from db.database import Database
+from models.SegmentEffortData import Effort
+from services.effort_compactor import EffortCompactor, downsample_efforts
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLICY = ((90, "sample"), (365, "day"), (None, "week"))
+
+
+def effort(day: datetime, effort_count: int):
+    return Effort(effort_count=effort_count, fetch_date=day.strftime("%d-%m-%Y"), fetch_day=day)
+
+
+def test_downsample_keeps_recent_samples_and_latest_per_week_when_old():
+    now = datetime(2024, 6, 1)
+    recent = [effort(now - timedelta(days=days), 100 - days) for days in (1, 2)]
+    # Monday 2022-01-03 to Wednesday 2022-01-05 share an ISO week
+    old = [effort(datetime(2022, 1, 3), 1), effort(datetime(2022, 1, 4), 2), effort(datetime(2022, 1, 5), 3)]
+    kept = downsample_efforts(old + recent, POLICY, now)
+    assert [e.effort_count for e in kept] == [3, 98, 99]
+
+
+def test_run_pulls_removed_efforts_and_checkpoints_each_batch():
+    config = ConfigForTest()
+    compactor = EffortCompactor(Database(config), config, policy=POLICY, batch_size=2)
+    documents = [{"_id": 1, "efforts": [effort(datetime(2022, 1, 3), 1).model_dump(),
+                                        effort(datetime(2022, 1, 4), 2).model_dump()]},
+                 {"_id": 2, "efforts": [effort(datetime(2022, 1, 3), 1).model_dump()]}]
+    cursor = MagicMock()
+    cursor.sort.return_value.limit.side_effect = [documents, []]
+    with patch.object(Database, 'find_one', return_value=None), \
+            patch.object(Database, 'find_many', return_value=cursor), \
+            patch.object(Database, 'bulk_write') as mock_bulk_write, \
+            patch.object(Database, 'update_one') as mock_update_one:
+        assert compactor.run() == 1
+    operations = mock_bulk_write.call_args.args[1]
+    assert operations[0]._filter == {"_id": 1}
+    assert operations[0]._doc[0]["$set"]["efforts"]["$filter"]["cond"] == {
+        "$not": [{"$in": ["$$this.fetch_date", {"$literal": ["03-01-2022"]}]}]}
+    checkpoints = [call.args[2]["$set"]["last_id"] for call in mock_update_one.call_args_list]
+    assert checkpoints == [2, 2]
+    assert mock_update_one.call_args.args[2]["$set"]["completed_at"] is not None
+
+
+def test_batch_query_selects_legacy_entries_next_to_migrated_ones():
+    config = ConfigForTest()
+    now = datetime(2024, 6, 1)
+    compactor = EffortCompactor(Database(config), config, policy=POLICY)
+    # Two legacy entries without fetch_day in the same old week, then an entry written since the migration
+    legacy = [Effort(effort_count=count, fetch_date=fetch_date).model_dump(exclude={"fetch_day"})
+              for count, fetch_date in ((1, "03-01-2022"), (2, "04-01-2022"))]
+    document = {"_id": 1, "efforts": legacy + [effort(now - timedelta(days=1), 3).model_dump()]}
+    query = compactor._batch_query(None, now)
+    assert {"efforts": {"$elemMatch": {"fetch_day": {"$exists": False}}}} in query["$or"]
+    operation = compactor._compaction_operation(document, now)
+    assert operation._doc[0]["$set"]["efforts"]["$filter"]["cond"] == {
+        "$not": [{"$in": ["$$this.fetch_date", {"$literal": ["03-01-2022"]}]}]}
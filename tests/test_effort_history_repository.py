@@ -0,0 +1,55 @@
+from datetime import datetime
+
+import pytest
+from unittest.mock import patch
+from db.database import Database
+from models.SegmentEffortData import Effort, SegmentEffortData
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+from services.effort_history_repository import EffortHistoryRepository
+
+load_dotenv()
+
+
+@pytest.fixture
+def effort_history():
+    config = ConfigForTest()
+    db = Database(config)
+    return EffortHistoryRepository(db, config)
+
+
+def test_append_effort_upserts_into_monthly_bucket(effort_history):
+    segment_effort_data = SegmentEffortData(segment_id=1, name="Test Segment",
+                                            efforts=[Effort(effort_count=10, fetch_date="05-03-2024")])
+    with patch.object(Database, 'update_one') as mock_update_one:
+        effort_history.append_effort(segment_effort_data)
+        collection_name, query, pipeline = mock_update_one.call_args.args
+    assert collection_name == effort_history.config.EFFORT_BUCKETS_COLL_NAME
+    assert query == {"segment_id": 1, "month": "2024-03"}
+    assert pipeline[-1] == {"$set": {"count": {"$size": "$efforts"}}}
+    assert mock_update_one.call_args.kwargs == {"upsert": True}
+
+
+def test_read_efforts_runs_range_query_server_side(effort_history):
+    with patch.object(Database, 'aggregate') as mock_aggregate:
+        mock_aggregate.return_value = [{"effort_count": 9, "fetch_date": "31-03-2024",
+                                        "fetch_day": datetime(2024, 3, 31)}]
+        efforts = effort_history.read_efforts(1, datetime(2024, 3, 15, 18), datetime(2024, 4, 10))
+        collection_name, pipeline = mock_aggregate.call_args.args
+    assert collection_name == effort_history.config.EFFORT_BUCKETS_COLL_NAME
+    assert pipeline[0] == {"$match": {"segment_id": 1, "month": {"$gte": "2024-03", "$lte": "2024-04"}}}
+    assert {"$match": {"fetch_day": {"$gte": datetime(2024, 3, 15), "$lte": datetime(2024, 4, 10)}}} in pipeline
+    assert efforts == [Effort(effort_count=9, fetch_date="31-03-2024", fetch_day=datetime(2024, 3, 31))]
+
+
+def test_import_operations_group_efforts_by_month(effort_history):
+    operations = effort_history._import_operations({
+        "segment_id": 1,
+        "name": "Test Segment",
+        "efforts": [{"effort_count": 5, "fetch_date": "31-03-2024"},
+                    {"effort_count": 7, "fetch_date": "01-04-2024"},
+                    {"effort_count": 8, "fetch_date": "02-04-2024"}],
+    })
+    assert [operation._filter for operation in operations] == [{"segment_id": 1, "month": "2024-03"},
+                                                               {"segment_id": 1, "month": "2024-04"}]
+    assert all(operation._upsert for operation in operations)
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from db.database import Database
+from models.SegmentEffortData import Effort
+from services.fetch_scheduler import FetchScheduler, effort_rate
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+NOW = datetime(2024, 6, 10, 6)
+
+
+def history(segment_id, counts, last_day):
+    days = [last_day - timedelta(days=len(counts) - 1 - index) for index in range(len(counts))]
+    return {"segment_id": segment_id,
+            "efforts": [{"effort_count": count, "fetch_date": day.strftime("%d-%m-%Y"), "fetch_day": day}
+                        for count, day in zip(counts, days)]}
+
+
+def test_effort_rate_is_efforts_per_day():
+    day = datetime(2024, 6, 1)
+    efforts = [Effort(effort_count=10, fetch_date="01-06-2024", fetch_day=day),
+               Effort(effort_count=40, fetch_date="04-06-2024", fetch_day=day + timedelta(days=3))]
+    assert effort_rate(efforts) == 10
+    assert effort_rate(efforts[:1]) is None
+
+
+def test_refresh_interval_is_clamped_between_min_and_max():
+    config = ConfigForTest()
+    scheduler = FetchScheduler(Database(config), config)
+    assert scheduler.refresh_interval(100) == config.SCHEDULE_MIN_INTERVAL_DAYS
+    assert scheduler.refresh_interval(0) == config.SCHEDULE_MAX_INTERVAL_DAYS
+    assert scheduler.refresh_interval(1) == config.SCHEDULE_TARGET_EFFORTS
+
+
+def test_due_segments_skips_quiet_segments_and_orders_by_priority():
+    config = ConfigForTest()
+    yesterday = datetime(2024, 6, 9)
+    documents = [
+        history(1, [100, 130, 160], yesterday),  # busy, due every run
+        history(2, [50, 50, 50], yesterday),  # quiet, fetched yesterday
+        history(3, [10, 11, 12], yesterday - timedelta(days=10)),  # slow but overdue
+    ]
+    work = [("area", "1"), ("area", "2"), ("area", "3"), ("area", "4")]
+    with patch.object(Database, 'find_many', return_value=documents):
+        due = FetchScheduler(Database(config), config).due_segments(work, now=NOW, quota=0)
+    # 4 has no history so it goes first, 2 is not due
+    assert due == [("area", "4"), ("area", "3"), ("area", "1")]
+
+
+def test_due_segments_respects_the_quota():
+    config = ConfigForTest()
+    work = [("area", str(segment_id)) for segment_id in range(5)]
+    with patch.object(Database, 'find_many', return_value=[]):
+        due = FetchScheduler(Database(config), config).due_segments(work, now=NOW, quota=2)
+    assert len(due) == 2
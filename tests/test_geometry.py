@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from unittest.mock import MagicMock, patch
+from db.database import Database
+from services.geometry_repository import GeometryRepository
+from utils.config import ConfigForTest
+from utils.geometry import bounding_box, decode_polyline, decode_polylines, path_length, simplify
+
+# Example from the encoded polyline algorithm documentation
+POLYLINE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+COORDINATES = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+
+
+def test_decode_polyline():
+    np.testing.assert_allclose(decode_polyline(POLYLINE), COORDINATES)
+
+
+def test_decode_polylines_restarts_deltas_for_each_polyline():
+    decoded = decode_polylines([POLYLINE, "??", POLYLINE])
+    np.testing.assert_allclose(decoded[0], COORDINATES)
+    np.testing.assert_allclose(decoded[1], [[0.0, 0.0]])
+    np.testing.assert_allclose(decoded[2], COORDINATES)
+
+
+def test_bounding_box_and_length():
+    coordinates = np.array([[40.0, 8.0], [40.0, 8.01]])
+    assert bounding_box(coordinates) == (40.0, 8.0, 40.0, 8.01)
+    assert abs(path_length(coordinates) - 851.7) < 1
+
+
+def test_simplify_drops_points_within_tolerance():
+    # The middle point is about 1.1 meters off the straight line
+    coordinates = np.array([[40.0, 8.0], [40.00001, 8.005], [40.0, 8.01]])
+    np.testing.assert_allclose(simplify(coordinates, 5), coordinates[[0, 2]])
+    np.testing.assert_allclose(simplify(coordinates, 0.5), coordinates)
+
+
+def test_get_shape_is_cached_per_geometry():
+    config = ConfigForTest()
+    repository = GeometryRepository(Database(config), config)
+    with patch.object(Database, 'find_one', return_value={"_id": "abc", "polyline": POLYLINE}) as mock_find_one, \
+            patch.object(Database, 'update_one') as mock_update_one:
+        shape = repository.get_shape("abc")
+        assert repository.get_shape("abc") is shape
+        mock_find_one.assert_called_once()
+        mock_update_one.assert_called_once_with(config.GEOMETRIES_COLL_NAME, {"_id": "abc"}, {"$set": {"shape": shape}})
+    assert shape["points"] == 3
+    assert shape["bbox"] == [38.5, -126.453, 43.252, -120.2]
+    assert set(shape["simplified"]) == {str(tolerance) for tolerance in config.GEOMETRY_SIMPLIFY_TOLERANCES}
+
+
+@pytest.mark.parametrize("polyline", ["?", "_p~iF~ps|U_", "abc def"])
+def test_decode_polylines_rejects_malformed_polylines(polyline):
+    with pytest.raises(ValueError, match="Malformed encoded polyline"):
+        decode_polylines([POLYLINE, polyline])
+
+
+def test_build_shapes_marks_malformed_geometries():
+    config = ConfigForTest()
+    repository = GeometryRepository(Database(config), config)
+    cursor = MagicMock()
+    cursor.limit.side_effect = [[{"_id": "good", "polyline": POLYLINE}, {"_id": "bad", "polyline": "?"}], []]
+    with patch.object(Database, 'find_many', return_value=cursor), \
+            patch.object(Database, 'bulk_write') as mock_bulk_write:
+        assert repository.build_shapes() == 2
+    good, bad = mock_bulk_write.call_args.args[1]
+    assert good._doc["$set"]["shape"]["points"] == 3
+    assert bad._doc["$set"]["shape"]["tolerances"] == list(config.GEOMETRY_SIMPLIFY_TOLERANCES)
+    assert "error" in bad._doc["$set"]["shape"]
+    assert repository.get_shape("bad") is None
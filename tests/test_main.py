@@ -0,0 +1,122 @@
+import threading
+from unittest.mock import MagicMock, patch
+from main import fetch_and_write_segments, prioritize, record_bulk_flush, run_maintenance
+from models.BulkWriteReport import BulkWriteReport
+from services.run_budget import RunBudget
+from services.run_journal import DEFERRED, FAILED, WRITTEN
+from services.segment_leases import SegmentLeases
+from services.strava_api import StravaRateLimitError
+from utils.config import ConfigForTest
+
+
+@patch('main.fetch_segment')
+def test_fetch_and_write_segments_writes_every_segment(mock_fetch_segment):
+    mock_fetch_segment.side_effect = lambda strava_api, location, segment_id, journal: (location, segment_id)
+    segments_writer = MagicMock()
+    with patch('main.segment_ids', {"area1": {"1": "a", "2": "b"}, "area2": {"3": "c"}}):
+        fetch_and_write_segments(MagicMock(), segments_writer, max_workers=2)
+    written = {call.args[0] for call in segments_writer.write_segment_data.call_args_list}
+    assert written == {("area1", "1"), ("area1", "2"), ("area2", "3")}
+
+
+@patch('main.fetch_segment')
+def test_fetch_and_write_segments_marks_failures_without_stopping_the_run(mock_fetch_segment):
+    def fetch(strava_api, location, segment_id, journal):
+        if segment_id == "2":
+            raise ValueError("invalid payload")
+        return (location, segment_id)
+    mock_fetch_segment.side_effect = fetch
+    segments_writer = MagicMock()
+    journal = MagicMock()
+    fetch_and_write_segments(MagicMock(), segments_writer, 2, [("area1", "1"), ("area1", "2"), ("area2", "3")],
+                             journal)
+    written = {call.args[0] for call in segments_writer.write_segment_data.call_args_list}
+    assert written == {("area1", "1"), ("area2", "3")}
+    marks = {call.args[0]: call.args[1] for call in journal.mark.call_args_list}
+    assert marks == {"1": WRITTEN, "2": FAILED, "3": WRITTEN}
+
+
+@patch('main.fetch_segment')
+def test_fetch_and_write_segments_defers_the_rest_on_rate_limit(mock_fetch_segment):
+    mock_fetch_segment.side_effect = StravaRateLimitError("quota exhausted")
+    journal = MagicMock()
+    deferred = fetch_and_write_segments(MagicMock(), MagicMock(), 1, [("area1", "1"), ("area1", "2")], journal)
+    assert deferred == ["1", "2"]
+    assert mock_fetch_segment.call_count == 1
+    journal.mark.assert_called_once_with(["1", "2"], DEFERRED)
+
+
+@patch('main.fetch_segment')
+def test_fetch_and_write_segments_stops_taking_segments_when_the_budget_runs_out(mock_fetch_segment):
+    mock_fetch_segment.side_effect = lambda strava_api, location, segment_id, journal: (location, segment_id)
+    segments_writer = MagicMock()
+    requests = iter(range(100))
+    budget = RunBudget(max_requests=2, request_count=lambda: next(requests))
+    work = [("area1", str(segment_id)) for segment_id in range(5)]
+    deferred = fetch_and_write_segments(MagicMock(), segments_writer, 1, work, budget=budget)
+    assert segments_writer.write_segment_data.call_count == 2
+    assert deferred == ["2", "3", "4"]
+    assert budget.reason == "request budget exhausted"
+
+
+@patch('main.fetch_segment')
+def test_lease_workers_complete_their_leases_while_waiting_for_each_other(mock_fetch_segment):
+    # Each worker claims one segment, then finds the other one held by the other worker
+    mock_fetch_segment.side_effect = lambda strava_api, location, segment_id, journal: (location, segment_id)
+    owners, done, first_claims = {}, set(), set()
+    lock, both_claimed = threading.Lock(), threading.Barrier(2)
+
+    def try_claim(leases, segment_id):
+        with lock:
+            if segment_id in done:
+                return False
+            claimed = owners.setdefault(segment_id, leases.worker_id) == leases.worker_id
+            first = claimed and leases.worker_id not in first_claims
+            first_claims.add(leases.worker_id)
+        if first:
+            both_claimed.wait()
+        return True if claimed else None
+
+    def complete(leases, segment_ids):
+        with lock:
+            done.update(segment_ids)
+
+    config = ConfigForTest()
+    config.SEGMENT_LEASE_POLL_INTERVAL = 0.05
+    with patch.object(SegmentLeases, 'try_claim', autospec=True, side_effect=try_claim), \
+            patch.object(SegmentLeases, 'complete', autospec=True, side_effect=complete):
+        workers = [
+            threading.Thread(target=fetch_and_write_segments, daemon=True,
+                             args=(MagicMock(), MagicMock(), 2, work),
+                             kwargs={"leases": SegmentLeases(MagicMock(), config, "run", worker_id)})
+            for worker_id, work in (("a", [("area", "1"), ("area", "2")]), ("b", [("area", "2"), ("area", "1")]))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(5)
+    assert not any(worker.is_alive() for worker in workers)
+    assert sorted(call.args[2] for call in mock_fetch_segment.call_args_list) == ["1", "2"]
+
+
+def test_prioritize_moves_deferred_segments_first():
+    work = [("a", "1"), ("a", "2"), ("b", "3")]
+    assert prioritize(work, ["3"]) == [("b", "3"), ("a", "1"), ("a", "2")]
+
+
+def test_record_bulk_flush_marks_segments_with_failed_operations():
+    journal = MagicMock()
+    segments = [MagicMock(id=1), MagicMock(id=2)]
+    report = BulkWriteReport(errors=[{"collection": "segments", "message": "duplicate key",
+                                      "operation": {"q": {"id": 2}, "u": {}}}])
+    record_bulk_flush(journal, segments, report)
+    assert journal.mark.call_args_list[0].args == ([1], WRITTEN)
+    assert journal.mark.call_args_list[1].args == ("2", FAILED, "duplicate key")
+
+
+def test_run_maintenance_never_fails_the_run():
+    segments_repository = MagicMock()
+    segments_repository.geometries.build_shapes.side_effect = ValueError("Malformed encoded polyline")
+    with patch("main.SegmentScorer") as mock_scorer:
+        run_maintenance(MagicMock(), MagicMock(), segments_repository)
+    mock_scorer.assert_not_called()
@@ -0,0 +1,44 @@
+from unittest.mock import MagicMock, patch
+from services.response_cache import SegmentResponseCache
+from services.strava_api import StravaAPI
+from utils.config import ConfigForTest
+
+
+def test_cache_returns_payload_until_ttl_expires(tmp_path):
+    cache = SegmentResponseCache(str(tmp_path / "cache.sqlite"), ttl=60, max_bytes=1024 * 1024)
+    with patch('services.response_cache.time.time', return_value=1000.0):
+        cache.put("1", {"id": 1, "name": "Catorcio"})
+    with patch('services.response_cache.time.time', return_value=1059.0):
+        assert cache.get("1") == ({"id": 1, "name": "Catorcio"}, 1000.0)
+    with patch('services.response_cache.time.time', return_value=1061.0):
+        assert cache.get("1") is None
+
+
+def test_cache_evicts_oldest_entries_over_max_bytes(tmp_path):
+    cache = SegmentResponseCache(str(tmp_path / "cache.sqlite"), ttl=3600, max_bytes=40)
+    with patch('services.response_cache.time.time', return_value=1000.0):
+        cache.put("1", {"id": 1, "name": "first"})
+    with patch('services.response_cache.time.time', return_value=1001.0):
+        cache.put("2", {"id": 2, "name": "second"})
+        assert cache.get("1") is None
+        assert cache.get("2") == ({"id": 2, "name": "second"}, 1001.0)
+
+
+def test_get_segment_uses_cache_before_strava(tmp_path):
+    cache = SegmentResponseCache(str(tmp_path / "cache.sqlite"), ttl=3600, max_bytes=1024 * 1024)
+    strava_api = StravaAPI(ConfigForTest(), response_cache=cache)
+    strava_api._handle_request = MagicMock(return_value={"id": 1})
+    assert strava_api.get_segment("1") == {"id": 1}
+    assert strava_api.get_segment("1") == {"id": 1}
+    strava_api._handle_request.assert_called_once()
+
+
+def test_cached_segment_keeps_the_time_it_was_fetched(tmp_path):
+    cache = SegmentResponseCache(str(tmp_path / "cache.sqlite"), ttl=24 * 3600, max_bytes=1024 * 1024)
+    strava_api = StravaAPI(ConfigForTest(), response_cache=cache)
+    strava_api._handle_request = MagicMock(return_value={"id": 1})
+    with patch('services.strava_api.time.time', return_value=1000.0):
+        assert strava_api.get_segment_with_fetch_time("1") == ({"id": 1}, 1000.0)
+    # Replayed hours later, the payload is still dated when Strava served it
+    with patch('services.response_cache.time.time', return_value=1000.0 + 6 * 3600):
+        assert strava_api.get_segment_with_fetch_time("1") == ({"id": 1}, 1000.0)
@@ -0,0 +1,77 @@
+from unittest.mock import patch
+from db.database import Database
+from services.run_journal import FAILED, FETCHED, VALIDATED, WRITTEN, RunJournal
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def test_start_records_every_segment_and_the_latest_run():
+    config = ConfigForTest()
+    db = Database(config)
+    with patch.object(Database, 'insert_one') as mock_insert_one, \
+            patch.object(Database, 'update_one') as mock_update_one:
+        journal = RunJournal.start(db, config, [("area1", "1"), ("area2", "2")])
+    run = mock_insert_one.call_args.args[1]
+    assert run["_id"] == journal.run_id
+    assert run["segments"] == {"1": {"location": "area1", "status": None}, "2": {"location": "area2", "status": None}}
+    assert mock_update_one.call_args.args[2]["$set"]["run_id"] == journal.run_id
+    assert journal.remaining() == [("area1", "1"), ("area2", "2")]
+
+
+def test_mark_sets_the_status_of_many_segments_in_one_update():
+    config = ConfigForTest()
+    journal = RunJournal(Database(config), config, "run", {"1": {"location": "a"}, "2": {"location": "a"}})
+    with patch.object(Database, 'update_one') as mock_update_one:
+        journal.mark([1, 2], WRITTEN)
+    mock_update_one.assert_called_once()
+    new_values = mock_update_one.call_args.args[2]["$set"]
+    assert new_values["segments.1.status"] == WRITTEN and new_values["segments.2.status"] == WRITTEN
+    assert journal.remaining() == []
+
+
+def test_resume_skips_written_segments_and_retries_failed_ones():
+    config = ConfigForTest()
+    run = {"_id": "run", "completed_at": None, "segments": {
+        "1": {"location": "a", "status": WRITTEN},
+        "2": {"location": "a", "status": FAILED, "error": "boom"},
+        "3": {"location": "b", "status": "fetched"},
+    }}
+    with patch.object(Database, 'find_one', side_effect=[{"_id": "segments_job", "run_id": "run"}, run]):
+        journal = RunJournal.resume(Database(config), config)
+    assert journal.run_id == "run"
+    assert journal.remaining() == [("a", "2"), ("b", "3")]
+
+
+def test_resume_returns_none_when_the_latest_run_completed():
+    config = ConfigForTest()
+    with patch.object(Database, 'find_one', return_value={"_id": "run", "completed_at": 1, "segments": {}}):
+        assert RunJournal.resume(Database(config), config, "run") is None
+
+
+def test_finish_completes_the_run_only_when_every_segment_was_written():
+    config = ConfigForTest()
+    journal = RunJournal(Database(config), config, "run", {"1": {"location": "a", "status": WRITTEN},
+                                                            "2": {"location": "a", "status": FAILED}})
+    with patch.object(Database, 'update_one') as mock_update_one:
+        assert journal.finish() is False
+        mock_update_one.assert_not_called()
+        journal.mark("2", WRITTEN)
+        assert journal.finish() is True
+    assert "completed_at" in mock_update_one.call_args.args[2]["$set"]
+
+
+def test_buffered_marks_are_written_with_the_next_mark():
+    config = ConfigForTest()
+    journal = RunJournal(Database(config), config, "run", {"1": {"location": "a"}, "2": {"location": "a"}})
+    with patch.object(Database, 'update_one') as mock_update_one:
+        journal.mark("1", FETCHED, buffered=True)
+        journal.mark("2", FETCHED, buffered=True)
+        journal.mark("2", VALIDATED, buffered=True)
+        mock_update_one.assert_not_called()
+        journal.mark("1", WRITTEN)
+    mock_update_one.assert_called_once()
+    new_values = mock_update_one.call_args.args[2]["$set"]
+    assert new_values["segments.1.status"] == WRITTEN
+    assert new_values["segments.2.status"] == VALIDATED
@@ -0,0 +1,56 @@
+from unittest.mock import patch
+from pymongo.errors import DuplicateKeyError
+from db.database import Database
+from services.segment_leases import SegmentLeases, shard_of, shard_work
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def leases():
+    config = ConfigForTest()
+    return SegmentLeases(Database(config), config, "run", "worker-a")
+
+
+def test_shards_partition_the_segments_stably():
+    work = [("area", str(segment_id)) for segment_id in range(100)]
+    shards = [shard_work(work, index, 3) for index in range(3)]
+    assert sorted(pair for shard in shards for pair in shard) == sorted(work)
+    assert all(shards)
+    assert shard_of("1234", 3) == shard_of(1234, 3)
+
+
+def test_try_claim_upserts_a_lease_that_only_matches_when_free():
+    with patch.object(Database, 'update_one') as mock_update_one:
+        assert leases().try_claim("1") is True
+    query, new_values = mock_update_one.call_args.args[1:3]
+    assert query["_id"] == "run:1"
+    assert query["$or"][0]["done_at"] is None and "$lte" in query["$or"][0]["expires_at"]
+    assert query["$or"][1] == {"owner": "worker-a"}
+    assert new_values["$set"]["owner"] == "worker-a"
+    assert mock_update_one.call_args.kwargs["upsert"] is True
+
+
+def test_try_claim_tells_done_segments_from_held_ones():
+    with patch.object(Database, 'update_one', side_effect=DuplicateKeyError("dup")), \
+            patch.object(Database, 'find_one', side_effect=[{"done_at": 1}, {"done_at": None}]):
+        assert leases().try_claim("1") is False
+        assert leases().try_claim("2") is None
+
+
+def test_claim_waits_for_held_segments_and_takes_expired_ones_over():
+    # 1 is claimed, 2 was done by another worker, 3 is held and its lease expires after one poll
+    claims = {"1": [True], "2": [False], "3": [None, True]}
+    with patch.object(SegmentLeases, 'try_claim', side_effect=lambda segment_id: claims[segment_id].pop(0)), \
+            patch('services.segment_leases.time.sleep') as mock_sleep:
+        claimed = list(leases().claim([("a", "1"), ("a", "2"), ("a", "3")]))
+    assert claimed == [("a", "1"), ("a", "3")]
+    mock_sleep.assert_called_once()
+
+
+def test_complete_only_touches_own_leases():
+    with patch.object(Database, 'update_many') as mock_update_many:
+        leases().complete(["1", 2])
+    query = mock_update_many.call_args.args[1]
+    assert query == {"_id": {"$in": ["run:1", "run:2"]}, "owner": "worker-a"}
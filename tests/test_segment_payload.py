@@ -0,0 +1,35 @@
+import copy
+import pytest
+from pydantic import ValidationError
+from models.EnhancedSegment import EnhancedSegment
+from models.RawSegment import LocalLegend, Map, RawSegment
+from models.SegmentPayload import segment_document
+from segments_data.sample_payload import SEGMENT_PAYLOAD
+
+
+def test_segment_document_matches_the_validated_models():
+    expected = EnhancedSegment.from_raw_segment(RawSegment(**copy.deepcopy(SEGMENT_PAYLOAD)), "alghero", 1.5).to_dict()
+    assert segment_document(copy.deepcopy(SEGMENT_PAYLOAD), "alghero", 1.5) == expected
+
+
+def test_segment_document_handles_missing_local_legend_and_ignores_extra_fields():
+    payload = {key: value for key, value in SEGMENT_PAYLOAD.items()
+               if key not in ("athlete_segment_stats", "elevation_profile")}
+    payload["local_legend"] = None
+    document = segment_document(payload, "alghero", 1.5)
+    assert document["local_legend"] is None
+    assert document["start_lat"] == 40.5612 and document["end_lng"] == 8.3304
+
+
+def test_segment_document_rejects_invalid_payloads():
+    payload = copy.deepcopy(SEGMENT_PAYLOAD)
+    payload["effort_count"] = "many"
+    with pytest.raises(ValidationError):
+        segment_document(payload, "alghero", 1.5)
+
+
+def test_from_payload_builds_a_segment_writing_the_same_document():
+    segment = EnhancedSegment.from_payload(copy.deepcopy(SEGMENT_PAYLOAD), "alghero", 1.5)
+    assert segment.to_dict() == segment_document(copy.deepcopy(SEGMENT_PAYLOAD), "alghero", 1.5)
+    assert EnhancedSegment.model_validate_json(segment.model_dump_json()) == segment
+    assert isinstance(segment.map, Map) and isinstance(segment.local_legend, LocalLegend)
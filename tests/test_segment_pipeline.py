@@ -0,0 +1,64 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from db.database import DatabaseConnectionError
+from services.run_journal import DEFERRED, FAILED, FETCHED, VALIDATED, WRITTEN
+from services.segment_pipeline import SegmentPipeline
+from services.strava_api import StravaRateLimitError
+
+WORK = [("area1", "1"), ("area1", "2"), ("area2", "3")]
+
+
+@pytest.fixture(autouse=True)
+def build_segment():
+    # Stand-in for the Pydantic model: the enhanced segment is (location, segment id)
+    with patch('services.segment_pipeline.EnhancedSegment') as mock_enhanced_segment:
+        mock_enhanced_segment.from_payload.side_effect = lambda data, location, timestamp: (location, data["id"])
+        yield
+
+
+def strava_api():
+    api = MagicMock()
+    api.get_segment_with_fetch_time.side_effect = lambda segment_id: ({"id": segment_id}, 0.0)
+    return api
+
+
+def test_pipeline_fetches_validates_and_writes_every_segment():
+    segments_writer = MagicMock()
+    journal = MagicMock()
+    deferred = SegmentPipeline(strava_api(), segments_writer, fetch_workers=2, write_workers=2, queue_size=1,
+                               journal=journal).run(WORK)
+    assert deferred == []
+    written = {call.args[0] for call in segments_writer.write_segment_data.call_args_list}
+    assert written == {("area1", "1"), ("area1", "2"), ("area2", "3")}
+    statuses = [call.args[1] for call in journal.mark.call_args_list if call.args[0] == "2"]
+    assert statuses == [FETCHED, VALIDATED, WRITTEN]
+
+
+def test_pipeline_marks_invalid_segments_failed_and_keeps_going():
+    api = strava_api()
+    api.get_segment_with_fetch_time.side_effect = lambda segment_id: (
+        {} if segment_id == "2" else {"id": segment_id}, 0.0)
+    segments_writer = MagicMock()
+    journal = MagicMock()
+    SegmentPipeline(api, segments_writer, fetch_workers=1, journal=journal).run(WORK)
+    assert segments_writer.write_segment_data.call_count == 2
+    assert any(call.args[:2] == ("2", FAILED) for call in journal.mark.call_args_list)
+
+
+def test_pipeline_defers_the_rest_on_rate_limit():
+    api = strava_api()
+    api.get_segment_with_fetch_time.side_effect = StravaRateLimitError("quota exhausted")
+    journal = MagicMock()
+    deferred = SegmentPipeline(api, MagicMock(), fetch_workers=1, queue_size=1, journal=journal).run(WORK)
+    assert sorted(deferred) == ["1", "2", "3"]
+    assert api.get_segment_with_fetch_time.call_count == 1
+    journal.mark.assert_called_once_with(deferred, DEFERRED)
+
+
+def test_pipeline_stops_and_raises_on_database_connection_error():
+    segments_writer = MagicMock()
+    segments_writer.write_segment_data.side_effect = DatabaseConnectionError()
+    work = [("area", str(segment_id)) for segment_id in range(50)]
+    with pytest.raises(DatabaseConnectionError):
+        SegmentPipeline(strava_api(), segments_writer, fetch_workers=2, queue_size=2).run(work)
+    assert segments_writer.write_segment_data.call_count == 1
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+import numpy as np
+from unittest.mock import patch
+from db.database import Database
+from services.segment_scoring import SegmentScorer, difficulty_classes, effort_rates, popularity_scores
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def test_effort_rates_from_unordered_samples():
+    segment_index = np.array([1, 0, 1, 0, 2])
+    days = np.array([10, 14, 0, 10, 5])
+    counts = np.array([30, 18, 10, 10, 7])
+    rates = effort_rates(segment_index, days, counts, 4)
+    assert rates.tolist() == [2.0, 2.0, 0.0, 0.0]
+
+
+def test_popularity_is_relative_to_the_busiest_segment_of_the_area():
+    area_codes = np.array([0, 0, 1, 1])
+    rates = np.array([4.0, 1.0, 0.0, 0.0])
+    athlete_counts = np.array([10, 10, 50, 20])
+    assert popularity_scores(area_codes, rates, athlete_counts).tolist() == [100, 25, 100, 40]
+
+
+def test_difficulty_classes_by_grade_and_distance():
+    grades = np.array([1.0, -4.0, 8.0, 12.0, 8.0])
+    distances = np.array([500.0, 500.0, 500.0, 500.0, 5000.0])
+    assert difficulty_classes(grades, distances, (3, 6, 10), 3000).tolist() == [
+        "easy", "moderate", "hard", "extreme", "extreme"]
+
+
+def test_run_writes_only_changed_scores():
+    config = ConfigForTest()
+    scorer = SegmentScorer(Database(config), config)
+    segments = [
+        {"id": 1, "trail_area": "alghero", "average_grade": 1.0, "distance": 100.0, "athlete_count": 5,
+         "popularity": 100, "difficulty": "easy"},
+        {"id": 2, "trail_area": "alghero", "average_grade": 7.0, "distance": 100.0, "athlete_count": 5,
+         "popularity": 0, "difficulty": ""},
+    ]
+    efforts = [
+        {"segment_id": 1, "fetch_day": datetime(2024, 5, 1), "effort_count": 10},
+        {"segment_id": 1, "fetch_day": datetime(2024, 5, 3), "effort_count": 20},
+        {"segment_id": 2, "fetch_day": datetime(2024, 5, 1), "effort_count": 10},
+        {"segment_id": 2, "fetch_day": datetime(2024, 5, 3), "effort_count": 15},
+        {"segment_id": 99, "fetch_day": datetime(2024, 5, 3), "effort_count": 1000},
+    ]
+    with patch.object(Database, 'find_many', return_value=segments), \
+            patch.object(Database, 'aggregate', return_value=efforts), \
+            patch.object(Database, 'bulk_write') as mock_bulk_write:
+        updated = scorer.run(now=datetime(2024, 5, 3))
+    assert updated == 1
+    operation, = mock_bulk_write.call_args.args[1]
+    assert operation._filter == {"id": 2}
+    assert operation._doc == {"$set": {"popularity": 50, "difficulty": "hard"}}
+
+
+def test_recent_efforts_filters_the_window_before_unwinding():
+    config = ConfigForTest()
+    config.EFFORT_STORAGE = "document"
+    rows = [{"segment_id": 1, "effort_count": 10, "fetch_day": datetime(2024, 5, 30)}]
+    with patch.object(Database, 'aggregate', return_value=rows) as mock_aggregate:
+        segment_ids, days, counts = SegmentScorer(Database(config), config).recent_efforts(datetime(2024, 5, 1))
+    pipeline = mock_aggregate.call_args.args[1]
+    assert [next(iter(stage)) for stage in pipeline] == ["$project", "$unwind", "$project"]
+    assert pipeline[0]["$project"]["efforts"]["$filter"]["cond"] == {"$gte": ["$$this.fetch_day", datetime(2024, 5, 1)]}
+    assert (segment_ids.tolist(), counts.tolist()) == ([1], [10])
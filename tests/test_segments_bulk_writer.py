@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+from unittest.mock import MagicMock, patch
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from db.database import Database
+from models.BulkWriteReport import BulkWriteReport
+from utils.config import ConfigForTest
+from dotenv import load_dotenv
+from services.segments_bulk_writer import SegmentsBulkWriter
+from services.segments_repository import SegmentsRepository, map_segment_effort_data
+
+load_dotenv()
+
+
+@pytest.fixture
+def segments_repository():
+    config = ConfigForTest()
+    db = Database(config)
+    return SegmentsRepository(db, config)
+
+
+def test_build_effort_operations_upserts_without_reading(segments_repository, make_segment):
+    segments = [make_segment(1), make_segment(2)]
+    with patch.object(Database, 'find_many') as mock_find_many:
+        operations = segments_repository.build_effort_operations(segments)
+        mock_find_many.assert_not_called()
+    for segment, operation in zip(segments, operations):
+        assert operation == UpdateOne(
+            {"segment_id": segment.id},
+            SegmentsRepository.upsert_effort_pipeline(map_segment_effort_data(segment)),
+            upsert=True,
+        )
+
+
+def test_build_segment_operations_writes_only_new_or_changed_segments(segments_repository, make_segment):
+    unchanged, changed, new = make_segment(1), make_segment(2), make_segment(3)
+    stored = {segment.id: segments_repository._new_segment_document(segment)["field_hashes"]
+              for segment in (unchanged, changed)}
+    changed.star_count = 5
+    with patch.object(Database, 'find_many') as mock_find_many:
+        mock_find_many.return_value = [{"id": segment_id, "field_hashes": hashes}
+                                       for segment_id, hashes in stored.items()]
+        operations = segments_repository.build_segment_operations([unchanged, changed, new])
+        mock_find_many.assert_called_once()
+    assert len(operations) == 2
+    assert operations[0]._filter == {"id": 2}
+    assert set(operations[0]._doc["$set"]) == {"star_count", "timestamp", "field_hashes.star_count"}
+    assert operations[1]._filter == {"id": 3}
+    assert operations[1]._doc["$set"]["field_hashes"] == segments_repository._new_segment_document(new)["field_hashes"]
+    assert operations[1]._doc["$setOnInsert"] == {"alt_name": new.alt_name, "trail_area": new.trail_area,
+                                                  "difficulty": new.difficulty, "popularity": new.popularity}
+    assert operations[1]._upsert
+
+
+def test_bulk_write_reports_per_operation_errors(segments_repository):
+    with patch.object(Database, 'bulk_write') as mock_bulk_write:
+        mock_bulk_write.side_effect = BulkWriteError({
+            "nInserted": 1, "nMatched": 0, "nModified": 0, "nUpserted": 0,
+            "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key", "op": {"segment_id": 2}}],
+        })
+        report = segments_repository.bulk_write("effort_stats", [InsertOne({}), InsertOne({})])
+    assert report.operations == 2
+    assert report.inserted == 1
+    assert report.errors == [{"collection": "effort_stats", "index": 1, "code": 11000, "message": "duplicate key",
+                              "operation": {"segment_id": 2}}]
+
+
+def test_bulk_writer_flushes_when_batch_is_full(make_segment):
+    segments_repository = MagicMock()
+    segments_repository.write_segments_bulk.return_value = BulkWriteReport()
+    writer = SegmentsBulkWriter(segments_repository, batch_size=2, flush_interval=3600)
+    writer.write_segment_data(make_segment(1))
+    segments_repository.write_segments_bulk.assert_not_called()
+    writer.write_segment_data(make_segment(2))
+    segments_repository.write_segments_bulk.assert_called_once()
+    assert [segment.id for segment in segments_repository.write_segments_bulk.call_args.args[0]] == [1, 2]
+
+
+def test_bulk_writer_fails_the_whole_batch_when_the_flush_raises(make_segment):
+    segments_repository = MagicMock()
+    segments_repository.write_segments_bulk.side_effect = TimeoutError("timed out")
+    on_flush, on_failed = MagicMock(), MagicMock()
+    writer = SegmentsBulkWriter(segments_repository, batch_size=2, flush_interval=3600,
+                                on_flush=on_flush, on_failed=on_failed)
+    writer.write_segment_data(make_segment(1))
+    writer.write_segment_data(make_segment(2))
+    on_flush.assert_not_called()
+    segments, error = on_failed.call_args.args
+    assert [segment.id for segment in segments] == [1, 2]
+    assert isinstance(error, TimeoutError)
+
+
+def test_bulk_writer_flushes_on_interval_without_new_writes(make_segment):
+    segments_repository = MagicMock()
+    segments_repository.write_segments_bulk.return_value = BulkWriteReport()
+    flushed = threading.Event()
+    writer = SegmentsBulkWriter(segments_repository, batch_size=100, flush_interval=0.05,
+                                on_flush=lambda segments, report: flushed.set())
+    writer.write_segment_data(make_segment(1))
+    assert flushed.wait(2)
+    assert [segment.id for segment in segments_repository.write_segments_bulk.call_args.args[0]] == [1]
+    writer.close()
@@ -1,5 +1,7 @@
-from unittest.mock import patch
-from services.strava_api import StravaAPI
+import time
+import pytest
+from unittest.mock import MagicMock, patch
+from services.strava_api import RateLimitGovernor, StravaAPI, StravaRateLimitError
 from dotenv import load_dotenv
 from utils.config import ConfigForTest
 
@@ -27,3 +29,54 @@ def test_get_real_segment_effort_data():
     assert segment_effort_data is not None
     assert segment_effort_data["id"] == int(segment_id)
     assert segment_effort_data["name"] == "Catorcio"
+
+
+def test_rate_limit_governor_waits_for_next_window_when_exhausted():
+    governor = RateLimitGovernor(safety_margin=0, max_wait=60)
+    governor.update({"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "200,300"})
+    with patch('services.strava_api.time.time', return_value=899.0), \
+            patch('services.strava_api.time.sleep') as mock_sleep:
+        governor._windows[("X-RateLimit", RateLimitGovernor.SHORT_PERIOD)].reset_at = 900.0
+        governor._windows[("X-RateLimit", RateLimitGovernor.DAILY_PERIOD)].reset_at = 86400.0
+        mock_sleep.side_effect = lambda seconds: governor._windows[
+            ("X-RateLimit", RateLimitGovernor.SHORT_PERIOD)].roll(900.0)
+        governor.acquire()
+        mock_sleep.assert_called_once_with(1.0)
+
+
+def test_rate_limit_governor_raises_when_daily_window_exhausted():
+    governor = RateLimitGovernor(safety_margin=0, max_wait=60)
+    governor.update({"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "10,2000"})
+    with pytest.raises(StravaRateLimitError):
+        governor.acquire()
+
+
+def test_handle_request_retries_after_429():
+    config = ConfigForTest()
+    strava_api = StravaAPI(config)
+    mock_get = MagicMock()
+    strava_api.session.get = mock_get
+    rate_limited = MagicMock(status_code=429, headers={})
+    ok = MagicMock(status_code=200, headers={"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "2,2"})
+    ok.json.return_value = {"id": 1}
+    mock_get.side_effect = [rate_limited, ok]
+    strava_api.token_manager.get_access_token = MagicMock(return_value="token")
+    with patch.object(strava_api.rate_limit_governor, 'exhaust') as mock_exhaust:
+        assert strava_api.get_segment("1") == {"id": 1}
+        mock_exhaust.assert_called_once()
+
+
+def test_session_retries_transient_errors():
+    config = ConfigForTest()
+    strava_api = StravaAPI(config)
+    adapter = strava_api.session.get_adapter(config.STRAVA_API_URL)
+    assert adapter.max_retries.total == config.STRAVA_MAX_RETRIES
+    assert 503 in adapter.max_retries.status_forcelist
+    assert adapter._pool_maxsize == config.STRAVA_POOL_SIZE
+
+
+def test_governor_raises_instead_of_waiting_past_the_deadline():
+    governor = RateLimitGovernor(max_wait=960, deadline=time.time())
+    governor.exhaust()
+    with pytest.raises(StravaRateLimitError):
+        governor.acquire()
@@ -0,0 +1,51 @@
+import time
+from unittest.mock import MagicMock
+from models.StravaToken import StravaToken
+from services.token_manager import FileTokenStore, TokenManager
+from utils.config import ConfigForTest
+
+
+def auth_response(access_token, refresh_token, expires_at):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"access_token": access_token, "refresh_token": refresh_token,
+                                  "expires_at": expires_at}
+    return response
+
+
+def test_token_refreshed_before_first_request_and_persisted(tmp_path):
+    config = ConfigForTest()
+    config.STRAVA_REFRESH_TOKEN = "initial_refresh"
+    session = MagicMock()
+    session.post.return_value = auth_response("new_access", "new_refresh", int(time.time()) + 3600)
+    store = FileTokenStore(str(tmp_path / "token.json"))
+    token_manager = TokenManager(config, session, store)
+
+    assert token_manager.get_access_token() == "new_access"
+    assert token_manager.get_access_token() == "new_access"
+    session.post.assert_called_once()
+    assert session.post.call_args.kwargs["data"]["refresh_token"] == "initial_refresh"
+    assert store.load().refresh_token == "new_refresh"
+
+
+def test_stored_token_used_until_close_to_expiry(tmp_path):
+    config = ConfigForTest()
+    session = MagicMock()
+    store = FileTokenStore(str(tmp_path / "token.json"))
+    store.save(StravaToken(access_token="stored", refresh_token="r", expires_at=int(time.time()) + 3600))
+    token_manager = TokenManager(config, session, store)
+
+    assert token_manager.get_access_token() == "stored"
+    session.post.assert_not_called()
+
+
+def test_invalidate_refreshes_only_once_for_the_same_token():
+    config = ConfigForTest()
+    session = MagicMock()
+    session.post.return_value = auth_response("second", "r2", int(time.time()) + 3600)
+    token_manager = TokenManager(config, session)
+    token_manager._token = StravaToken(access_token="first", refresh_token="r1", expires_at=int(time.time()) + 3600)
+
+    token_manager.invalidate("first")
+    token_manager.invalidate("first")
+    session.post.assert_called_once()
+    assert token_manager.get_access_token() == "second"
@@ -4,10 +4,13 @@ import pytest
 from unittest.mock import patch
 from db.database import Database
 from models.RawSegment import Map
+from models.TrailArea import TrailBase
 from utils.config import ConfigForTest
 from models.EnhancedSegment import EnhancedSegment
 from dotenv import load_dotenv
-from services.segments_repository import SegmentsRepository
+from services.effort_history_repository import EffortHistoryRepository
+from services.geometry_repository import GeometryRepository, polyline_hash
+from services.segments_repository import SegmentsRepository, field_fingerprints, map_segment_effort_data
 
 load_dotenv()
 
@@ -39,8 +42,32 @@ def segment():
 @pytest.fixture
 def segments_repository():
     config = ConfigForTest()
+    # The inline layout carries every field, the collection layout is covered by its own tests
+    config.GEOMETRY_STORAGE = "inline"
     db = Database(config)
-    return SegmentsRepository(db, config)
+    with patch.object(GeometryRepository, 'save'):
+        yield SegmentsRepository(db, config)
+
+
+def segment_fields(segment):
+    return {
+        "name": segment.name,
+        "average_grade": segment.average_grade,
+        "distance": segment.distance,
+        "start_lat": segment.start_lat,
+        "start_lng": segment.start_lng,
+        "end_lat": segment.end_lat,
+        "end_lng": segment.end_lng,
+        "local_legend": None,
+        "star_count": segment.star_count,
+        "effort_count": segment.effort_count,
+        "athlete_count": segment.athlete_count,
+        "kom": segment.kom,
+        "map": segment.map.to_dict(),
+        "polyline": segment.polyline,
+        "geometry_id": polyline_hash(segment.map.polyline),
+        "start_point": {"type": "Point", "coordinates": [segment.start_lng, segment.start_lat]},
+    }
 
 
 def test_update_segment_data_when_segment_exists(segment, segments_repository):
@@ -49,33 +76,45 @@ def test_update_segment_data_when_segment_exists(segment, segments_repository):
         SegmentsRepository, '_insert_one') as mock_insert_one:
         mock_find_one.return_value = {"_id": "test_id"}
         segments_repository.update_segment_data(segment)
+        fingerprints = field_fingerprints(segment_fields(segment))
         mock_update_one.assert_called_once_with(
             "segments",
             {"_id": "test_id"},
             {
                 "$set":
                     {
-                        "name": segment.name,
-                        "average_grade": segment.average_grade,
-                        "distance": segment.distance,
-                        "start_lat": segment.start_lat,
-                        "start_lng": segment.start_lng,
-                        "end_lat": segment.end_lat,
-                        "end_lng": segment.end_lng,
-                        "local_legend": None,
-                        "star_count": segment.star_count,
-                        "effort_count": segment.effort_count,
-                        "athlete_count": segment.athlete_count,
-                        "kom": segment.kom,
-                        "map": segment.map.to_dict(),
-                        "polyline": segment.polyline,
+                        **segment_fields(segment),
                         "timestamp": segment.timestamp,
+                        **{f"field_hashes.{name}": fingerprint for name, fingerprint in fingerprints.items()},
                     }
             }
         )
         mock_insert_one.assert_not_called()
 
 
+def test_update_segment_data_writes_only_changed_fields(segment, segments_repository):
+    fingerprints = field_fingerprints(segment_fields(segment))
+    segment.effort_count = 42
+    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
+                                                                           '_update_one') as mock_update_one:
+        mock_find_one.return_value = {"_id": "test_id", "field_hashes": fingerprints}
+        segments_repository.update_segment_data(segment)
+        mock_update_one.assert_called_once_with(
+            "segments",
+            {"_id": "test_id"},
+            {"$set": {"effort_count": 42, "timestamp": segment.timestamp,
+                      "field_hashes.effort_count": field_fingerprints({"effort_count": 42})["effort_count"]}}
+        )
+
+
+def test_update_segment_data_skips_unchanged_segment(segment, segments_repository):
+    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
+                                                                           '_update_one') as mock_update_one:
+        mock_find_one.return_value = {"_id": "test_id", "field_hashes": field_fingerprints(segment_fields(segment))}
+        segments_repository.update_segment_data(segment)
+        mock_update_one.assert_not_called()
+
+
 def test_update_segment_data_when_segment_does_not_exist(segment, segments_repository):
     with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
                                                                            '_update_one') as mock_update_one, patch.object(
@@ -105,74 +144,116 @@ def test_update_segment_data_when_segment_does_not_exist(segment, segments_repos
                 "map": segment.map.to_dict(),
                 "polyline": segment.polyline,
                 "timestamp": segment.timestamp,
+                "geometry_id": polyline_hash(segment.map.polyline),
+                "start_point": {"type": "Point", "coordinates": [segment.start_lng, segment.start_lat]},
+                "field_hashes": field_fingerprints(segment_fields(segment)),
             }
         )
         mock_update_one.assert_not_called()
 
 
-def test_update_effort_data_when_effort_exists(segment, segments_repository):
-    fetch_date = datetime.now().strftime("%d-%m-%Y")
+def test_update_effort_data_upserts_without_reading(segment, segments_repository):
     with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
                                                                            '_update_one') as mock_update_one:
-        mock_find_one.return_value = {"efforts": [{"fetch_date": fetch_date, "effort_count": 10}]}
         segments_repository.update_effort_data(segment)
-        mock_update_one.assert_called_once_with(
-            segments_repository.config.EFFORT_COLL_NAME,
-            {"segment_id": segment.id, "efforts.fetch_date": fetch_date},
-            {"$set": {"efforts.$.effort_count": segment.effort_count}},
-        )
+        mock_find_one.assert_not_called()
+        mock_update_one.assert_called_once()
+        collection_name, query, pipeline = mock_update_one.call_args.args
+        assert collection_name == segments_repository.config.EFFORT_COLL_NAME
+        assert query == {"segment_id": segment.id}
+        assert isinstance(pipeline, list)
+        assert mock_update_one.call_args.kwargs == {"upsert": True}
 
 
-def test_update_effort_data_when_effort_data_for_segment_does_not_exist(segment, segments_repository):
-    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
-                                                                           '_insert_one') as mock_insert_one:
-        mock_find_one.return_value = None
-        segments_repository.update_effort_data(segment)
-        mock_insert_one.assert_called_once_with(
-            segments_repository.config.EFFORT_COLL_NAME,
-            {"segment_id": segment.id, "name": segment.name,
-             "efforts": [{"effort_count": segment.effort_count, "fetch_date": datetime.now().strftime("%d-%m-%Y")}]}
-        )
+def test_upsert_effort_pipeline_replaces_or_appends_todays_effort(segment, segments_repository):
+    now = datetime.now()
+    fetch_date = now.strftime("%d-%m-%Y")
+    fetch_day = datetime(now.year, now.month, now.day)
+    segment_effort_data = map_segment_effort_data(segment)
+    efforts = SegmentsRepository.upsert_effort_pipeline(segment_effort_data)[0]["$set"]["efforts"]["$cond"]
+    same_date_check, replace_branch, append_branch = efforts
+    assert same_date_check["$in"][0] == {"$literal": fetch_date}
+    assert replace_branch["$map"]["in"]["$cond"][1] == {
+        "$mergeObjects": ["$$this", {"effort_count": segment.effort_count, "fetch_day": fetch_day}]}
+    assert append_branch["$concatArrays"][1] == [
+        {"$literal": {"effort_count": segment.effort_count, "fetch_date": fetch_date, "fetch_day": fetch_day}}]
 
 
-def test_update_effort_data_when_effort_data_with_different_fetch_date(segment, segments_repository):
-    fetch_date = datetime.now().strftime("%d-%m-%Y")
-    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
-                                                                           '_update_one') as mock_update_one:
-        mock_find_one.return_value = {"efforts": [{"fetch_date": "01-01-2021", "effort_count": 10}]}
-        segments_repository.update_effort_data(segment)
-        mock_update_one.assert_called_once_with(
-            segments_repository.config.EFFORT_COLL_NAME,
-            {"segment_id": segment.id},
-            {"$push": {"efforts": {"effort_count": segment.effort_count, "fetch_date": fetch_date}}},
-            upsert=False
-        )
+def test_find_efforts_between_filters_server_side(segment, segments_repository):
+    with patch.object(Database, 'aggregate') as mock_aggregate:
+        mock_aggregate.return_value = [{"effort_count": 3, "fetch_date": "02-01-2024",
+                                        "fetch_day": datetime(2024, 1, 2)}]
+        efforts = segments_repository.find_efforts_between(segment.id, datetime(2024, 1, 1), datetime(2024, 1, 31))
+        collection_name, pipeline = mock_aggregate.call_args.args
+    assert collection_name == segments_repository.config.EFFORT_COLL_NAME
+    assert pipeline[0] == {"$match": {"segment_id": segment.id}}
+    assert pipeline[-1] == {"$sort": {"fetch_day": 1}}
+    assert efforts[0].fetch_day == datetime(2024, 1, 2)
+
+
+def test_find_efforts_between_reads_buckets_in_bucket_mode(segment):
+    config = ConfigForTest()
+    config.EFFORT_STORAGE = "bucket"
+    db = Database(config)
+    segments_repository = SegmentsRepository(db, config, EffortHistoryRepository(db, config))
+    with patch.object(Database, 'aggregate', return_value=[]) as mock_aggregate:
+        segments_repository.find_efforts_between(segment.id, datetime(2024, 1, 1), datetime(2024, 1, 31))
+    assert mock_aggregate.call_args.args[0] == config.EFFORT_BUCKETS_COLL_NAME
 
 
 def test_update_effort_data_when_database_update_fails(segment, segments_repository):
-    fetch_date = datetime.now().strftime("%d-%m-%Y")
-    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
-                                                                           '_update_one') as mock_update_one:
-        mock_find_one.return_value = {"efforts": [{"fetch_date": fetch_date, "effort_count": 10}]}
+    with patch.object(SegmentsRepository, '_update_one') as mock_update_one:
         mock_update_one.side_effect = Exception("Database update failed")
         with pytest.raises(Exception, match="Database update failed"):
             segments_repository.update_effort_data(segment)
 
 
-def test_update_effort_data_when_database_insert_fails(segment, segments_repository):
+def test_logging_when_effort_written(segment, segments_repository):
+    with patch.object(SegmentsRepository, '_update_one'), patch('services.segments_repository.Logger') as mock_logger:
+        segments_repository.update_effort_data(segment)
+        mock_logger.debug.assert_any_call(f"Effort data for segment {segment.id} written into DB")
+
+
+def test_update_segment_data_stores_geometry_separately(segment, segments_repository):
+    segments_repository.config.GEOMETRY_STORAGE = "collection"
     with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
                                                                            '_insert_one') as mock_insert_one:
         mock_find_one.return_value = None
-        mock_insert_one.side_effect = Exception("Database insert failed")
-        with pytest.raises(Exception, match="Database insert failed"):
-            segments_repository.update_effort_data(segment)
+        segments_repository.update_segment_data(segment)
+        segments_repository.geometries.save.assert_called_once_with(segment.map.polyline)
+        document = mock_insert_one.call_args.args[1]
+    assert "polyline" not in document
+    assert document["map"] == {"id": segment.map.id, "resource_state": segment.map.resource_state}
+    assert document["geometry_id"] == polyline_hash(segment.map.polyline)
 
 
-def test_logging_when_effort_exists(segment, segments_repository):
-    fetch_date = datetime.now().strftime("%d-%m-%Y")
-    with patch.object(Database, 'find_one') as mock_find_one, patch.object(SegmentsRepository,
-                                                                           '_update_one') as mock_update_one, patch(
-        'services.segments_repository.Logger') as mock_logger:
-        mock_find_one.return_value = {"efforts": [{"fetch_date": fetch_date, "effort_count": 10}]}
-        segments_repository.update_effort_data(segment)
-        mock_logger.debug.assert_any_call(f"Effort data for segment {segment.id} already exists in DB")
+def test_find_segments_loads_geometry_lazily(segments_repository):
+    with patch.object(Database, 'find_many') as mock_find_many, \
+            patch.object(GeometryRepository, 'get_polylines') as mock_get_polylines:
+        mock_find_many.return_value = [{"id": 1, "geometry_id": "abc", "map": {"id": "1", "resource_state": 1}}]
+        segments_repository.find_segments({"trail_area": "alghero"})
+        mock_find_many.assert_called_once_with("segments", {"trail_area": "alghero"},
+                                               {"polyline": 0, "map.polyline": 0})
+        mock_get_polylines.assert_not_called()
+
+        mock_get_polylines.return_value = {"abc": "encoded"}
+        documents = segments_repository.find_segments({"trail_area": "alghero"}, with_geometry=True)
+        mock_get_polylines.assert_called_once_with(["abc"])
+    assert documents[0]["polyline"] == "encoded"
+    assert Map(**documents[0]["map"]).polyline == "encoded"
+
+
+def test_find_segments_near_trail_base_queries_2dsphere_index(segments_repository):
+    with patch.object(Database, 'find_many', return_value=[]) as mock_find_many:
+        segments_repository.find_segments_near(TrailBase(name="Base", coordinates=(40.55, 8.31)), 2.5)
+        query = mock_find_many.call_args.args[1]
+    assert query == {"start_point": {"$nearSphere": {
+        "$geometry": {"type": "Point", "coordinates": [8.31, 40.55]}, "$maxDistance": 2500}}}
+
+
+def test_find_segments_in_box(segments_repository):
+    with patch.object(Database, 'find_many', return_value=[]) as mock_find_many:
+        segments_repository.find_segments_in_box(40.0, 8.0, 41.0, 9.0)
+        polygon = mock_find_many.call_args.args[1]["start_point"]["$geoWithin"]["$geometry"]
+    assert polygon == {"type": "Polygon", "coordinates": [[[8.0, 40.0], [9.0, 40.0], [9.0, 41.0], [8.0, 41.0],
+                                                          [8.0, 40.0]]]}
@@ -0,0 +1,136 @@
+import threading
+import time
+from unittest.mock import MagicMock
+from pymongo.errors import ServerSelectionTimeoutError
+from models.BulkWriteReport import BulkWriteReport
+from services.write_behind import SegmentSpool, WriteBehindWriter
+
+
+def write_behind(tmp_path, store_batch, **kwargs):
+    return WriteBehindWriter(MagicMock(), SegmentSpool(str(tmp_path / "spool.jsonl")), store_batch=store_batch,
+                             **kwargs)
+
+
+def test_writer_stores_queued_segments_in_the_background(tmp_path, make_segment):
+    stored = []
+    on_flush = MagicMock()
+
+    def store_batch(segments):
+        stored.extend(segments)
+        return BulkWriteReport(operations=len(segments))
+    writer = write_behind(tmp_path, store_batch, batch_size=2, on_flush=on_flush)
+    for segment_id in range(5):
+        writer.write_segment_data(make_segment(segment_id))
+    report = writer.close()
+    assert [segment.id for segment in stored] == [0, 1, 2, 3, 4]
+    assert report.operations == 5
+    assert sum(len(call.args[0]) for call in on_flush.call_args_list) == 5
+    assert writer.spooled == 0
+
+
+def test_writer_fills_batches_from_writes_arriving_one_at_a_time(tmp_path, make_segment):
+    batches = []
+    writer = write_behind(tmp_path, lambda segments: batches.append(len(segments)), batch_size=5, flush_interval=60)
+    for segment_id in range(10):
+        writer.write_segment_data(make_segment(segment_id))
+        time.sleep(0.01)
+    writer.close()
+    assert batches == [5, 5]
+
+
+def test_writer_stores_a_partial_batch_after_the_flush_interval(tmp_path, make_segment):
+    stored = threading.Event()
+    writer = write_behind(tmp_path, lambda segments: stored.set(), batch_size=100, flush_interval=0.05)
+    writer.write_segment_data(make_segment(1))
+    assert stored.wait(2)
+    writer.close()
+
+
+def test_writer_spools_the_failed_batch_and_later_writes(tmp_path, make_segment):
+    failed = threading.Event()
+
+    def store_batch(segments):
+        failed.set()
+        raise ServerSelectionTimeoutError("no servers")
+    on_spooled = MagicMock()
+    writer = write_behind(tmp_path, store_batch, batch_size=1, on_spooled=on_spooled)
+    spool = writer.spool
+    writer.write_segment_data(make_segment(1))
+    failed.wait(5)
+    while writer.spooled < 1:
+        time.sleep(0.01)
+    writer.write_segment_data(make_segment(2))
+    writer.close()
+    assert writer.db_down
+    assert writer.spooled == 2
+    assert [segment.id for call in on_spooled.call_args_list for segment in call.args[0]] == [1, 2]
+    assert [segment.id for segment in SegmentSpool._read(spool.path)] == [1, 2]
+
+
+def test_writer_spools_when_the_queue_is_full(tmp_path, make_segment):
+    storing, release = threading.Event(), threading.Event()
+    stored = []
+
+    def store_batch(segments):
+        storing.set()
+        release.wait(5)
+        stored.extend(segments)
+    writer = write_behind(tmp_path, store_batch, batch_size=1, max_pending=1)
+    spool = writer.spool
+    writer.write_segment_data(make_segment(1))
+    storing.wait(5)
+    writer.write_segment_data(make_segment(2))  # waits for the next flush
+    writer.write_segment_data(make_segment(3))  # max_pending segments are already waiting
+    release.set()
+    writer.close()
+    assert [segment.id for segment in stored] == [1, 2]
+    assert [segment.id for segment in SegmentSpool._read(spool.path)] == [3]
+
+
+def test_replay_writes_spooled_segments_and_empties_the_spool(tmp_path, make_segment):
+    spool = SegmentSpool(str(tmp_path / "spool.jsonl"))
+    spool.append([make_segment(1), make_segment(2), make_segment(3)])
+    with open(spool.path, "a") as spool_file:
+        spool_file.write('{"id": 4, "na')  # truncated by a crash
+    store_batch = MagicMock()
+    assert spool.replay(store_batch, batch_size=2) == 3
+    assert [[segment.id for segment in call.args[0]] for call in store_batch.call_args_list] == [[1, 2], [3]]
+    assert store_batch.call_args_list[0].args[0][0] == make_segment(1)
+    assert SegmentSpool._read(spool.path) == []
+    assert spool.replay(store_batch, batch_size=2) == 0
+
+
+def test_replay_keeps_the_batches_that_failed(tmp_path, make_segment):
+    spool = SegmentSpool(str(tmp_path / "spool.jsonl"))
+    spool.append([make_segment(1), make_segment(2)])
+    store_batch = MagicMock(side_effect=[None, ServerSelectionTimeoutError("no servers")])
+    assert spool.replay(store_batch, batch_size=1) == 1
+    assert [segment.id for segment in SegmentSpool._read(spool.path)] == [2]
+
+
+def test_writer_fails_only_the_rejected_segment(tmp_path, make_segment):
+    stored = []
+
+    def store_batch(segments):
+        if any(segment.id == 2 for segment in segments):
+            raise ValueError("document too large")
+        stored.extend(segments)
+    on_failed = MagicMock()
+    writer = write_behind(tmp_path, store_batch, batch_size=1, on_failed=on_failed)
+    for segment_id in (1, 2, 3):
+        writer.write_segment_data(make_segment(segment_id))
+    writer.close()
+    assert [segment.id for segment in stored] == [1, 3]
+    assert [segment.id for segment in on_failed.call_args.args[0]] == [2]
+    assert writer.spooled == 0
+
+
+def test_replay_drops_segments_the_db_rejects(tmp_path, make_segment):
+    spool = SegmentSpool(str(tmp_path / "spool.jsonl"))
+    spool.append([make_segment(1), make_segment(2)])
+
+    def store_batch(segments):
+        if any(segment.id == 2 for segment in segments):
+            raise ValueError("document too large")
+    assert spool.replay(store_batch, batch_size=2) == 1
+    assert SegmentSpool._read(spool.path) == []
@@ -1,4 +1,5 @@
 import os
+import socket
 
 
 class Config:
@@ -6,7 +7,42 @@ class Config:
     EFFORT_COLL_NAME = "effort_stats"
     SEGMENTS_COLL_NAME = "segments"
     AREAS_COLL_NAME = "areas"
+    TOKENS_COLL_NAME = "strava_tokens"
+    EFFORT_BUCKETS_COLL_NAME = "effort_buckets"
+    EFFORT_COMPACT_COLL_NAME = "effort_history_compact"
+    JOB_STATE_COLL_NAME = "job_state"
+    GEOMETRIES_COLL_NAME = "geometries"
+    RUN_JOURNAL_COLL_NAME = "job_runs"
+    LEASES_COLL_NAME = "segment_leases"
+    AREA_ROLLUPS_COLL_NAME = "area_daily_rollups"
     DATE_FORMAT = "%d-%m-%Y"
+    BUCKET_MONTH_FORMAT = "%Y-%m"
+    STRAVA_RATE_LIMIT_SAFETY_MARGIN = 2
+    STRAVA_RATE_LIMIT_MAX_WAIT = 16 * 60
+    STRAVA_REQUEST_TIMEOUT = 30
+    STRAVA_MAX_RETRIES = 5
+    STRAVA_BACKOFF_FACTOR = 0.5
+    STRAVA_BACKOFF_JITTER = 0.5
+    STRAVA_TOKEN_REFRESH_MARGIN = 5 * 60
+    # (max age in days, resolution) tiers for EffortCompactor, the last tier covering all older efforts
+    EFFORT_RETENTION_POLICY = ((90, "sample"), (365, "day"), (None, "week"))
+    # Douglas-Peucker tolerances in whole meters of the simplified shapes stored with each geometry
+    GEOMETRY_SIMPLIFY_TOLERANCES = (5, 20)
+    # FetchScheduler refreshes a segment once it is expected to have gained SCHEDULE_TARGET_EFFORTS efforts
+    SCHEDULE_TARGET_EFFORTS = 5
+    SCHEDULE_MIN_INTERVAL_DAYS = 1
+    SCHEDULE_MAX_INTERVAL_DAYS = 14
+    SCHEDULE_RATE_SAMPLES = 8
+    # SegmentScorer rates popularity on the efforts of the last SCORING_WINDOW_DAYS days; a segment's difficulty
+    # class goes up at each absolute average grade threshold (percent) and once more from the long distance (meters)
+    SCORING_WINDOW_DAYS = 30
+    DIFFICULTY_GRADE_THRESHOLDS = (3, 6, 10)
+    DIFFICULTY_LONG_DISTANCE = 3000
+    # Seconds kept free before the run deadline to finish in-flight fetches and flush pending writes
+    RUN_DEADLINE_MARGIN = 60
+    # Longer than the longest rate limit wait, so only a crashed worker loses its segment leases
+    SEGMENT_LEASE_TTL = 20 * 60
+    SEGMENT_LEASE_POLL_INTERVAL = 5
 
     def __init__(self):
         self.STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
@@ -15,6 +51,40 @@ class Config:
         self.STRAVA_REFRESH_TOKEN = os.getenv("STRAVA_REFRESH_TOKEN")
         self.DB_URI = os.getenv("DB_URI")
         self.DB_NAME = os.getenv("DB_NAME")
+        self.FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", 8))
+        self.STRAVA_TOKEN_STORE = os.getenv("STRAVA_TOKEN_STORE", "mongo")
+        self.STRAVA_TOKEN_FILE = os.getenv("STRAVA_TOKEN_FILE", ".strava_token.json")
+        self.STRAVA_CACHE_PATH = os.getenv("STRAVA_CACHE_PATH", ".strava_cache.sqlite")
+        self.STRAVA_CACHE_TTL = float(os.getenv("STRAVA_CACHE_TTL", 6 * 60 * 60))
+        self.STRAVA_CACHE_MAX_BYTES = int(os.getenv("STRAVA_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.STRAVA_POOL_SIZE = int(os.getenv("STRAVA_POOL_SIZE", self.FETCH_MAX_WORKERS))
+        self.EFFORT_STORAGE = os.getenv("EFFORT_STORAGE", "document")
+        # "collection" keeps polylines only in the geometries collection, "inline" also keeps both copies in segments
+        self.GEOMETRY_STORAGE = os.getenv("GEOMETRY_STORAGE", "collection")
+        self.WRITE_MODE = os.getenv("WRITE_MODE", "bulk")
+        self.BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", 100))
+        self.BULK_WRITE_FLUSH_INTERVAL = float(os.getenv("BULK_WRITE_FLUSH_INTERVAL", 30))
+        # Writes go through WriteBehindWriter, spilling to this file when the DB lags or fails; empty to disable
+        self.WRITE_SPOOL_PATH = os.getenv("WRITE_SPOOL_PATH", ".segments_spool.jsonl")
+        self.WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 1000))
+        # "threads" fetches in a thread pool and writes from the main thread, "pipeline" overlaps the
+        # fetch, validate and write stages in SegmentPipeline
+        self.EXECUTION_MODE = os.getenv("EXECUTION_MODE", "threads")
+        self.PIPELINE_VALIDATE_WORKERS = int(os.getenv("PIPELINE_VALIDATE_WORKERS", 1))
+        self.PIPELINE_WRITE_WORKERS = int(os.getenv("PIPELINE_WRITE_WORKERS", 2))
+        self.PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2 * self.FETCH_MAX_WORKERS))
+        self.FETCH_SCHEDULE = os.getenv("FETCH_SCHEDULE", "all")
+        # Segments fetched per run at most by the adaptive schedule, below Strava's default daily read limit
+        self.FETCH_QUOTA = int(os.getenv("FETCH_QUOTA", 900))
+        # Seconds and Strava requests a run may spend, 0 for no limit
+        self.RUN_TIME_BUDGET = float(os.getenv("RUN_TIME_BUDGET", 0))
+        self.RUN_REQUEST_BUDGET = int(os.getenv("RUN_REQUEST_BUDGET", 0))
+        # "none", "hash" (SHARD_INDEX of SHARD_COUNT) or "lease" (workers sharing SHARD_RUN_KEY claim segments)
+        self.SHARD_MODE = os.getenv("SHARD_MODE", "none")
+        self.SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+        self.SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+        self.SHARD_RUN_KEY = os.getenv("SHARD_RUN_KEY", os.getenv("GITHUB_RUN_ID"))
+        self.SHARD_WORKER_ID = os.getenv("SHARD_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
 
 
 class ConfigForTest(Config):
@@ -0,0 +1,117 @@
+from typing import List, Sequence, Tuple
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+POLYLINE_PRECISION = 1e5
+
+
+def _decode_values(encoded: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Decode the varint chunks of encoded polyline bytes into signed integers.
+
+    Returns the values and, for each value, the index of its last byte.
+    """
+    chunks = encoded.astype(np.int64) - 63
+    is_last = (chunks & 0x20) == 0
+    last_indexes = np.flatnonzero(is_last)
+    first_indexes = np.concatenate(([0], last_indexes[:-1] + 1))
+    value_index = np.repeat(np.arange(len(last_indexes)), last_indexes - first_indexes + 1)
+    shifts = 5 * (np.arange(len(chunks)) - first_indexes[value_index])
+    values = np.zeros(len(last_indexes), dtype=np.int64)
+    np.add.at(values, value_index, (chunks & 0x1f) << shifts)
+    return np.where(values & 1, ~(values >> 1), values >> 1), last_indexes
+
+
+def decode_polyline(polyline: str) -> np.ndarray:
+    """Decode a Google encoded polyline into an (n, 2) array of lat, lng."""
+    return decode_polylines([polyline])[0]
+
+
+def decode_polylines(polylines: Sequence[str]) -> List[np.ndarray]:
+    """
+    Decode many Google encoded polylines in a single vectorized pass.
+
+    Raises ValueError when a polyline is malformed: characters outside the encoding, a truncated
+    last value or a latitude without its longitude.
+    """
+    if not polylines:
+        return []
+    lengths = np.array([len(polyline) for polyline in polylines])
+    try:
+        encoded = np.frombuffer("".join(polylines).encode("ascii"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        raise ValueError("Malformed encoded polyline: non-ASCII characters") from None
+    if np.any((encoded < 63) | (encoded > 126)):
+        raise ValueError("Malformed encoded polyline: characters outside the encoding range")
+    ends = np.cumsum(lengths)
+    # A truncated polyline ends inside a value, which would run on into the next polyline
+    last_bytes = encoded[ends[lengths > 0] - 1].astype(np.int64) - 63
+    if np.any(last_bytes & 0x20):
+        raise ValueError(f"Malformed encoded polyline: truncated polyline at index "
+                         f"{int(np.flatnonzero(lengths > 0)[np.argmax(last_bytes & 0x20 != 0)])}")
+    values, last_indexes = _decode_values(encoded)
+    # Number of values in each polyline, from the polyline each value ends in
+    value_counts = np.bincount(np.searchsorted(ends, last_indexes, side="right"), minlength=len(polylines))
+    if np.any(value_counts % 2):
+        raise ValueError(f"Malformed encoded polyline: odd number of values at index "
+                         f"{int(np.argmax(value_counts % 2))}")
+    deltas = values.reshape(-1, 2)
+    coordinates = np.cumsum(deltas, axis=0)
+    point_ends = np.cumsum(value_counts // 2)
+    point_starts = point_ends - value_counts // 2
+    decoded = []
+    for start, end in zip(point_starts, point_ends):
+        # Deltas restart at the first point of every polyline
+        offset = coordinates[start - 1] if start > 0 else 0
+        decoded.append((coordinates[start:end] - offset) / POLYLINE_PRECISION)
+    return decoded
+
+
+def bounding_box(coordinates: np.ndarray) -> Tuple[float, float, float, float]:
+    """(min_lat, min_lng, max_lat, max_lng) of a coordinate array."""
+    min_lat, min_lng = coordinates.min(axis=0)
+    max_lat, max_lng = coordinates.max(axis=0)
+    return float(min_lat), float(min_lng), float(max_lat), float(max_lng)
+
+
+def path_length(coordinates: np.ndarray) -> float:
+    """Length in meters of the path through the coordinates, by the haversine formula."""
+    if len(coordinates) < 2:
+        return 0.0
+    lat, lng = np.radians(coordinates[:, 0]), np.radians(coordinates[:, 1])
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2)
+    return float(np.sum(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))))
+
+
+def _to_local_meters(coordinates: np.ndarray) -> np.ndarray:
+    """Equirectangular projection around the path, accurate enough at segment scale."""
+    lat0 = np.radians(coordinates[:, 0].mean())
+    radians = np.radians(coordinates)
+    return np.column_stack((radians[:, 0] * EARTH_RADIUS_M, radians[:, 1] * EARTH_RADIUS_M * np.cos(lat0)))
+
+
+def simplify(coordinates: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas–Peucker simplification keeping every point farther than tolerance meters from the path."""
+    if len(coordinates) < 3:
+        return coordinates
+    points = _to_local_meters(coordinates)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        relative = points[start + 1:end] - points[start]
+        segment_length = np.hypot(*segment)
+        if segment_length == 0:
+            distances = np.hypot(relative[:, 0], relative[:, 1])
+        else:
+            distances = np.abs(segment[0] * relative[:, 1] - segment[1] * relative[:, 0]) / segment_length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.extend(((start, index), (index, end)))
+    return coordinates[keep]